@@ -1,17 +1,66 @@
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextlib
 from typing import Any
+import metrics
 
 
 from ast import Dict
 import queue
+import random
+import sys
 import threading
 import pymysql
 from pymysql.connections import Connection
+from pymysql.constants.SERVER_STATUS import SERVER_STATUS_IN_TRANS
 from pymysql.cursors import Cursor, DictCursor, SSDictCursor, SSCursor
 from queue import Queue
 import simple_log
 import traceback
 import time
+
+# 连接池使用率(借出连接数/连接数)直方图的分桶
+UTILIZATION_BUCKETS = (0.1,0.25,0.5,0.75,0.9,1)
+
+ISOLATION_LEVELS = ('READ UNCOMMITTED','READ COMMITTED','REPEATABLE READ','SERIALIZABLE')
+
+# 借出连接时记录的调用栈层数; 连接池与contextlib自身的栈帧不计入
+CHECKOUT_STACK_LIMIT = 8
+CHECKOUT_SKIPPED_FILES = (__file__,contextlib.__file__)
+
+def isolation_statement(isolation_level:str)->str:
+  '''
+  设置会话隔离级别的语句; 不使用transaction_isolation变量, 它在MySQL 5.7.20与MariaDB 11.1之前不存在
+  '''
+  level = isolation_level.upper().replace('-',' ')
+  if level not in ISOLATION_LEVELS:
+    raise ValueError(f'Invalid isolation_level: {isolation_level}, expected one of {ISOLATION_LEVELS}')
+  return f'SET SESSION TRANSACTION ISOLATION LEVEL {level}'
+
+def session_assignments(values:dict)->list[str]:
+  '''
+  会话配置中的变量对应的SET SESSION赋值: lock_wait_timeout(秒), max_execution_time(毫秒, 只限制SELECT)
+  isolation_level由isolation_statement单独设置; charset与autocommit不在此列, 由pymysql的连接参数与Connection.autocommit()处理
+  '''
+  assignments = []
+  if values.get('lock_wait_timeout') is not None:
+    assignments.append(f'innodb_lock_wait_timeout = {int(values["lock_wait_timeout"])}')
+  if values.get('max_execution_time') is not None:
+    assignments.append(f'max_execution_time = {int(values["max_execution_time"])}')
+  return assignments
+
+def session_statements(values:dict)->list[str]:
+  '''
+  应用会话配置的语句: 隔离级别一条, 其余变量合并为一条SET SESSION
+  '''
+  statements = []
+  if values.get('isolation_level') is not None:
+    statements.append(isolation_statement(values['isolation_level']))
+  assignments = session_assignments(values)
+  if assignments:
+    statements.append('SET SESSION '+', '.join(assignments))
+  return statements
+
 class DBpool:
   '''
   数据库连接池
@@ -20,70 +69,421 @@ class DBpool:
   def create_connection(self):
     try:
       if self.cursorclass == 'Default' or self.cursorclass is None or self.cursorclass == 'Cursor':
-        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db)
+        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,**self.session_args)
       elif self.cursorclass == 'DictCursor':
-        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=DictCursor)
+        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=DictCursor,**self.session_args)
       elif self.cursorclass == 'SSDictCursor':
-        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=SSDictCursor)
+        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=SSDictCursor,**self.session_args)
       elif self.cursorclass == 'SSCursor':
-        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=SSCursor)
+        conn = pymysql.connect(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=SSCursor,**self.session_args)
       else:
         simple_log.log(f"Invalid cursorclass: {self.cursorclass} in creating of DBpool",log_path=self.logging_path)
         raise Exception(f"Invalid cursorclass: {self.cursorclass}")
-      return conn
+      return self.init_session(conn)
     except Exception as e:
       simple_log.log(traceback.format_exc(),log_path=self.logging_path)
       raise e
   
-  def __init__(self,max_connections:int,host:str,port:int,user:str,password:str,db:str,cursorclass:str = 'Default',logging_path:str = './logging_dir/log.txt'):
+  def __init__(self,max_connections:int,host:str,port:int,user:str,password:str,db:str,cursorclass:str = 'Default',logging_path:str = './logging_dir/log.txt',min_size:int|None = None,grow_after:float = 0.05,idle_timeout:float = 300,warmup_workers:int = 8,min_ready:int|None = None,metrics_obj:metrics.Metrics|None = None,hold_warning_seconds:float = 60,session:dict|None = None):
+    '''
+    min_size为None时为固定大小模式: 启动时创建全部max_connections个连接, 任何一个失败都会关闭连接池并抛出异常
+    min_size不为None时为弹性模式:
+      启动时只创建min_size个连接, 部分创建失败时用已创建的连接启动(一个都没有创建成功时抛出异常)
+      获取连接等待超过grow_after秒时新建连接, 最多max_connections个
+      空闲超过idle_timeout秒的连接由后台线程关闭, 至少保留min_size个
+    启动时最多warmup_workers个连接同时握手; 有min_ready个连接可用后构造函数即返回, 其余连接在后台继续创建
+    min_ready为None时等待全部连接创建完成; 启动耗时记录在metrics_obj的dbpool_ready_seconds与dbpool_warm_seconds中
+    每次借出记录持有者线程与借出时间, 等待时间、持有时间与使用率写入metrics_obj的dbpool_wait_seconds、dbpool_hold_seconds、dbpool_utilization
+    hold_warning_seconds: 连接被持有超过该时间时由维护线程记录借出连接的位置与持有线程当前的调用栈, 为0时不检查(也不记录借出位置)
+    session: 每个连接建立时设置一次的会话配置, 例如{'isolation_level':'READ COMMITTED','lock_wait_timeout':5,'max_execution_time':30000,'charset':'utf8mb4','autocommit':False}
+    连接记录已设置的会话状态(conn.session_state), set_session()只对与当前状态不同的项执行SET
+    '''
     self.host = host
     self.port = port
     self.user = user
     self.password = password
     self.db = db
-    self.pool = Queue[Connection]()
     self.max_connections = max_connections
     self.cursorclass = cursorclass
     self.logging_path = logging_path
-    successful_connections = 0
-    for i in range(self.max_connections):
+    self.elastic = min_size is not None
+    self.min_size = min(max(0,min_size),max_connections) if self.elastic else max_connections
+    self.grow_after = grow_after
+    self.idle_timeout = idle_timeout
+    # 弹性模式下后进先出, 常用的连接保持活跃, 多余的连接才会空闲超时
+    self.pool = queue.LifoQueue() if self.elastic else Queue[Connection]()
+    # 已创建且未关闭的连接数(包括借出的连接), 由size_lock保护
+    self.size = 0
+    self.size_lock = threading.Lock()
+    self.maintenance_stop = threading.Event()
+    self.maintenance_thread:threading.Thread|None = None
+    self.metrics = metrics_obj if metrics_obj is not None else metrics.Metrics()
+    self.closed = False
+    self.session = dict(session) if session else {}
+    self.session_args = self.session_connect_args()
+    self.warmup_executor:ThreadPoolExecutor|None = None
+    # 启动时创建连接的进度, 由warmup_cond保护
+    self.warmup_cond = threading.Condition()
+    self.warmup_created = 0
+    self.warmup_failed = 0
+    self.warmup_remaining = 0
+    self.hold_warning_seconds = hold_warning_seconds
+    # id(conn) -> [持有线程ident, 线程名, 借出时间, 是否已记录调用栈, 借出位置], 由hold_lock保护
+    self.holders:dict[int,list] = {}
+    self.hold_lock = threading.Lock()
+    self.warm_up(self.min_size,min_ready,warmup_workers)
+    if self.needs_maintenance():
+      self.maintenance_thread = threading.Thread(target=self.maintenance_loop,name='dbpool_maintenance',daemon=True)
+      self.maintenance_thread.start()
+
+  def session_connect_args(self)->dict:
+    '''
+    会话配置对应的pymysql.connect参数: charset与autocommit直接传入, 其余变量合并为一条init_command, 在握手时一并执行
+    隔离级别不放进init_command(init_command只能是一条语句), 由init_session单独设置
+    '''
+    args = {}
+    if self.session.get('charset') is not None:
+      args['charset'] = self.session['charset']
+    if self.session.get('autocommit') is not None:
+      args['autocommit'] = bool(self.session['autocommit'])
+    assignments = session_assignments(self.session)
+    if assignments:
+      args['init_command'] = 'SET SESSION '+', '.join(assignments)
+    return args
+
+  def init_session(self,conn:Connection)->Connection:
+    '''
+    设置新建连接的隔离级别并记录已经应用的会话配置
+    ping(reconnect=True)重连时pymysql只会重新执行init_command, conn.init_statements由db_retry.retry在重连后重新执行
+    '''
+    conn.init_statements = session_statements({'isolation_level':self.session.get('isolation_level')})
+    for statement in conn.init_statements:
+      with conn.cursor() as cursor:
+        cursor.execute(statement)
+    conn.session_state = dict(self.session)
+    return conn
+
+  def set_session(self,conn:Connection,**values)->bool:
+    '''
+    按需修改连接的会话配置(isolation_level, lock_wait_timeout, max_execution_time, autocommit)
+    与conn.session_state相同的项跳过, 全部相同时不访问数据库; 返回是否执行了SET
+    '''
+    state = getattr(conn,'session_state',None)
+    if state is None:
+      state = {}
+      conn.session_state = state
+    changed = {key:value for key,value in values.items() if state.get(key) != value}
+    if not changed:
+      return False
+    statements = session_statements(changed)
+    if statements:
+      with conn.cursor() as cursor:
+        for statement in statements:
+          cursor.execute(statement)
+    if 'autocommit' in changed:
+      conn.autocommit(bool(changed['autocommit']))
+    state.update(changed)
+    self.metrics.incr('dbpool_session_sets')
+    return True
+
+  def warm_up(self,target:int,min_ready:int|None,workers:int):
+    '''
+    并发创建target个连接, 有min_ready个可用后返回, 其余连接由warmup_executor在后台继续创建
+    固定大小模式下在返回前有任何连接创建失败时关闭连接池并抛出异常; 弹性模式下只有一个连接都没有创建成功时才抛出异常
+    返回之后的创建失败只记录日志, 连接池以较少的连接继续运行
+    '''
+    start = time.time()
+    min_ready = target if min_ready is None else min(max(0,min_ready),target)
+    if target <= 0:
+      self.metrics.set_gauge('dbpool_ready_seconds',0)
+      return
+    self.warmup_remaining = target
+    def open_one():
+      conn = None
+      error = None
+      begin = time.time()
+      try:
+        if not self.closed:
+          conn = self.create_connection()
+      except Exception as e:
+        error = e
+      # 先记账并唤醒等待者, 再写日志, 日志写入失败不会让构造函数一直等待
+      with self.warmup_cond:
+        if conn is None:
+          self.warmup_failed += 1
+        elif self.closed:
+          conn.close()
+        else:
+          with self.size_lock:
+            self.size += 1
+          self.release_to_pool(conn)
+          self.warmup_created += 1
+        self.warmup_remaining -= 1
+        last = self.warmup_remaining == 0
+        self.warmup_cond.notify_all()
+      if conn is not None:
+        self.metrics.observe('dbpool_connect_seconds',time.time()-begin)
+      if error is not None:
+        self.metrics.incr('dbpool_connect_errors')
+        simple_log.log(f"Failed to create connection during warm-up: {str(error)}",log_path=self.logging_path)
+      if last:
+        elapsed = time.time()-start
+        self.metrics.set_gauge('dbpool_warm_seconds',elapsed)
+        simple_log.log(f"DBpool warm-up finished in {elapsed:.3f}s: {self.warmup_created} connections created, {self.warmup_failed} failed",log_path=self.logging_path)
+    self.warmup_executor = ThreadPoolExecutor(max_workers=max(1,min(workers,target)),thread_name_prefix='dbpool_warmup')
+    for _ in range(target):
+      self.warmup_executor.submit(open_one)
+    with self.warmup_cond:
+      # 固定大小模式下任何失败都会导致启动失败, 不必等待其余连接
+      strict_failed = lambda: not self.elastic and self.warmup_failed > 0
+      self.warmup_cond.wait_for(lambda: self.warmup_created >= min_ready or self.warmup_remaining == 0 or strict_failed())
+      created = self.warmup_created
+      failed = strict_failed() or (created < min_ready and (not self.elastic or created == 0))
+    if failed:
+      self.closed = True
+      self.warmup_executor.shutdown(wait=True,cancel_futures=True)
+      self.warmup_executor = None
+      while self.pool.empty() == False:
+        self.discard_connection(self.pool.get())
+      simple_log.log(f"Warning: Only created {created} out of {target} requested connections",log_path=self.logging_path)
+      raise Exception(f"Failed to create {target} connections. Only {created} connections were created successfully. This might be due to MySQL max_connections limit or system resource constraints.")
+    if created < min_ready:
+      simple_log.log(f"Warning: elastic pool started with {created} out of {min_ready} connections",log_path=self.logging_path)
+    self.warmup_executor.shutdown(wait=False)
+    elapsed = time.time()-start
+    self.metrics.set_gauge('dbpool_ready_seconds',elapsed)
+    simple_log.log(f"DBpool ready in {elapsed:.3f}s with {created} connections, warming {target-created} more in background",log_path=self.logging_path)
+
+  def grow(self)->Connection|None:
+    '''
+    连接数未达到max_connections时新建一个连接并直接借出, 已达上限或创建失败时返回None
+    '''
+    with self.size_lock:
+      if self.size >= self.max_connections:
+        return None
+      self.size += 1
+    try:
+      conn = self.create_connection()
+    except Exception as e:
+      with self.size_lock:
+        self.size -= 1
+      simple_log.log(f"Failed to grow elastic pool beyond {self.size} connections: {str(e)}",log_path=self.logging_path)
+      return None
+    self.metrics.incr('dbpool_grown')
+    simple_log.log(f"Elastic pool grew to {self.size} connections",log_path=self.logging_path)
+    return conn
+
+  def checkout(self,timeout:float|None=None)->Connection:
+    '''
+    从连接池取出连接; 弹性模式下等待超过grow_after秒后尝试新建连接, 无法新建时继续等待
+    timeout为None时一直等待, 否则超时后抛出queue.Empty
+    '''
+    if not self.elastic:
+      return self.pool.get(block=True,timeout=timeout)
+    deadline = None if timeout is None else time.time()+timeout
+    wait = self.grow_after if timeout is None else min(self.grow_after,timeout)
+    try:
+      return self.pool.get(block=True,timeout=wait)
+    except queue.Empty:
+      pass
+    conn = self.grow()
+    if conn is not None:
+      return conn
+    return self.pool.get(block=True,timeout=None if deadline is None else max(0,deadline-time.time()))
+
+  def discard_connection(self,conn:Connection|None):
+    '''
+    关闭一个不再放回连接池的连接(失效或空闲超时)
+    '''
+    if conn is not None:
+      with self.hold_lock:
+        self.holders.pop(id(conn),None)
+    with self.size_lock:
+      self.size = max(0,self.size-1)
+    if conn is not None:
+      try:
+        conn.close()
+      except Exception:
+        pass
+
+  def shrink_idle(self)->int:
+    '''
+    关闭空闲超过idle_timeout秒的连接, 至少保留min_size个, 返回关闭的连接数
+    '''
+    now = time.time()
+    idle = []
+    with self.pool.mutex:
+      with self.size_lock:
+        removable = self.size-self.min_size
+      # LifoQueue中越靠前的连接空闲越久
+      for conn in list(self.pool.queue):
+        if removable <= 0:
+          break
+        if now-getattr(conn,'pool_idle_since',now) > self.idle_timeout:
+          self.pool.queue.remove(conn)
+          idle.append(conn)
+          removable -= 1
+    for conn in idle:
+      self.discard_connection(conn)
+    if idle:
+      self.metrics.incr('dbpool_idle_closed',len(idle))
+      simple_log.log(f"Elastic pool closed {len(idle)} idle connections, {self.size} left",log_path=self.logging_path)
+    return len(idle)
+
+  def replenish(self)->int:
+    '''
+    连接数低于min_size(固定大小模式下为max_connections)时补充连接, 返回补充的连接数; 启动预热尚未结束时不补充
+    '''
+    added = 0
+    while not self.closed:
+      with self.size_lock:
+        if self.warmup_remaining > 0 or self.size >= self.min_size:
+          break
+        self.size += 1
       try:
         conn = self.create_connection()
-        self.pool.put(conn)
-        successful_connections += 1
-        #改为日志记录
-        print(f"Successfully created connection {successful_connections}/{max_connections}")
-        
       except Exception as e:
-        #改为日志记录
-        simple_log.log(traceback.format_exc(),log_path = self.logging_path)
-        simple_log.log(f"Failed to create connection {i+1}: {str(e)}",log_path=self.logging_path)
-        print(f"Failed to create connection {i+1}: {str(e)}")
+        with self.size_lock:
+          self.size -= 1
+        simple_log.log(f"Failed to replenish DBpool at {self.size} connections: {str(e)}",log_path=self.logging_path)
         break
-    actual_connections = self.pool.qsize()
-    if actual_connections != max_connections:
-      #改为日志记录
-      simple_log.log(f"Warning: Only created {actual_connections} out of {max_connections} requested connections",log_path=self.logging_path)
-      while self.pool.empty() == False:
-        self.pool.get().close()
-      raise Exception(f"Failed to create {max_connections} connections. Only {actual_connections} connections were created successfully. This might be due to MySQL max_connections limit or system resource constraints.")
+      self.release_to_pool(conn)
+      added += 1
+    if added:
+      self.metrics.incr('dbpool_replenished',added)
+    return added
+
+  def check_holds(self)->int:
+    '''
+    记录持有超过hold_warning_seconds秒的连接的借出位置与持有线程当前的调用栈, 每次借出只记录一次, 返回本轮记录的数量
+    持有线程当前可能已经在执行与这个连接无关的代码, 借出位置才能说明是哪里没有及时归还
+    '''
+    if self.hold_warning_seconds <= 0:
+      return 0
+    now = time.time()
+    with self.hold_lock:
+      long_holds = [holder for holder in self.holders.values() if not holder[3] and now-holder[2] > self.hold_warning_seconds]
+      for holder in long_holds:
+        holder[3] = True
+    if not long_holds:
+      return 0
+    frames = sys._current_frames()
+    for ident,name,since,_,site in long_holds:
+      frame = frames.get(ident)
+      stack = ''.join(traceback.format_stack(frame)) if frame is not None else '(thread has exited, connection was never returned)\n'
+      checkout = ''.join(site.format()) if site else '(not recorded)\n'
+      simple_log.log(f"DBpool connection held by thread {name} for {now-since:.1f}s ({len(self.holders)}/{self.size} in use), checked out at:\n{checkout}current stack:\n{stack}",log_path=self.logging_path)
+    self.metrics.incr('dbpool_long_holds',len(long_holds))
+    return len(long_holds)
+
+  def needs_maintenance(self)->bool:
+    return self.elastic or self.hold_warning_seconds > 0
+
+  def maintenance_interval(self)->float:
+    interval = min(self.idle_timeout/2,30)
+    if self.hold_warning_seconds > 0:
+      interval = min(interval,self.hold_warning_seconds/2)
+    return max(1.0,interval)
+
+  def maintain(self):
+    '''
+    后台维护线程每轮执行的操作
+    '''
+    if self.elastic:
+      self.shrink_idle()
+    self.check_holds()
+    self.replenish()
+
+  def maintenance_loop(self):
+    interval = self.maintenance_interval()
+    while not self.maintenance_stop.wait(timeout=interval):
+      try:
+        self.maintain()
+      except Exception as e:
+        simple_log.log(f"Error in DBpool maintenance: {str(e)}",log_path=self.logging_path)
+
+  def checkout_site(self)->traceback.StackSummary|None:
+    '''
+    借出连接的调用位置: 跳过连接池与contextlib的栈帧, 记录调用方最内层的CHECKOUT_STACK_LIMIT层
+    源代码行在check_holds记录日志时才读取, 借出时只遍历栈帧
+    '''
+    if self.hold_warning_seconds <= 0:
+      return None
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in CHECKOUT_SKIPPED_FILES:
+      frame = frame.f_back
+    site = traceback.StackSummary.extract(traceback.walk_stack(frame),limit=CHECKOUT_STACK_LIMIT,lookup_lines=False)
+    site.reverse()
+    return site
+
+  def track_checkout(self,conn:Connection,start:float):
+    now = time.time()
+    current = threading.current_thread()
+    site = self.checkout_site()
+    with self.hold_lock:
+      self.holders[id(conn)] = [current.ident,current.name,now,False,site]
+      in_use = len(self.holders)
+    self.metrics.observe('dbpool_wait_seconds',now-start)
+    self.metrics.observe('dbpool_utilization',in_use/max(1,self.size),UTILIZATION_BUCKETS)
+    self.metrics.set_gauge('dbpool_in_use',in_use)
+    return conn
 
   # 获取连接
   def get_connection(self):
-    return self.pool.get(block=True)
+    start = time.time()
+    return self.track_checkout(self.checkout(),start)
 
   # 获取连接, 超时时间默认10秒, 超时后抛出TimeoutError
   def timed_get_connection(self,timeout:int=10):
-    return self.pool.get(block=True,timeout=timeout)
+    start = time.time()
+    return self.track_checkout(self.checkout(timeout),start)
   
   # 放回连接
   def put_connection(self,conn:Connection):
+    with self.hold_lock:
+      holder = self.holders.pop(id(conn),None)
+    if holder is not None:
+      self.metrics.observe('dbpool_hold_seconds',time.time()-holder[2])
+    self.release_to_pool(conn)
+
+  @contextmanager
+  def connection(self,timeout:float|None=None):
+    '''
+    with pool.connection() as conn: 借出连接, 退出时回滚未提交的事务并放回连接池
+    获取连接失败时不会执行放回; 回滚失败的连接已不可用, 关闭而不放回, 由维护线程补充
+    '''
+    conn = self.get_connection() if timeout is None else self.timed_get_connection(timeout)
+    try:
+      yield conn
+    finally:
+      try:
+        # 已提交的连接不在事务中, 不需要额外的ROLLBACK往返
+        if getattr(conn,'server_status',SERVER_STATUS_IN_TRANS) & SERVER_STATUS_IN_TRANS:
+          conn.rollback()
+      except Exception as e:
+        simple_log.log(f"Rollback failed while returning a connection, closing it: {str(e)}",log_path=self.logging_path)
+        self.discard_connection(conn)
+      else:
+        self.put_connection(conn)
+
+  # 连接放回队列并记录开始空闲的时间, 供连接池内部使用
+  def release_to_pool(self,conn:Connection):
+    conn.pool_idle_since = time.time()
     self.pool.put(conn)
     
   # 关闭连接池
   def close(self):
+    with self.warmup_cond:
+      self.closed = True
+    if self.warmup_executor is not None:
+      self.warmup_executor.shutdown(wait=True,cancel_futures=True)
+      self.warmup_executor = None
+    self.maintenance_stop.set()
+    if self.maintenance_thread is not None and self.maintenance_thread is not threading.current_thread():
+      self.maintenance_thread.join()
+      self.maintenance_thread = None
     while self.pool.empty() == False:
-      self.pool.get().close()
+      self.discard_connection(self.pool.get())
   
   # 获取当前连接池大小
   def get_pool_size(self):
@@ -171,95 +571,96 @@ class ConnectionRenew(pymysql.Connection):
 
 class DBpoolRenew(DBpool):
   '''
-  每经过一段自定义时间, 就会进入"更新"状态, 在更新状态下, 每次回收到的连接对象会被关闭并重新创建,
-  在将全部的连接对象都更新完毕后会退出"更新"状态, 并重置时间
+  由后台维护线程检查池中的空闲连接, 获取与放回连接时不再访问数据库:
+  上一次检查超过time_interval秒的连接执行SELECT 1, 失败时关闭并重新创建
+  连接使用超过max_lifetime秒(带lifetime_jitter比例的随机提前量, 避免所有连接同时到期)后关闭并重新创建
+  连接数因重建失败低于下限时由维护线程补充
   '''
   #默认使用DictCursor
   def create_connection(self):
-    return ConnectionRenew(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=DictCursor,last_renew_time=time.time())
+    conn = ConnectionRenew(host=self.host,port=self.port,user=self.user,password=self.password,db=self.db,cursorclass=DictCursor,last_renew_time=time.time(),**self.session_args)
+    return self.stamp_lifetime(self.init_session(conn))
   
-  def __init__(self,max_connections:int,host:str,port:int,user:str,password:str,db:str,cursorclass=DictCursor,logging_path:str = './logging_dir/log.txt',time_interval:int = 100,max_workers:int = 8):
-    super().__init__(max_connections,host,port,user,password,db,cursorclass,logging_path)
+  def __init__(self,max_connections:int,host:str,port:int,user:str,password:str,db:str,cursorclass=DictCursor,logging_path:str = './logging_dir/log.txt',time_interval:int = 100,max_workers:int = 8,max_lifetime:float|None = 3600,lifetime_jitter:float = 0.1,**pool_options):
+    '''
+    max_lifetime: 为None或0时不按寿命轮换连接
+    pool_options: 弹性模式、启动预热等参数, 见DBpool
+    '''
+    # 预热与维护线程在父类构造函数中启动, 需要先设置检查参数
     self.time_interval = time_interval #单位为秒
     self.max_workers = max_workers
+    self.max_lifetime = max_lifetime
+    self.lifetime_jitter = lifetime_jitter
+    super().__init__(max_connections,host,port,user,password,db,cursorclass,logging_path,**pool_options)
     # self.ThreadPool = ThreadPoolExecutor(max_workers=self.max_workers)
-  
-  '''
-  在每次获取和放回连接时, 检查该连接的上一次检查时间, 若超过时间间隔, 则创建新的连接, 并关闭旧连接
-  '''
-  
-  def put_connection(self,conn:ConnectionRenew):
-    last_time = conn.last_renew_time
-    conn.last_renew_time = time.time()
-    if time.time() > last_time + self.time_interval:
-      try:
-        with conn.cursor() as cursor:
-          cursor.execute("SELECT 1")
-      except Exception as e:
-        simple_log.log(traceback.format_exc()+"\n-> "+str(e)+"\n-> Fixing connection error...",log_path=self.logging_path)
-        if conn:
-          conn.close()
-        try:
-          conn = self.create_connection()
-          self.pool.put(conn)
-        except Exception as err:
-          simple_log.log(traceback.format_exc()+"\n-> "+str(err)+"\n-> Failed to create new connection while checking heartbeat",log_path=self.logging_path)
-          raise err
-      else:
-        self.pool.put(conn)
-    else:
-      self.pool.put(conn)
-    
-  def get_connection(self):
-    conn:ConnectionRenew = self.pool.get(block=True)
-    last_time = conn.last_renew_time
-    conn.last_renew_time = time.time()
-    if time.time() > last_time + self.time_interval:
-      #进行心跳检查
-      try:
-        with conn.cursor() as cursor:
-          cursor.execute("SELECT 1")
-      except Exception as e:
-        simple_log.log(traceback.format_exc()+"\n-> "+str(e)+"\n-> Fixing connection error...",log_path=self.logging_path)
-        if conn:
-          conn.close()
-        try:
-          conn = self.create_connection()
-        except Exception as err:
-          simple_log.log(traceback.format_exc()+"\n-> "+str(err)+"\n-> Failed to create new connection while checking heartbeat",log_path=self.logging_path)
-          raise err
-        else:
-          return conn
-      else:
-        return conn
-    else:
-      return conn
-  
-  def timed_get_connection(self, timeout: int = 10):
-    conn:ConnectionRenew = self.pool.get(block=True,timeout=timeout)
-    last_time = conn.last_renew_time
+
+  def stamp_lifetime(self,conn):
+    conn.expires_at = time.time()+self.max_lifetime*(1-self.lifetime_jitter*random.random()) if self.max_lifetime else None
+    return conn
+
+  def needs_maintenance(self)->bool:
+    return True
+
+  def maintenance_interval(self)->float:
+    return min(super().maintenance_interval(),max(1.0,self.time_interval/2))
+
+  def maintain(self):
+    self.check_connections()
+    super().maintain()
+
+  def check_connections(self)->int:
+    '''
+    逐个取出需要检查或到期的空闲连接处理后放回, 其余连接在此期间照常借出; 返回关闭的连接数
+    '''
+    now = time.time()
+    with self.pool.mutex:
+      candidates = [conn for conn in self.pool.queue if self.connection_expired(conn,now) or now-conn.last_renew_time > self.time_interval]
+    replaced = 0
+    for conn in candidates:
+      with self.pool.mutex:
+        # 检查期间可能已被借出
+        if conn not in self.pool.queue:
+          continue
+        self.pool.queue.remove(conn)
+      if not self.connection_expired(conn,now) and self.validate(conn):
+        self.release_to_pool(conn)
+        continue
+      replaced += 1
+      self.replace_connection(conn)
+    return replaced
+
+  def connection_expired(self,conn,now:float)->bool:
+    expires_at = getattr(conn,'expires_at',None)
+    return expires_at is not None and now >= expires_at
+
+  def validate(self,conn)->bool:
+    try:
+      with conn.cursor() as cursor:
+        cursor.execute("SELECT 1")
+    except Exception as e:
+      simple_log.log(traceback.format_exc()+"\n-> "+str(e)+"\n-> Fixing connection error...",log_path=self.logging_path)
+      self.metrics.incr('dbpool_validation_errors')
+      return False
     conn.last_renew_time = time.time()
-    if time.time() > last_time + self.time_interval:
-      #进行心跳检查
-      try:
-        with conn.cursor() as cursor:
-          cursor.execute("SELECT 1")
-      except Exception as e:
-        simple_log.log(traceback.format_exc()+"\n-> "+str(e)+"\n-> Fixing connection error...",log_path=self.logging_path)
-        if conn:
-          conn.close()
-        try:
-          conn = self.create_connection()
-        except Exception as err:
-          simple_log.log(traceback.format_exc()+"\n-> "+str(err)+"\n-> Failed to create new connection while checking heartbeat",log_path=self.logging_path)
-          raise err
-        else:
-          return conn
-      else:
-        return conn
-    else:
-      return conn
-  
+    return True
+
+  def replace_connection(self,conn):
+    '''
+    关闭失效或到期的连接并创建新连接放回连接池, 创建失败时连接数减一, 由replenish补充
+    '''
+    try:
+      conn.close()
+    except Exception:
+      pass
+    try:
+      new_conn = self.create_connection()
+    except Exception as err:
+      simple_log.log(traceback.format_exc()+"\n-> "+str(err)+"\n-> Failed to create new connection while checking heartbeat",log_path=self.logging_path)
+      self.discard_connection(None)
+      return
+    self.metrics.incr('dbpool_connections_replaced')
+    self.release_to_pool(new_conn)
+
   def close(self):
     # self.ThreadPool.shutdown(wait=True)
     super().close()
@@ -293,8 +694,9 @@ class DBpoolRenew(DBpool):
   #   return result
   
 
-def get_DBpool(max_connections,host,port,user,password,db,cursorclass,logging_path,time_interval):
-  return DBpool(max_connections=max_connections,host=host,port=port,user=user,password=password,db=db,cursorclass=cursorclass,logging_path=logging_path)
+# pool_options为连接池的其他关键字参数, 例如弹性模式的min_size/grow_after/idle_timeout
+def get_DBpool(max_connections,host,port,user,password,db,cursorclass,logging_path,time_interval,**pool_options):
+  return DBpool(max_connections=max_connections,host=host,port=port,user=user,password=password,db=db,cursorclass=cursorclass,logging_path=logging_path,**pool_options)
 
-def get_DBpoolRenew(max_connections,host,port,user,password,db,cursorclass,logging_path,time_interval):
-  return DBpoolRenew(max_connections=max_connections,host=host,port=port,user=user,password=password,db=db,cursorclass=cursorclass,logging_path=logging_path,time_interval=time_interval)
\ No newline at end of file
+def get_DBpoolRenew(max_connections,host,port,user,password,db,cursorclass,logging_path,time_interval,**pool_options):
+  return DBpoolRenew(max_connections=max_connections,host=host,port=port,user=user,password=password,db=db,cursorclass=cursorclass,logging_path=logging_path,time_interval=time_interval,**pool_options)
\ No newline at end of file
@@ -0,0 +1,106 @@
+from typing import Callable
+import math
+import threading
+import metrics
+
+# 未配置admission_costs的资源, 每个任务占用1个单位(相当于并发名额)
+DEFAULT_RESOURCE_COST = {'base':1}
+
+class AdmissionController:
+  '''
+  按资源预算控制任务的领取与启动: 每个任务按行中的字段估算对各项资源的占用, 只有剩余预算足够时才启动
+  budgets: 资源名 -> 总预算, 例如{'vram':24, 'inference_slots':4}
+  costs: 资源名 -> 估算规则{'base':固定占用, 'per_megapixel':每百万像素(width*height)的占用, 'min':单个任务的最小占用(可选, 只用于估算领取数量)},
+  未配置的资源每个任务占用1
+  cost_fn: 自定义的估算函数row -> {资源名: 占用}, 不为None时代替costs; 也可以在子类中重写cost
+  单个任务的占用超过总预算时按总预算计算, 保证它在其他任务都结束后可以单独运行
+  '''
+  def __init__(self,budgets:dict[str,float],costs:dict[str,dict]|None=None,cost_fn:Callable[[dict],dict[str,float]]|None=None,metrics_obj:metrics.Metrics|None=None):
+    if not budgets:
+      raise ValueError('AdmissionController requires at least one resource budget')
+    for name,budget in budgets.items():
+      if budget <= 0:
+        raise ValueError(f'Invalid budget for resource {name!r}: {budget}')
+    self.budgets = dict(budgets)
+    self.costs = {name:dict((costs or {}).get(name,DEFAULT_RESOURCE_COST)) for name in self.budgets}
+    self.cost_fn = cost_fn
+    self.metrics = metrics_obj if metrics_obj is not None else metrics.Metrics()
+    self.lock = threading.Lock()
+    self.used = {name:0.0 for name in self.budgets}
+    # 已启动任务的占用, 登记键 -> {资源名: 占用}; main_thread按id(row)登记, 同一任务的多次提交互不覆盖
+    self.holders:dict[int,dict[str,float]] = {}
+    # 各资源已估算过的最小非零占用, 没有配置最小占用时用于估算领取数量
+    self.min_seen:dict[str,float|None] = {name:None for name in self.budgets}
+
+  def cost(self,row:dict)->dict[str,float]:
+    if self.cost_fn is not None:
+      cost = self.cost_fn(row)
+    else:
+      pixels = (row.get('width') or 0)*(row.get('height') or 0)
+      cost = {name:rule.get('base',0)+rule.get('per_megapixel',0)*pixels/1e6 for name,rule in self.costs.items()}
+    cost = {name:min(max(0.0,float(cost.get(name,0))),budget) for name,budget in self.budgets.items()}
+    with self.lock:
+      for name,value in cost.items():
+        if value > 0 and (self.min_seen[name] is None or value < self.min_seen[name]):
+          self.min_seen[name] = value
+    return cost
+
+  def fits(self,cost:dict[str,float])->bool:
+    with self.lock:
+      return all(self.used[name]+cost[name] <= self.budgets[name]+1e-9 for name in self.budgets)
+
+  def acquire(self,key:int,cost:dict[str,float])->bool:
+    '''
+    剩余预算足够时占用资源并返回True, 否则不占用并返回False
+    '''
+    with self.lock:
+      if not all(self.used[name]+cost[name] <= self.budgets[name]+1e-9 for name in self.budgets):
+        self.metrics.incr('admission_rejected')
+        return False
+      for name in self.budgets:
+        self.used[name] += cost[name]
+      self.holders[key] = cost
+      self.update_gauges()
+    return True
+
+  def release(self,key:int):
+    with self.lock:
+      cost = self.holders.pop(key,None)
+      if cost is None:
+        return
+      for name in self.budgets:
+        self.used[name] = max(0.0,self.used[name]-cost[name])
+      self.update_gauges()
+
+  def min_cost(self,name:str)->float:
+    '''
+    估算资源name的最小单任务占用: 配置的base或min中较大者; 都为0时(例如只按分辨率估算)用已估算过的最小占用, 还没有时返回0
+    '''
+    rule = self.costs[name] if self.cost_fn is None else {}
+    floor = max(rule.get('base',0),rule.get('min',0))
+    if floor > 0:
+      return floor
+    return self.min_seen[name] or 0
+
+  def claim_limit(self)->int|None:
+    '''
+    按各资源的最小单任务占用(min_cost)估算剩余预算还能启动多少个任务, 作为领取数量的上限
+    最小占用未知时每次只领取1个, 由它的占用得到估计; 所有资源都不会被占用(规则全为0)时返回None(不限制)
+    '''
+    limit = None
+    with self.lock:
+      for name,budget in self.budgets.items():
+        if self.cost_fn is None and not any(value > 0 for value in self.costs[name].values()):
+          continue
+        remaining = budget-self.used[name]
+        unit = self.min_cost(name)
+        if unit > 0:
+          n = math.floor(remaining/min(unit,budget)+1e-9)
+        else:
+          n = 1 if remaining > 1e-9 else 0
+        limit = n if limit is None else min(limit,n)
+    return None if limit is None else max(0,limit)
+
+  def update_gauges(self):
+    for name in self.budgets:
+      self.metrics.set_gauge(f'admission_used_{name}',self.used[name])
@@ -0,0 +1,183 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Awaitable
+import asyncio
+import threading
+import DBpool
+import simple_log
+from main_thread import main_thread, main_thread_TimedRenew
+
+class main_thread_async(main_thread_TimedRenew):
+  '''
+  基于asyncio的调度器, 配置文件、任务状态流转与main_thread_TimedRenew相同
+  func为async def函数: async def func(args, dbpool) -> tuple[int,None|str] (pass_context时第二个参数为TaskContext)
+  每个在途任务是事件循环中的一个协程而不是一个线程, 适合大量等待远程推理的I/O密集型任务
+  领取、初始化、回调等阻塞的数据库操作交给db_workers个线程的执行器, 不会阻塞事件循环
+  开启enforce_deadlines时用asyncio.wait_for限制每个协程的执行时间, 超时的协程被取消并按失败结果写回, 不需要看门狗线程
+  所有协程运行在同一个线程中, worker_init只在事件循环启动时执行一次, 退出时执行worker_teardown
+  '''
+  def __init__(self,func:Callable[...,Awaitable],path_config:str,dbpool_get:Callable=DBpool.get_DBpoolRenew,db_workers:int=4,worker_init:Callable|None=None,worker_teardown:Callable|None=None):
+    super().__init__(func=func,path_config=path_config,dbpool_get=dbpool_get,worker_init=worker_init,worker_teardown=worker_teardown)
+    self.db_workers = db_workers
+    self.db_executor:ThreadPoolExecutor|None = None
+    self.loop:asyncio.AbstractEventLoop|None = None
+    self.slot_event:asyncio.Event|None = None
+
+  async def run_db(self,fn:Callable,*args):
+    '''
+    在数据库执行器中运行阻塞函数
+    '''
+    return await self.loop.run_in_executor(self.db_executor,fn,*args)
+
+  async def run_task(self,args:dict,deadline):
+    '''
+    执行一个任务协程; 超过截止时间时取消协程并返回超时的失败结果, 由回调按重试或最终失败处理
+    '''
+    coro = self.func(args,self.func_arg(args,deadline))
+    if deadline is None:
+      return await coro
+    deadline.start()
+    try:
+      return await asyncio.wait_for(coro,timeout=deadline.seconds)
+    except asyncio.TimeoutError:
+      deadline.cancel()
+      self.metrics.incr('tasks_timed_out')
+      simple_log.log(f'Task {args["id"]} exceeded its deadline of {deadline.seconds}s, cancelled', log_path=self.logging_path)
+      return (args['id'],f'task timed out after {deadline.seconds}s')
+
+  def task_done(self,args:dict,task:asyncio.Task,row:dict):
+    '''
+    协程结束后写回结果; 有CompletionWriter时只是入队, 否则回调会直接写库, 交给数据库执行器
+    '''
+    callback_obj = main_thread.callback(args,self.dbpool,self.logging_path,self.max_retry_times,self.generate_retry_times,self.claim_worker_id(),self.writer,self.task_sql)
+    if self.writer is not None:
+      callback_obj(task)
+      self.release_task(row)
+    else:
+      write = self.loop.run_in_executor(self.db_executor,callback_obj,task)
+      write.add_done_callback(lambda _:self.release_task(row))
+
+  def release_task(self,row:dict):
+    with self.slot_cond:
+      self.in_flight.pop(row['id'],None)
+      self.in_flight_user.pop(row['id'],None)
+    if self.admission is not None:
+      self.admission.release(id(row))
+    self.slot_event.set()
+
+  def wake(self):
+    super().wake()
+    if self.loop is not None and self.slot_event is not None:
+      try:
+        self.loop.call_soon_threadsafe(self.slot_event.set)
+      except RuntimeError:
+        # 事件循环已经关闭
+        pass
+
+  async def drain_tasks(self,tasks:set):
+    '''
+    退出前最多等待drain_timeout秒, 仍未结束的协程被取消; 它们和就绪队列中尚未启动的任务一起批量放回队列
+    '''
+    released = []
+    while not self.queue.empty():
+      released.append(self.queue.get()['id'])
+    pending = set()
+    if tasks:
+      _,pending = await asyncio.wait(tasks,timeout=max(0,self.drain_timeout))
+    if pending:
+      with self.slot_cond:
+        released += [task_id for task_id,task in self.in_flight.items() if task in pending]
+      for task in pending:
+        task.cancel()
+      await asyncio.gather(*pending,return_exceptions=True)
+      simple_log.log(f'Cancelled {len(pending)} tasks still running after the drain deadline', log_path=self.logging_path)
+    if not released:
+      return
+    try:
+      await self.run_db(self.release_tasks,released)
+    except Exception as e:
+      simple_log.log(f'Error in drain_tasks while releasing {len(released)} tasks: {str(e)}', log_path=self.logging_path)
+
+  async def wait_slot(self,timeout:float):
+    '''
+    等待任务完成(释放名额)或超时; slot_event在每轮开始时清除, 本轮中途释放的名额不会被漏掉
+    '''
+    try:
+      await asyncio.wait_for(self.slot_event.wait(),timeout=timeout)
+    except asyncio.TimeoutError:
+      pass
+
+  async def run_async(self,slice_size:int=10,max_concurrency:int=1000):
+    '''
+    与main_thread.run流程相同: 按空闲名额领取任务, 每个任务创建一个协程, 没有任务时按AdaptivePoll等待, stop()后排空在途任务再退出
+    max_concurrency: 同时执行的协程数(配置了max_in_flight时以max_in_flight为准)
+    '''
+    self.loop = asyncio.get_running_loop()
+    self.slot_event = asyncio.Event()
+    self.db_executor = ThreadPoolExecutor(max_workers=self.db_workers,thread_name_prefix='async_db')
+    budget = self.max_in_flight if self.max_in_flight is not None else max_concurrency
+    tasks = set()
+    try:
+      self.start_lease_thread()
+      self.start_writer()
+      self.start_reporter()
+      self.start_metrics_logger()
+      if self.worker_init is not None:
+        self.init_worker_thread()
+      try:
+        while self.status:
+          self.slot_event.clear()
+          await self.run_db(self.init_process)
+          try:
+            await self.run_db(self.scheduler.maintain,self.dbpool)
+          except Exception as e:
+            simple_log.log(f'Error in scheduler maintenance: {str(e)}', log_path=self.logging_path)
+          free_slots = budget-len(self.in_flight)
+          if free_slots <= 0:
+            await self.wait_slot(1.0)
+            continue
+          want = self.claim_size(min(slice_size,free_slots)-self.queue.qsize())
+          idlist = await self.run_db(self.fetch_status0,want) if want > 0 else []
+          while True:
+            row = self.next_admitted_row()
+            if row is None:
+              break
+            args = self.build_args(row)
+            task = asyncio.create_task(self.run_task(args,self.task_deadline(row)))
+            with self.slot_cond:
+              self.in_flight[args['id']] = task
+              if 'user_id' in row:
+                self.in_flight_user[args['id']] = row['user_id']
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda t,args=args,row=row:self.task_done(args,t,row))
+          interval = self.poller.found() if idlist else self.poller.idle()
+          self.metrics.set_gauge('poll_interval_seconds',interval)
+          if interval > 0:
+            await self.wait_slot(interval)
+      finally:
+        # 循环因异常退出时也要放回已领取的任务, 否则它们停留在state=1直到租约过期
+        await self.drain_tasks(tasks)
+    finally:
+      # 等待回调中尚未完成的写库操作, 再依次关闭进度写入、结果写入、租约线程和连接池
+      self.db_executor.shutdown(wait=True)
+      self.teardown_workers()
+      self.stop_reporter()
+      self.stop_writer()
+      self.stop_lease_thread()
+      self.stop_metrics_logger()
+      self.close()
+
+  def run(self,slice_size:int=10,max_workers:int=1000):
+    '''
+    max_workers在异步模式下表示同时执行的协程数
+    '''
+    self.running = True
+    self.run_thread = threading.current_thread()
+    self.stopped.clear()
+    previous_handlers = self.install_signal_handlers()
+    try:
+      asyncio.run(self.run_async(slice_size,max_workers))
+    finally:
+      self.restore_signal_handlers(previous_handlers)
+      self.running = False
+      self.stopped.set()
@@ -0,0 +1,87 @@
+from concurrent.futures import Future
+import time
+
+# 未配置batch_key时按分辨率分组
+DEFAULT_BATCH_KEY = ('width','height')
+
+class BatchItem:
+  '''
+  批量模式下的一个任务: future为该任务自己的Future, 写库回调与名额释放回调都注册在它上面
+  '''
+  def __init__(self,row:dict,args:dict,deadline=None):
+    self.row = row
+    self.args = args
+    self.deadline = deadline
+    self.future = Future()
+
+class TaskBatcher:
+  '''
+  把已领取的任务按key_fields分组, 每组攒够max_size条, 或组内最早的任务等待超过max_wait秒后作为一批取出
+  只在run()所在的线程中使用, 不需要加锁
+  '''
+  def __init__(self,key_fields:tuple|list|None=None,max_size:int=8,max_wait:float=0.5):
+    self.key_fields = tuple(key_fields) if key_fields else DEFAULT_BATCH_KEY
+    self.max_size = max(1,max_size)
+    self.max_wait = max(0.0,max_wait)
+    # key -> (第一条任务加入的时间, [BatchItem])
+    self.groups:dict[tuple,tuple[float,list[BatchItem]]] = {}
+
+  def key(self,row:dict)->tuple:
+    return tuple(row.get(field) for field in self.key_fields)
+
+  def add(self,item:BatchItem):
+    key = self.key(item.row)
+    if key not in self.groups:
+      self.groups[key] = (time.monotonic(),[])
+    self.groups[key][1].append(item)
+
+  def ready(self,force:bool=False)->list[list[BatchItem]]:
+    '''
+    取出已满或等待超时的批次; force为True时取出全部批次
+    '''
+    now = time.monotonic()
+    batches = []
+    for key,(since,items) in list(self.groups.items()):
+      while len(items) >= self.max_size:
+        batches.append(items[:self.max_size])
+        del items[:self.max_size]
+        since = now
+      if items and (force or now-since >= self.max_wait):
+        batches.append(list(items))
+        items.clear()
+      if items:
+        self.groups[key] = (since,items)
+      else:
+        del self.groups[key]
+    return batches
+
+  def time_to_next(self)->float|None:
+    '''
+    距离最早一个未满批次超时的秒数, 没有待分组的任务时为None
+    '''
+    if not self.groups:
+      return None
+    oldest = min(since for since,_ in self.groups.values())
+    return max(0.0,oldest+self.max_wait-time.monotonic())
+
+  def __len__(self)->int:
+    return sum(len(items) for _,items in self.groups.values())
+
+def fan_out(items:list[BatchItem],results:list|None,error:BaseException|None=None):
+  '''
+  把func_batch的返回值按任务id分发到各任务的Future; func_batch抛出异常或漏掉某个任务时, 该任务按失败结果处理(由回调决定重试或最终失败)
+  '''
+  by_id = {}
+  if error is None:
+    for result in results or []:
+      by_id[result[0]] = result
+  for item in items:
+    task_id = item.args['id']
+    if item.future.done():
+      continue
+    if error is not None:
+      item.future.set_result((task_id,f'batch call failed: {error}'))
+    elif task_id in by_id:
+      item.future.set_result(by_id[task_id])
+    else:
+      item.future.set_result((task_id,'missing from batch results'))
@@ -0,0 +1,165 @@
+from concurrent.futures import Future
+from queue import Queue, Empty
+import threading
+import time
+import traceback
+import pymysql
+import simple_log
+import metrics
+from db_retry import is_connection_error
+from task_sql import TaskSQL
+
+class CompletionWriter:
+  '''
+  任务完成结果的批量写入器
+  回调线程只把结果放入内存队列并立即返回, 由单独的写入线程在攒够batch_size条或等待超过flush_interval秒后,
+  用一个连接、一次提交写回一批结果; 成功的任务合并为一条多行UPDATE
+  连接断开时整批结果在新连接上重新写入(断开时已执行的语句随事务回滚, 不能只重试当前语句);
+  数据错误(例如描述过长)时逐条写入, 只有出错的结果失败
+  submit_success/submit_failure返回Future, 结果真正提交到数据库后完成(写入失败时为异常), 需要确认落库的调用方可以等待它
+  '''
+  def __init__(self,dbpool,logging_path:str,max_retry_times:int=5,generate_retry_times:int=3,batch_size:int=64,flush_interval:float=0.2,worker_id:str|None=None,metrics_obj:metrics.Metrics|None=None,task_sql:TaskSQL|None=None):
+    '''
+    worker_id: 不为None时, 只更新仍由该实例持有的任务(state=1且worker_id相同)
+    '''
+    self.dbpool = dbpool
+    self.logging_path = logging_path
+    self.max_retry_times = max_retry_times
+    self.generate_retry_times = generate_retry_times
+    self.batch_size = max(1,batch_size)
+    self.flush_interval = flush_interval
+    self.worker_id = worker_id
+    self.metrics = metrics_obj if metrics_obj is not None else metrics.Metrics()
+    self.task_sql = task_sql if task_sql is not None else TaskSQL()
+    # 元素为(task_id, msg, artifact_path, future), msg为None表示成功
+    self.queue = Queue()
+    self.closed = False
+    self.thread:threading.Thread|None = None
+
+  def start(self):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self.writer_loop,name='completion_writer',daemon=True)
+      self.thread.start()
+
+  def submit_success(self,task_id:int,artifact_path:str|None=None)->Future:
+    return self.submit(task_id,None,artifact_path)
+
+  def submit_failure(self,task_id:int,msg:str)->Future:
+    return self.submit(task_id,msg)
+
+  def submit(self,task_id:int,msg:str|None,artifact_path:str|None=None)->Future:
+    future = Future()
+    if self.closed:
+      future.set_exception(RuntimeError('CompletionWriter is closed'))
+      return future
+    self.queue.put((task_id,msg,artifact_path,future))
+    return future
+
+  def close(self,timeout:float|None=None):
+    '''
+    停止接收新结果, 写完队列中剩余的结果后退出写入线程
+    '''
+    self.closed = True
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join(timeout=timeout)
+      self.thread = None
+
+  def writer_loop(self):
+    stopping = False
+    while not stopping:
+      item = self.queue.get()
+      if item is None:
+        stopping = True
+        batch = []
+      else:
+        batch = [item]
+      deadline = time.time()+self.flush_interval
+      while len(batch) < self.batch_size:
+        remaining = deadline-time.time()
+        try:
+          # 收到停止标记后不再等待, 只取走队列中已有的结果
+          item = self.queue.get(timeout=remaining) if (remaining > 0 and not stopping) else self.queue.get_nowait()
+        except Empty:
+          break
+        if item is None:
+          stopping = True
+          continue
+        batch.append(item)
+      if batch:
+        self.flush(batch)
+
+  def flush(self,batch:list[tuple[int,str|None,str|None,Future]]):
+    successes = [item for item in batch if item[1] is None]
+    failures = [item for item in batch if item[1] is not None]
+    start = time.time()
+    try:
+      self.write_batch(batch)
+    except (pymysql.err.DataError, pymysql.err.IntegrityError) as e:
+      if len(batch) == 1:
+        self.fail_batch(batch,e)
+        return
+      simple_log.log(f'Data error in CompletionWriter.flush for {len(batch)} results, writing them one by one: {str(e)}',log_path=self.logging_path)
+      self.metrics.incr('completion_row_fallbacks')
+      for item in batch:
+        self.flush([item])
+      return
+    except Exception as e:
+      self.fail_batch(batch,e)
+      return
+    for *_,future in batch:
+      future.set_result(True)
+    self.metrics.incr('completion_flushes')
+    self.metrics.incr('completion_rows',len(batch))
+    self.metrics.observe('completion_flush_seconds',time.time()-start)
+    simple_log.log(f'CompletionWriter flushed {len(successes)} successes and {len(failures)} failures',log_path=self.logging_path)
+
+  def fail_batch(self,batch:list[tuple[int,str|None,str|None,Future]],e:Exception):
+    simple_log.log(traceback.format_exc()+f'\n-> Error in CompletionWriter.flush for {len(batch)} results',log_path=self.logging_path)
+    for *_,future in batch:
+      future.set_exception(e)
+    self.metrics.incr('completion_flush_errors')
+
+  def write_batch(self,batch:list[tuple[int,str|None,str|None,Future]]):
+    '''
+    在一个事务中写回整批结果; 连接断开时关闭该连接, 在新连接上重新写入整批, 最多max_retry_times次
+    '''
+    successes = [(item[0],item[2]) for item in batch if item[1] is None]
+    failures = [(item[0],item[1]) for item in batch if item[1] is not None]
+    for attempt in range(max(1,self.max_retry_times)):
+      conn = self.dbpool.get_connection()
+      broken = False
+      try:
+        with conn.cursor() as cursor:
+          if successes:
+            self.write_successes(cursor,successes)
+          if failures:
+            self.write_failures(cursor,failures)
+        conn.commit()
+        return
+      except Exception as e:
+        broken = is_connection_error(e)
+        if not broken:
+          try:
+            conn.rollback()
+          except Exception:
+            pass
+          raise
+        if attempt+1 >= max(1,self.max_retry_times):
+          raise
+        simple_log.log(traceback.format_exc()+f'\n-> Connection lost in CompletionWriter.flush, rewriting {len(batch)} results on a new connection',log_path=self.logging_path)
+        self.metrics.incr('completion_flush_retries')
+      finally:
+        if broken:
+          self.dbpool.discard_connection(conn)
+        else:
+          self.dbpool.put_connection(conn)
+
+  # 直接执行而不用retry_execute: 它在断开的连接上重连后只重试当前语句, 同一事务中之前的语句已经丢失
+  def write_successes(self,cursor,successes:list[tuple[int,str|None]]):
+    sql = self.task_sql.success_update(len(successes),self.worker_id is not None)
+    cursor.execute(sql,self.task_sql.success_args(successes,self.worker_id))
+
+  def write_failures(self,cursor,failures:list[tuple[int,str]]):
+    sql,args = self.task_sql.failure_update(failures,self.generate_retry_times,self.worker_id)
+    cursor.execute(sql,args)
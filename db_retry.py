@@ -0,0 +1,63 @@
+import pymysql
+from pymysql.cursors import DictCursor
+import simple_log
+import time
+
+# 在使用游标进行操作时, 添加重试机制, 自定义重试次数(3~5次)
+# 弹出特定异常, 即触发重试, 其他异常不触发重试
+
+# 连接断开类的错误码: 重连后可以重试, 但连接上未提交的事务已经回滚
+CONNECTION_ERROR_CODES = (0, 2003, 2006, 2013)
+
+def is_connection_error(e:Exception)->bool:
+  return isinstance(e,(pymysql.err.OperationalError, pymysql.err.InterfaceError)) and bool(e.args) and e.args[0] in CONNECTION_ERROR_CODES
+
+def restore_session(conn:pymysql.Connection):
+  '''
+  重连后恢复会话: pymysql只重新执行了init_command, 这里重新执行DBpool.init_session记录的init_statements(隔离级别);
+  set_session设置过的值已随旧连接丢失, 清空conn.session_state, 之后的set_session会重新执行SET
+  '''
+  for statement in getattr(conn,'init_statements',()):
+    with conn.cursor() as cursor:
+      cursor.execute(statement)
+  if hasattr(conn,'session_state'):
+    conn.session_state = {}
+
+def retry(conn:pymysql.Connection,max_retry_times:int=5,logging_path:str='./log.txt'):
+  status = False
+  for i in range(max_retry_times):
+    try:
+      # 服务端线程id变化说明ping重建了连接
+      thread_id = getattr(conn,'server_thread_id',None)
+      conn.ping(reconnect=True)
+      if getattr(conn,'server_thread_id',None) != thread_id:
+        restore_session(conn)
+    except Exception as e:
+      print(f'Ping exception {e}! Retry failed, retrying times: {i}\nIn db_retry.retry')
+      simple_log.log(f'Ping exception {e}! Retry failed, retrying times: {i}\nIn db_retry.retry',log_path=logging_path)
+      time.sleep(1)
+      continue
+    else:
+        status = True
+        break
+  return status
+
+def retry_execute(cursor:DictCursor,logging_path:str,sql:str,args:tuple=None,max_retry_times:int=5):
+  status = False
+  for i in range(max_retry_times):
+    try:
+      cursor.execute(sql,args)
+    except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+      if e.args[0] in CONNECTION_ERROR_CODES:
+        retry(cursor.connection,max_retry_times,logging_path)
+        continue
+      else:
+        raise e
+    except Exception as e:
+        print(f'Execute exception {e}! Retry failed, retrying times: {i}\nIn db_retry.retry_execute')
+        simple_log.log(f'Execute exception {e}! Retry failed, retrying times: {i}\nIn db_retry.retry_execute',log_path=logging_path)
+        raise e
+    else:
+        status = True
+        break
+  return status
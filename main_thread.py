@@ -1,4 +1,4 @@
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor, Future, CancelledError, wait
 from typing import Callable
 import pymysql
 from pymysql.cursors import DictCursor
@@ -6,50 +6,98 @@ from DBpool import DBpool, DBpoolRenew
 import DBpool
 from queue import Queue
 import simple_log
+import threading
 import time
+import os
+import json
+import random
+import signal
+import socket
+import uuid
 import read_config
+import metrics
 
-# 在使用游标进行操作时, 添加重试机制, 自定义重试次数(3~5次)
-# 弹出特定异常, 即触发重试, 其他异常不触发重试
+# retry/retry_execute 已移至db_retry, 这里重新导出以兼容原有的 main_thread.retry_execute 引用
+from db_retry import retry, retry_execute
+from completion_writer import CompletionWriter
+from task_sql import TaskSQL, PROJECTED_FIELDS
+from scheduling import SCHEDULE_MODES, FifoScheduler, FairShareScheduler, PriorityLaneScheduler
+import process_worker
+from progress_reporter import ProgressReporter
+from task_context import TaskContext, TaskDeadline
+from admission import AdmissionController
+from batching import TaskBatcher, BatchItem, fan_out
+from result_cache import ResultCache, cache_key
 
-def retry(conn:pymysql.Connection,max_retry_times:int=5,logging_path:str='./log.txt'):
-  status = False
-  for i in range(max_retry_times):
-    try:
-      conn.ping(reconnect=True)
-    except Exception as e:
-      print(f'Ping exception {e}! Retry failed, retrying times: {i}\nIn main_thread.retry')
-      simple_log.log(f'Ping exception {e}! Retry failed, retrying times: {i}\nIn main_thread.retry',log_path=logging_path)
-      time.sleep(1)
-      continue
-    else:
-        status = True
-        break
-  return status
+# 任务领取模式
+# legacy: 原有的SELECT+UPDATE, 只适合单实例运行
+# skip_locked: 在一个短事务中使用FOR UPDATE SKIP LOCKED领取任务, 并写入worker_id与heartbeat_at, 支持多实例同时运行
+CLAIM_MODES = ('legacy','skip_locked')
 
-def retry_execute(cursor:DictCursor,logging_path:str,sql:str,args:tuple=None,max_retry_times:int=5):
-  status = False
-  for i in range(max_retry_times):
-    try:
-      cursor.execute(sql,args)
-    except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
-      if e.args[0] in (0, 2003, 2006, 2013):
-        retry(cursor.connection,max_retry_times,logging_path)
-        continue
-      else:
-        raise e
-    except Exception as e:
-        print(f'Execute exception {e}! Retry failed, retrying times: {i}\nIn main_thread.retry_execute')
-        simple_log.log(f'Execute exception {e}! Retry failed, retrying times: {i}\nIn main_thread.retry_execute',log_path=logging_path)
-        raise e
+# 任务函数的执行方式
+# thread: 在线程池中执行, func的第二个参数为调度器的连接池
+# process: 在进程池中执行, 适合受GIL限制的CPU密集型任务; func必须是模块级函数, 第二个参数为子进程自己的连接池(见process_worker)
+EXECUTOR_MODES = ('thread','process')
+
+# 领取任务的事务需要READ COMMITTED才能看到其他事务已提交的数据, 作为连接池会话配置的默认隔离级别
+CLAIM_ISOLATION_LEVEL = 'READ COMMITTED'
+
+def default_worker_id()->str:
+  '''
+  生成当前调度实例的worker_id: 主机名-进程号-随机后缀
+  '''
+  return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+class AdaptivePoll:
+  '''
+  空闲轮询间隔: 没有领取到任务时按倍数指数退避(带随机抖动), 领取到任务后立即重置为0
+  min_interval: 第一次空闲时的等待时间(秒)
+  max_interval: 等待时间上限(秒)
+  '''
+  def __init__(self,min_interval:float=0.2,max_interval:float=5.0,multiplier:float=2.0,jitter:float=0.2):
+    self.min_interval = min_interval
+    self.max_interval = max(min_interval,max_interval)
+    self.multiplier = multiplier
+    self.jitter = jitter
+    self.current = 0.0
+
+  def found(self)->float:
+    self.current = 0.0
+    return self.current
+
+  def idle(self)->float:
+    if self.current <= 0:
+      base = self.min_interval
     else:
-        status = True
-        break
-  return status
+      base = min(self.current*self.multiplier,self.max_interval)
+    self.current = base
+    # 抖动避免多个调度实例在同一时刻查询数据库
+    return max(0.0,base*(1+random.uniform(-self.jitter,self.jitter)))
+
+class ReplaceableThreadPoolExecutor(ThreadPoolExecutor):
+  '''
+  可以临时补充工作线程的线程池: 超时任务的线程在func返回前一直被占用, add_worker为它补充一个线程, func返回后remove_worker收回
+  ThreadPoolExecutor没有调整线程数的接口, 这里在_shutdown_lock内修改_max_workers; 收回后多出的线程空闲等待,
+  不会再补充新线程, 同时执行的任务数仍由在途名额限制
+  '''
+  def __init__(self,max_workers:int,**kwargs):
+    super().__init__(max_workers=max_workers,**kwargs)
+    self.base_workers = max_workers
+
+  def add_worker(self):
+    with self._shutdown_lock:
+      self._max_workers += 1
+      if not self._shutdown:
+        # 已在队列中等待的任务不会再触发submit, 这里立即补充线程
+        self._adjust_thread_count()
+
+  def remove_worker(self):
+    with self._shutdown_lock:
+      self._max_workers = max(self.base_workers,self._max_workers-1)
 
 class main_thread:
   # 连接测试成功
-  def __init__(self,func:Callable,host:str='testapi.fuhu.tech',port:int=3306,user:str='ai_creator',password:str='ai_creator123456',db:str='vimaxai',max_connections:int=10, logging_path:str='./logging_dir', max_retry_times:int=5,generate_retry_times:int=3,heart_beat_interval:int=100,dbpool_get:Callable=DBpool.get_DBpool,time_overflow_seconds:int=1800):
+  def __init__(self,func:Callable,host:str='testapi.fuhu.tech',port:int=3306,user:str='ai_creator',password:str='ai_creator123456',db:str='vimaxai',max_connections:int=10, logging_path:str='./logging_dir', max_retry_times:int=5,generate_retry_times:int=3,heart_beat_interval:int=100,dbpool_get:Callable=DBpool.get_DBpool,time_overflow_seconds:int=1800,claim_mode:str='legacy',worker_id:str|None=None,max_in_flight:int|None=None,prefetch_margin:int=2,poll_min_interval:float=0.2,poll_max_interval:float=5.0,reap_interval:float=60,reap_batch_size:int=100,completion_batch_size:int=64,completion_flush_interval:float=0.2,table_name:str|None=None,fields:dict[str,str]|None=None,schedule_mode:str='fifo',max_per_user:int=0,priority_lanes:list[dict]|None=None,priority_aging_interval:float=300,priority_aging_step:int=1,executor_mode:str='thread',process_db_connections:int=1,pass_context:bool=False,progress_flush_interval:float=1.0,shutdown_timeout:float=30,handle_signals:bool=True,retry_backoff_base:float=0,retry_backoff_max:float=600,retry_backoff_jitter:float=0.2,enforce_deadlines:bool=False,per_task_deadlines:bool=False,deadline_check_interval:float=1.0,prefetch_high_watermark:int=0,prefetch_low_watermark:int|None=None,admission_budgets:dict[str,float]|None=None,admission_costs:dict[str,dict]|None=None,func_batch:Callable|None=None,batch_key:list[str]|None=None,batch_max_size:int=8,batch_max_wait:float=0.5,worker_init:Callable|None=None,worker_teardown:Callable|None=None,result_cache_dir:str|None=None,result_cache_max_bytes:int=10*1024**3,result_cache_max_entries:int=10000,pool_options:dict|None=None,record_artifacts:bool=False,metrics_log_interval:float=60,max_replacement_workers:int|None=None):
     '''
     func: 接收字典和线程池引用作为参数, 返回tuple[int,None|str]
     host: 数据库主机
@@ -58,7 +106,144 @@ class main_thread:
     password: 数据库密码
     db: 数据库名称
     max_connections: 数据库连接池最大连接数(近似认为是数据库访问的并行程度)
+    claim_mode: 任务领取模式, 见CLAIM_MODES; skip_locked模式需要表中有worker_id与heartbeat_at字段(见task_table_upgrade.sql)
+    worker_id: 当前调度实例的标识, 为None时自动生成; 多实例部署时每个实例必须不同
+    max_in_flight: 已提交但未完成的任务数上限, 为None时取run()的max_workers+prefetch_margin
+    prefetch_margin: 在空闲线程数之外额外领取的任务数, 保证线程执行完后能立即拿到下一个任务
+    poll_min_interval, poll_max_interval: 没有待处理任务时的轮询间隔范围(秒), 见AdaptivePoll
+    time_overflow_seconds: skip_locked模式下任务租约的有效期, heartbeat_at超过该时间未更新的state=1任务会被回收为state=0
+    reap_interval: 回收过期任务的检查间隔(秒)
+    reap_batch_size: 每条回收/续约语句处理的最大行数
+    completion_batch_size, completion_flush_interval: 任务结果批量写回的条数上限与最长等待时间(秒), 见CompletionWriter; completion_batch_size<=0时回调直接写库
+    table_name, fields: 任务表名与字段映射(逻辑字段名 -> 实际列名), 所有SQL由TaskSQL根据它们生成
+    schedule_mode: 任务调度模式, 见SCHEDULE_MODES; fair模式按user_id轮转领取(见FairShareScheduler)
+    max_per_user: fair模式下单个用户在本实例同时执行的任务数上限, 0表示不限制
+    priority_lanes, priority_aging_interval, priority_aging_step: priority模式的通道配置与老化参数, 见PriorityLaneScheduler
+    executor_mode: 任务函数的执行方式, 见EXECUTOR_MODES
+    process_db_connections: process模式下每个子进程连接池的连接数, 0表示不为子进程创建连接池(func收到None)
+    pass_context: 为True时func的第二个参数为TaskContext(含连接池与进度报告), 而不是连接池
+    progress_flush_interval: TaskContext.report_progress报告的进度合并写库的间隔(秒), 见ProgressReporter
+    shutdown_timeout: 停止时等待正在执行的任务完成的最长时间(秒), 见stop
+    handle_signals: 在主线程中运行run()时, 收到SIGTERM/SIGINT后优雅停止
+    retry_backoff_base, retry_backoff_max, retry_backoff_jitter: 失败重试的退避参数(秒), 第n次重试至少等待min(base*2^n, max)*(1±jitter)秒;
+    base<=0时失败的任务立即重新排队; 开启后表中需要next_run_at字段(见task_table_upgrade.sql)
+    enforce_deadlines: 为True时任务函数最多执行time_overflow_seconds秒, 超时的任务由看门狗线程按失败处理(重试或最终失败),
+    同时设置TaskContext.cancel_event通知func尽早返回, 之后到达的结果被忽略; 线程无法被强制结束, 超时任务在func返回前占用线程,
+    thread模式(非批量)下为每个这样的任务补充一个工作线程并释放它的在途名额, 最多补充max_replacement_workers个, 超出的部分仍占用在途名额
+    max_replacement_workers: 为超时未返回的任务补充的工作线程数上限, None表示与max_workers相同, 0表示不补充
+    per_task_deadlines: 为True时表中deadline_seconds字段不为空的任务使用各自的截止时间(见task_table_upgrade.sql)
+    deadline_check_interval: 看门狗检查超时任务的间隔(秒)
+    prefetch_high_watermark, prefetch_low_watermark: 大于0时由后台线程预取任务: 本地就绪队列中的任务数降到低水位(默认为高水位的一半)以下时,
+    领取下一批任务补足到高水位, 领取的数据库往返与任务执行重叠; 高水位限制了已领取但未开始执行的任务数, 0表示不预取
+    admission_budgets, admission_costs: 不为空时按资源预算控制领取与启动(见AdmissionController), 例如按width*height估算显存占用;
+    队首任务超出剩余预算时按顺序等待在途任务释放资源, 不会跳过大任务
+    func_batch: 不为None时开启批量模式, 代替func: func_batch(list_of_args, dbpool) -> [(id, None|str), ...], pass_context时第二个参数为TaskContext列表;
+    已领取的任务按batch_key中的字段(默认width与height)分组, 每组攒够batch_max_size条或最早的任务等待超过batch_max_wait秒后调用一次,
+    返回的结果按id分发给各任务的回调; 攒批中的任务占用在途名额, max_in_flight应不小于batch_max_size
+    worker_init: 每个执行器线程(process模式下为每个子进程)启动时执行一次worker_init(), 返回值(模型客户端、HTTP会话等)
+    通过TaskContext.worker_state传给该线程中执行的每个任务, 必须同时开启pass_context, 否则抛出ValueError; process模式下必须是模块级函数
+    worker_teardown: run()退出时对每个worker_init的返回值执行一次worker_teardown(state), process模式下在子进程退出时执行
+    result_cache_dir: 不为None时开启结果缓存(见ResultCache): (prompt, width, height, text_to_video_pack_id)相同的任务直接复用缓存的产物,
+    不再调用func; 同时在途的相同任务只执行一次; 产物由func以第三个返回值给出: (id, None, artifact_path); 批量模式下不使用缓存
+    result_cache_max_bytes, result_cache_max_entries: 缓存的总大小与条目数上限, 超过时按最近最少使用淘汰
+    metrics_log_interval: 每隔该时间(秒)把metrics的快照(领取、写回、连接池等指标)写入日志, run()退出时再写一次, 0表示不写
+    record_artifacts: 为True时成功的任务把产物路径(func的第三个返回值, 缓存命中时为放到输出目录中的路径)写入artifact_path字段(见task_table_upgrade.sql)
+    pool_options: 传给dbpool_get的其他连接池参数, 例如{'min_size':2,'grow_after':0.05,'idle_timeout':300}开启弹性连接池(此时max_connections为连接数上限),
+    {'warmup_workers':8,'min_ready':4}并发创建连接且有4个可用后即开始调度(见DBpool), 连接池的启动耗时等指标写入metrics;
+    {'session':{...}}为建立连接时设置的会话配置, 未配置isolation_level时使用READ COMMITTED, 子进程的连接池使用相同的会话配置
     '''
+    if claim_mode not in CLAIM_MODES:
+      raise ValueError(f'Invalid claim_mode: {claim_mode}, expected one of {CLAIM_MODES}')
+    if schedule_mode not in SCHEDULE_MODES:
+      raise ValueError(f'Invalid schedule_mode: {schedule_mode}, expected one of {SCHEDULE_MODES}')
+    if executor_mode not in EXECUTOR_MODES:
+      raise ValueError(f'Invalid executor_mode: {executor_mode}, expected one of {EXECUTOR_MODES}')
+    if worker_init is not None and not pass_context:
+      # worker_init的返回值只能通过TaskContext.worker_state传给func, 不开启pass_context时会被丢弃
+      raise ValueError('worker_init requires pass_context=True')
+    self.claim_mode = claim_mode
+    self.schedule_mode = schedule_mode
+    self.executor_mode = executor_mode
+    self.process_db_connections = process_db_connections
+    self.pass_context = pass_context
+    self.progress_flush_interval = progress_flush_interval
+    self.reporter:ProgressReporter|None = None
+    self.shutdown_timeout = shutdown_timeout
+    self.handle_signals = handle_signals
+    self.drain_timeout = shutdown_timeout
+    self.running = False
+    self.run_thread:threading.Thread|None = None
+    # run()完全退出(连接池已关闭)后设置
+    self.stopped = threading.Event()
+    self.worker_id = worker_id if worker_id else default_worker_id()
+    self.max_in_flight = max_in_flight
+    self.prefetch_margin = prefetch_margin
+    # 已提交到线程池但尚未完成的任务, id -> Future; 由slot_cond保护, 任务完成时通知run()领取新任务
+    self.in_flight:dict[int,Future] = {}
+    # 在途任务所属的用户, id -> user_id, 用于fair模式的单用户并发上限
+    self.in_flight_user:dict[int,any] = {}
+    self.slot_cond = threading.Condition()
+    self.poller = AdaptivePoll(poll_min_interval,poll_max_interval)
+    self.reap_interval = reap_interval
+    self.reap_batch_size = reap_batch_size
+    self.stop_event = threading.Event()
+    self.lease_thread:threading.Thread|None = None
+    self.metrics_log_interval = metrics_log_interval
+    self.metrics_thread:threading.Thread|None = None
+    self.completion_batch_size = completion_batch_size
+    self.completion_flush_interval = completion_flush_interval
+    self.writer:CompletionWriter|None = None
+    self.enforce_deadlines = enforce_deadlines
+    self.per_task_deadlines = per_task_deadlines
+    self.deadline_check_interval = deadline_check_interval
+    # 在途任务的截止时间, id -> TaskDeadline; 由slot_cond保护
+    self.deadlines:dict[int,TaskDeadline] = {}
+    # 已超时但func仍未返回的任务, Future -> id; 按Future登记, 同一任务重试后再次超时也不会互相覆盖
+    # 它们的线程在func返回前一直被占用, 除非已补充了工作线程(见replaced), 否则仍然计入在途名额
+    self.abandoned:dict[Future,int] = {}
+    # abandoned中已补充了工作线程的任务, func返回时收回补充的线程; 由slot_cond保护
+    self.replaced:set[Future] = set()
+    self.max_replacement_workers = max_replacement_workers
+    self.watchdog_thread:threading.Thread|None = None
+    self.executor:Executor|None = None
+    self.prefetch_high_watermark = max(0,prefetch_high_watermark)
+    self.prefetch_low_watermark = self.prefetch_high_watermark//2 if prefetch_low_watermark is None else min(max(0,prefetch_low_watermark),self.prefetch_high_watermark)
+    self.prefetch_thread:threading.Thread|None = None
+    self.prefetch_stop = threading.Event()
+    # run()从就绪队列取走任务或停止时设置, 只用于唤醒预取线程; 任务完成等slot_cond上的通知不会唤醒预取线程
+    self.prefetch_event = threading.Event()
+    self.func_batch = func_batch
+    self.result_cache:ResultCache|None = ResultCache(result_cache_dir,result_cache_max_bytes,result_cache_max_entries,logging_path) if result_cache_dir else None
+    # 正在执行的缓存键 -> 等待同一结果的任务[(args, deadline, future)]
+    self.cache_leaders:dict[str,list] = {}
+    # 执行者的任务id -> 缓存键
+    self.cache_leader_tasks:dict[int,str] = {}
+    self.cache_lock = threading.Lock()
+    self.worker_init = worker_init
+    self.worker_teardown = worker_teardown
+    self.worker_local = threading.local()
+    # 各工作线程中worker_init的返回值, 退出时逐个执行worker_teardown
+    self.worker_states:list = []
+    self.worker_states_lock = threading.Lock()
+    self.batcher:TaskBatcher|None = TaskBatcher(batch_key,batch_max_size,batch_max_wait) if func_batch is not None else None
+    projection = PROJECTED_FIELDS+('user_id',) if self.schedule_mode == 'fair' else PROJECTED_FIELDS
+    if self.per_task_deadlines:
+      projection += ('deadline_seconds',)
+    if self.schedule_mode == 'priority':
+      # 通道内按有效优先级和等待时间合并本通道任务与老化任务
+      projection += ('priority','created_at')
+    if self.batcher is not None:
+      projection += tuple(field for field in self.batcher.key_fields if field not in projection)
+    retry_backoff = (retry_backoff_base,retry_backoff_max,retry_backoff_jitter) if retry_backoff_base > 0 else None
+    self.task_sql = TaskSQL(table_name,fields,projection,retry_backoff,record_artifacts)
+    if self.schedule_mode == 'fair':
+      self.scheduler = FairShareScheduler(self.task_sql,logging_path,max_retry_times,max_per_user,user_load=self.in_flight_user_load)
+    elif self.schedule_mode == 'priority':
+      self.scheduler = PriorityLaneScheduler(self.task_sql,logging_path,max_retry_times,priority_lanes,priority_aging_interval,priority_aging_step)
+    else:
+      self.scheduler = FifoScheduler(self.task_sql,logging_path,max_retry_times)
+    self.metrics = metrics.Metrics()
+    self.admission:AdmissionController|None = AdmissionController(admission_budgets,admission_costs,metrics_obj=self.metrics) if admission_budgets else None
     self.func = func
     self.host = host
     self.port = port
@@ -73,10 +258,12 @@ class main_thread:
     self.generate_retry_times=generate_retry_times
     self.heart_beat_interval=heart_beat_interval
     self.time_overflow_seconds=time_overflow_seconds
-    self.dbpool:DBpool.DBpool|DBpool.DBpoolRenew = dbpool_get(self.max_connections,self.host,self.port,self.user,self.password,self.db,DictCursor,self.logging_path,self.heart_beat_interval)
+    self.pool_options = dict(pool_options or {})
+    self.pool_options['session'] = {'isolation_level':CLAIM_ISOLATION_LEVEL,**(self.pool_options.get('session') or {})}
+    self.dbpool:DBpool.DBpool|DBpool.DBpoolRenew = dbpool_get(self.max_connections,self.host,self.port,self.user,self.password,self.db,DictCursor,self.logging_path,self.heart_beat_interval,metrics_obj=self.metrics,**self.pool_options)
     try:
-      self.conn = self.dbpool.create_connection()
-      self.dbpool.put_connection(self.conn)
+      # 启动前确认可以建立新连接; 探测连接不在连接池的计数内, 用完直接关闭, 不放入连接池
+      self.dbpool.create_connection().close()
     except pymysql.Error as e:
       self.dbpool.close()
       simple_log.log(str(e),log_path=self.logging_path)
@@ -90,56 +277,38 @@ class main_thread:
     从数据库中找到特定数量的state=0的记录并添加到queue中, 并更新state为1
     '''
     rows = []
-    conn = None
-    cursor = None
     try:
-      # 每次获取新的连接，避免事务状态问题
-      conn = self.dbpool.get_connection()
-      conn.begin()
-      cursor = conn.cursor()
-
-      # 设置事务隔离级别为READ COMMITTED，确保能看到其他事务已提交的数据
-      cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
-
-      #弱点: 不熟悉数据库的事务和锁机制
-
-      # 使用原子操作：先更新再查询，避免竞态条件
-      # 使用FOR UPDATE SKIP LOCKED来避免锁定冲突
-      sql = '''
-      SELECT * FROM text_to_video_tasks
-      WHERE state = 0 
-      ORDER BY id 
-      LIMIT %s 
-      '''
-      args = (ub,)
-
-      status = retry_execute(cursor, self.logging_path, sql, args, self.max_retry_times)
-      if status == False:
-        raise Exception("""
-                        Error in fetch_status0:retry_execute(sql,args) 
-                        for finding rows with state=0
-                        """)
+      # 每次获取新的连接，避免事务状态问题; 出错时由dbpool.connection()回滚并放回连接
+      with self.dbpool.connection() as conn:
+        # 事务隔离级别为READ COMMITTED，确保能看到其他事务已提交的数据
+        # 连接池在建立连接时已经设置, 这里只在会话配置被改动过的连接上执行SET
+        self.dbpool.set_session(conn,isolation_level=CLAIM_ISOLATION_LEVEL)
+        conn.begin()
+        with conn.cursor() as cursor:
+          # 由调度器决定领取哪些行, 只查询传给任务函数的列
+          # skip_locked模式下行锁在同一个短事务内持有, 其他实例会跳过这些行, 不会重复领取
+          rows = self.scheduler.select(cursor,ub,self.claim_mode == 'skip_locked')
+          self.metrics.incr('claim_queries')
+          print('--------------------------------------------------------rows size:',len(rows))
 
-      rows = list(cursor.fetchall())
-      print('--------------------------------------------------------rows size:',len(rows))
+          if len(rows) > 0:
+            # 立即更新这些记录的状态为1
+            sql = self.task_sql.claim_update(len(rows),self.claim_mode == 'skip_locked')
+            args = tuple(row['id'] for row in rows)
+            if self.claim_mode == 'skip_locked':
+              # 写入当前实例的worker_id作为领取标记, heartbeat_at作为租约起点
+              args = (self.worker_id,) + args
 
-      if len(rows) > 0:
-        # 立即更新这些记录的状态为1
-        placeholders = ','.join(['%s'] * len(rows))
-        sql = f'UPDATE text_to_video_tasks SET state = 1 WHERE id IN ({placeholders})'
-        args = tuple(row['id'] for row in rows)
-
-        res = retry_execute(cursor, self.logging_path, sql, args, self.max_retry_times)
-        if res == False:
-          conn.rollback()
-          raise Exception("Retry failed, error in fetch_status0:retry_execute(sql,args), update state to 1")
-        else:
-          conn.commit()
-          simple_log.log(f'Successfully updated {len(rows)} tasks from state=0 to state=1', log_path=self.logging_path)
+            res = retry_execute(cursor, self.logging_path, sql, args, self.max_retry_times)
+            if res == False:
+              raise Exception("Retry failed, error in fetch_status0:retry_execute(sql,args), update state to 1")
+            conn.commit()
+            simple_log.log(f'Successfully updated {len(rows)} tasks from state=0 to state=1 (worker_id: {self.worker_id})', log_path=self.logging_path)
+            self.metrics.incr('tasks_claimed',len(rows))
 
-      else: #测试语句, 正式调试时删除
-        print('no rows to update')
-        time.sleep(5)
+          else:
+            # 结束本次(可能持有锁的)事务, 空闲等待由run()中的AdaptivePoll负责
+            conn.commit()
 
       idlist = []
       if len(rows) > 0:
@@ -151,41 +320,734 @@ class main_thread:
 
     except Exception as e:
       simple_log.log(f'Error in fetch_status0: {str(e)}', log_path=self.logging_path)
-      if conn:
-        try:
-          conn.rollback()
-        except:
-          pass
       raise e
-    finally:
-      if cursor:
-        try:
-          cursor.close()
-        except:
-          pass
-      if conn:
+
+  def in_flight_budget(self,max_workers:int)->int:
+    '''
+    允许同时在途(已提交未完成)的任务数
+    '''
+    if self.max_in_flight is not None:
+      return max(1,self.max_in_flight)
+    return max_workers + max(0,self.prefetch_margin)
+
+  def create_executor(self,max_workers:int)->Executor:
+    if self.executor_mode == 'process':
+      pool_args = None
+      if self.process_db_connections > 0:
+        pool_args = {'max_connections':self.process_db_connections,'host':self.host,'port':self.port,'user':self.user,'password':self.password,'db':self.db,'cursorclass':'DictCursor','logging_path':self.logging_path,'session':self.pool_options['session']}
+      context_args = None
+      if self.pass_context:
+        context_args = {'logging_path':self.logging_path,'task_sql':self.task_sql,'flush_interval':self.progress_flush_interval,'max_retry_times':self.max_retry_times,'worker_id':self.claim_worker_id()}
+      return ProcessPoolExecutor(max_workers=max_workers,initializer=process_worker.init_worker,initargs=(pool_args,context_args,self.worker_init,self.worker_teardown))
+    return ReplaceableThreadPoolExecutor(max_workers=max_workers,initializer=self.init_worker_thread if self.worker_init is not None else None)
+
+  def replace_worker(self)->bool:
+    '''
+    为一个超时未返回的任务补充工作线程, 需要持有slot_cond; 进程池与批量执行不补充, 达到max_replacement_workers时返回False
+    '''
+    executor = self.executor
+    if not isinstance(executor,ReplaceableThreadPoolExecutor) or self.batcher is not None:
+      return False
+    limit = executor.base_workers if self.max_replacement_workers is None else max(0,self.max_replacement_workers)
+    if len(self.replaced) >= limit:
+      return False
+    executor.add_worker()
+    return True
+
+  def init_worker_thread(self):
+    '''
+    ThreadPoolExecutor的initializer: 在每个工作线程启动时执行一次worker_init, 返回值保存在线程局部变量中
+    worker_init抛出异常时线程池不可用(之后提交的任务都会失败), 这里记录日志后继续抛出
+    '''
+    try:
+      state = self.worker_init()
+    except Exception as e:
+      simple_log.log(f'Error in worker_init: {str(e)}', log_path=self.logging_path)
+      raise
+    self.worker_local.state = state
+    with self.worker_states_lock:
+      self.worker_states.append(state)
+
+  def get_worker_state(self):
+    '''
+    当前线程中worker_init的返回值, 没有执行过worker_init的线程返回None
+    '''
+    return getattr(self.worker_local,'state',None)
+
+  def teardown_workers(self):
+    '''
+    执行器关闭后对每个工作线程的状态执行worker_teardown; 超时仍未返回的任务线程的状态也会被清理
+    '''
+    with self.worker_states_lock:
+      states = self.worker_states
+      self.worker_states = []
+    if self.worker_teardown is None:
+      return
+    for state in states:
+      try:
+        self.worker_teardown(state)
+      except Exception as e:
+        simple_log.log(f'Error in worker_teardown: {str(e)}', log_path=self.logging_path)
+
+  def func_arg(self,args:dict,deadline:TaskDeadline|None=None):
+    '''
+    传给func的第二个参数: pass_context时为TaskContext, 否则为连接池
+    '''
+    if self.pass_context:
+      return TaskContext(args['id'],self.dbpool,self.reporter,deadline,self.get_worker_state)
+    return self.dbpool
+
+  def submit_task(self,executor:Executor,args:dict,deadline:TaskDeadline|None=None,lookup:bool=True)->Future:
+    '''
+    提交任务函数, 回调始终在父进程中执行
+    process模式下cancel_event不能跨进程传递, 超时的任务只会被标记失败, 子进程中的func不会收到取消通知
+    '''
+    if self.result_cache is not None:
+      return self.submit_cached(executor,args,deadline,lookup)
+    return self.execute_task(executor,args,deadline)
+
+  def cached_future(self,args:dict)->Future|None:
+    '''
+    命中缓存时返回已完成的Future, 由正常的回调写回成功与产物路径; 未命中时返回None
+    命中时会硬链接或复制产物文件, 不要在持有slot_cond时调用
+    '''
+    result = self.cache_hit(args,cache_key(args))
+    if result is None:
+      return None
+    future = Future()
+    future.set_running_or_notify_cancel()
+    future.set_result(result)
+    return future
+
+  def execute_task(self,executor:Executor,args:dict,deadline:TaskDeadline|None=None)->Future:
+    if self.executor_mode == 'process':
+      return executor.submit(process_worker.run_task,self.func,args)
+    return executor.submit(self.func,args,self.func_arg(args,deadline))
+
+  def cache_hit(self,args:dict,key:str)->tuple|None:
+    '''
+    把缓存的产物放到任务的输出目录, 返回与func相同格式的成功结果; 缓存已被淘汰时返回None
+    '''
+    try:
+      path = self.result_cache.materialize(key,args.get('output_path') or self.result_cache.root,args.get('task_uuid') or args['id'])
+    except Exception as e:
+      simple_log.log(f'Error in cache_hit for task {args["id"]}: {str(e)}', log_path=self.logging_path)
+      return None
+    if path is None:
+      return None
+    self.metrics.incr('result_cache_hits')
+    simple_log.log(f'Task {args["id"]} served from result cache: {path}', log_path=self.logging_path)
+    return (args['id'],None,path)
+
+  def submit_cached(self,executor:Executor,args:dict,deadline:TaskDeadline|None=None,lookup:bool=True)->Future:
+    '''
+    命中缓存时返回已完成的Future(见cached_future); 相同的任务正在执行时返回等待它结果的Future(drain可以取消);
+    否则作为该缓存键的执行者提交func
+    lookup: 为False时调用方已经用cached_future查过缓存, 这里不再查找
+    '''
+    if lookup:
+      future = self.cached_future(args)
+      if future is not None:
+        return future
+    key = cache_key(args)
+    with self.cache_lock:
+      waiters = self.cache_leaders.get(key)
+      if waiters is not None:
+        future = Future()
+        waiters.append((args,deadline,future))
+        self.metrics.incr('result_cache_coalesced')
+        return future
+      self.cache_leaders[key] = []
+      self.cache_leader_tasks[args['id']] = key
+    self.metrics.incr('result_cache_misses')
+    try:
+      future = self.execute_task(executor,args,deadline)
+    except Exception:
+      self.cache_leader_done(key,args['id'],None)
+      raise
+    future.add_done_callback(lambda future:self.cache_leader_done(key,args['id'],future))
+    return future
+
+  def detach_cache_waiters(self,task_id:int)->tuple[str|None,list]:
+    '''
+    解除任务作为缓存键执行者的身份, 返回缓存键与等待它的任务; 不是执行者时返回(None, [])
+    '''
+    with self.cache_lock:
+      key = self.cache_leader_tasks.pop(task_id,None)
+      if key is None:
+        return None,[]
+      return key,self.cache_leaders.pop(key,[])
+
+  def cache_leader_done(self,key:str,task_id:int,future:Future|None):
+    '''
+    执行者完成后: 成功且给出产物时写入缓存, 等待的任务直接使用缓存; 否则等待的任务各自重新提交(第一个成为新的执行者)
+    执行者超时后由看门狗提前解除, 晚到的成功结果仍然写入缓存
+    '''
+    _,waiters = self.detach_cache_waiters(task_id)
+    if future is not None and not future.cancelled() and future.exception() is None:
+      result = future.result()
+      if result[1] is None and len(result) > 2 and result[2]:
         try:
-          self.dbpool.put_connection(conn)
-        except:
-          pass
+          self.result_cache.put(key,result[2])
+        except Exception as e:
+          simple_log.log(f'Error in cache_leader_done while caching {result[2]}: {str(e)}', log_path=self.logging_path)
+    self.resubmit_cache_waiters(waiters)
+
+  def resubmit_cache_waiters(self,waiters:list):
+    '''
+    等待者按顺序重新走submit_cached: 命中缓存则直接完成, 否则第一个成为新的执行者
+    在cache_lock之外完成等待者的Future, 它们的回调会获取slot_cond
+    '''
+    for args,deadline,waiter in waiters:
+      if not waiter.set_running_or_notify_cancel():
+        continue
+      try:
+        inner = self.submit_cached(self.executor,args,deadline)
+      except Exception as e:
+        waiter.set_exception(e)
+        continue
+      inner.add_done_callback(lambda inner,waiter=waiter:self.chain_result(inner,waiter))
+
+  def chain_result(self,source:Future,target:Future):
+    if source.cancelled():
+      target.set_exception(CancelledError())
+    elif source.exception() is not None:
+      target.set_exception(source.exception())
+    else:
+      target.set_result(source.result())
+
+  def task_deadline(self,row:dict)->TaskDeadline|None:
+    '''
+    任务的截止时间: per_task_deadlines时优先使用行中的deadline_seconds, 否则为time_overflow_seconds; 未开启enforce_deadlines时为None
+    '''
+    if not self.enforce_deadlines:
+      return None
+    seconds = row.get('deadline_seconds') if self.per_task_deadlines else None
+    if not seconds or seconds <= 0:
+      seconds = self.time_overflow_seconds
+    if not seconds or seconds <= 0:
+      return None
+    return TaskDeadline(float(seconds))
+
+  def expire_overdue_tasks(self)->list[int]:
+    '''
+    找出执行超过截止时间的任务: 设置取消标记, 移入abandoned, 并按失败结果写回(由failure_update决定重试或最终失败)
+    能补充工作线程时不再占用在途名额, 否则在func返回前仍然占用; 重新领取的同一任务按新的Future登记
+    任务开始执行时才开始计时; 与回调同时完成时由TaskDeadline.finish决定只写回一次, 返回超时的任务id
+    '''
+    now = time.monotonic()
+    expired = []
+    with self.slot_cond:
+      for task_id,deadline in list(self.deadlines.items()):
+        future = self.in_flight.get(task_id)
+        if future is None:
+          continue
+        if deadline.started_at is None:
+          if future.running():
+            deadline.start(now)
+          continue
+        if not deadline.expired(now) or not deadline.finish():
+          continue
+        deadline.cancel()
+        self.in_flight.pop(task_id,None)
+        self.in_flight_user.pop(task_id,None)
+        self.deadlines.pop(task_id,None)
+        self.abandoned[future] = task_id
+        if self.replace_worker():
+          self.replaced.add(future)
+        expired.append((task_id,deadline.seconds))
+      if expired:
+        self.slot_cond.notify_all()
+    for task_id,seconds in expired:
+      simple_log.log(f'Task {task_id} exceeded its deadline of {seconds}s, cancelling', log_path=self.logging_path)
+      if self.result_cache is not None:
+        # 等待该任务结果的相同任务不再等待, 重新提交
+        self.resubmit_cache_waiters(self.detach_cache_waiters(task_id)[1])
+      result = Future()
+      result.set_result((task_id,f'task timed out after {seconds}s'))
+      main_thread.callback({'id':task_id},self.dbpool,self.logging_path,self.max_retry_times,self.generate_retry_times,self.claim_worker_id(),self.writer,self.task_sql)(result)
+    self.metrics.incr('tasks_timed_out',len(expired))
+    with self.slot_cond:
+      self.metrics.set_gauge('tasks_abandoned',len(self.abandoned))
+      self.metrics.set_gauge('replacement_workers',len(self.replaced))
+    return [task_id for task_id,_ in expired]
+
+  def deadline_loop(self):
+    while not self.stop_event.wait(timeout=self.deadline_check_interval):
+      try:
+        self.expire_overdue_tasks()
+      except Exception as e:
+        simple_log.log(f'Error in deadline_loop: {str(e)}', log_path=self.logging_path)
+
+  def start_watchdog(self):
+    if not self.enforce_deadlines or self.watchdog_thread is not None:
+      return
+    self.watchdog_thread = threading.Thread(target=self.deadline_loop,name='deadline_watchdog',daemon=True)
+    self.watchdog_thread.start()
+
+  def stop_watchdog(self):
+    '''
+    超时任务的结果经writer写回, 需要在stop_writer之前调用
+    '''
+    self.stop_event.set()
+    if self.watchdog_thread is not None:
+      self.watchdog_thread.join()
+      self.watchdog_thread = None
+
+  def log_metrics(self):
+    simple_log.log(f'Metrics: {json.dumps(self.metrics.snapshot(),sort_keys=True)}', log_path=self.logging_path)
+
+  def metrics_loop(self):
+    while not self.stop_event.wait(timeout=self.metrics_log_interval):
+      try:
+        self.log_metrics()
+      except Exception as e:
+        simple_log.log(f'Error in metrics_loop: {str(e)}', log_path=self.logging_path)
+
+  def start_metrics_logger(self):
+    if self.metrics_log_interval <= 0 or self.metrics_thread is not None:
+      return
+    self.metrics_thread = threading.Thread(target=self.metrics_loop,name='metrics_logger',daemon=True)
+    self.metrics_thread.start()
+
+  def stop_metrics_logger(self):
+    '''
+    退出前写最后一次快照, 包含drain与写回的结果
+    '''
+    self.stop_event.set()
+    if self.metrics_thread is not None:
+      self.metrics_thread.join()
+      self.metrics_thread = None
+      try:
+        self.log_metrics()
+      except Exception as e:
+        simple_log.log(f'Error in stop_metrics_logger: {str(e)}', log_path=self.logging_path)
+
+  def start_reporter(self):
+    if not self.pass_context or self.reporter is not None:
+      return
+    self.reporter = ProgressReporter(self.dbpool,self.logging_path,self.task_sql,self.progress_flush_interval,self.max_retry_times,self.claim_worker_id(),metrics_obj=self.metrics)
+    self.reporter.start()
+
+  def stop_reporter(self):
+    if self.reporter is not None:
+      try:
+        self.reporter.close()
+      except Exception as e:
+        simple_log.log(f'Error in stop_reporter: {str(e)}', log_path=self.logging_path)
+      self.reporter = None
+
+  def in_flight_user_load(self)->dict:
+    '''
+    本实例各用户正在执行以及已领取等待执行的任务数
+    '''
+    load = {}
+    with self.slot_cond:
+      for user in self.in_flight_user.values():
+        load[user] = load.get(user,0)+1
+    for row in self.queued_rows():
+      if 'user_id' in row:
+        load[row['user_id']] = load.get(row['user_id'],0)+1
+    return load
+
+  def queued_rows(self)->list[dict]:
+    '''
+    本地就绪队列中已领取但尚未提交的行
+    '''
+    with self.queue.mutex:
+      return list(self.queue.queue)
+
+  def occupied_slots(self)->int:
+    '''
+    占用在途名额的任务数: 在途任务加上已超时但func仍未返回、也没有补充工作线程的任务, 需要持有slot_cond
+    线程无法被强制结束, 超时任务的工作线程在func返回前不可用, 没有补充线程时不计入会在线程池队列中积压任务
+    '''
+    return len(self.in_flight)+len(self.abandoned)-len(self.replaced)
+
+  def wait_for_slots(self,budget:int,timeout:float=1.0)->int:
+    '''
+    阻塞直到有空闲的在途名额或超时, 返回当前空闲名额数
+    任务完成时release_slot会唤醒这里, 不需要定时轮询
+    '''
+    with self.slot_cond:
+      if self.occupied_slots() >= budget and self.status:
+        self.slot_cond.wait(timeout=timeout)
+      return max(0,budget-self.occupied_slots())
+
+  class release_slot:
+    '''
+    Future完成后释放在途名额并唤醒run(), 需要在数据库回调之后注册, 保证名额释放时任务状态已写回
+    只移除属于这次提交的登记: 超时后被重新领取的同一任务已用新的Future登记, 旧调用返回时不能移除它们
+    '''
+    def __init__(self,owner:'main_thread',row:dict):
+      self.owner=owner
+      # 持有row, 保证准入控制按id(row)登记的占用在释放前不会与其他行混淆
+      self.row=row
+      self.task_id=row['id']
+    def __call__(self,future:Future):
+      with self.owner.slot_cond:
+        if self.owner.in_flight.get(self.task_id) is future:
+          self.owner.in_flight.pop(self.task_id)
+          self.owner.in_flight_user.pop(self.task_id,None)
+          self.owner.deadlines.pop(self.task_id,None)
+        self.owner.abandoned.pop(future,None)
+        if future in self.owner.replaced:
+          # func已返回, 收回为它补充的工作线程
+          self.owner.replaced.discard(future)
+          self.owner.executor.remove_worker()
+        if self.owner.admission is not None:
+          # 在func真正返回后才释放资源, 超时未返回的任务仍然占用显存等资源
+          self.owner.admission.release(id(self.row))
+        self.owner.slot_cond.notify_all()
+
+  def idle_wait(self,found:bool):
+    '''
+    根据本次是否领取到任务决定下一次轮询前的等待时间, 并记录poll_interval_seconds指标
+    等待期间任务完成或stop会通过slot_cond提前唤醒
+    '''
+    interval = self.poller.found() if found else self.poller.idle()
+    self.metrics.set_gauge('poll_interval_seconds',interval)
+    interval = self.batch_timeout(interval)
+    if interval > 0:
+      with self.slot_cond:
+        if self.status:
+          self.slot_cond.wait(timeout=interval)
+
+  def prefetch_loop(self,slice_size:int):
+    '''
+    后台预取线程: 就绪队列不高于低水位时领取一批任务(每次最多slice_size条, 不超过高水位), 没有领取到任务时按AdaptivePoll等待
+    只有run()取走任务或stop会通过prefetch_event提前唤醒这里, 空表时领取频率不超过AdaptivePoll的间隔
+    '''
+    while self.status and not self.prefetch_stop.is_set():
+      # 先清除再检查条件, 检查之后设置的事件不会丢失
+      self.prefetch_event.clear()
+      if self.queue.qsize() > self.prefetch_low_watermark:
+        self.prefetch_event.wait(timeout=1.0)
+        continue
+      if not self.status or self.prefetch_stop.is_set():
+        break
+      want = self.claim_size(min(slice_size,self.prefetch_high_watermark-self.queue.qsize()))
+      if want <= 0:
+        # 剩余预算不足以启动更多任务, 等待在途任务释放资源
+        with self.slot_cond:
+          if self.status and not self.prefetch_stop.is_set():
+            self.slot_cond.wait(timeout=1.0)
+        continue
+      try:
+        idlist = self.fetch_status0(want)
+      except Exception as e:
+        simple_log.log(f'Error in prefetch_loop: {str(e)}', log_path=self.logging_path)
+        idlist = []
+      self.metrics.set_gauge('ready_buffer_size',self.queue.qsize())
+      if idlist:
+        with self.slot_cond:
+          self.slot_cond.notify_all()
+      interval = self.poller.found() if idlist else self.poller.idle()
+      self.metrics.set_gauge('poll_interval_seconds',interval)
+      if interval > 0 and self.status and not self.prefetch_stop.is_set():
+        self.prefetch_event.wait(timeout=interval)
+
+  def start_prefetcher(self,slice_size:int):
+    '''
+    需要在init_process之后启动, 避免预取到的任务被启动时的回收逻辑放回队列
+    '''
+    if self.prefetch_high_watermark <= 0 or self.prefetch_thread is not None:
+      return
+    self.prefetch_stop.clear()
+    self.prefetch_thread = threading.Thread(target=self.prefetch_loop,args=(max(1,slice_size),),name='claim_prefetcher',daemon=True)
+    self.prefetch_thread.start()
+
+  def stop_prefetcher(self):
+    '''
+    需要在drain之前调用, 保证drain放回队列之后不会再领取新的任务
+    '''
+    self.prefetch_stop.set()
+    self.prefetch_event.set()
+    self.wake()
+    if self.prefetch_thread is not None:
+      self.prefetch_thread.join()
+      self.prefetch_thread = None
+
+  def claim_size(self,limit:int)->int:
+    '''
+    本次领取的数量: 不超过limit, 开启准入控制时再扣除就绪队列中的任务后不超过剩余预算能启动的任务数
+    '''
+    if self.admission is not None:
+      admissible = self.admission.claim_limit()
+      if admissible is not None:
+        limit = min(limit,admissible-self.queue.qsize())
+    return max(0,limit)
+
+  def next_admitted_row(self)->dict|None:
+    '''
+    取出就绪队列的队首任务; 开启准入控制时只有剩余预算足够才取出并占用资源, 否则留在队首返回None
+    只有run()所在的线程从就绪队列取任务, 先查看再取出是安全的
+    占用按id(row)登记: 超时未返回的旧调用与重新领取的同一任务各自持有自己的行, 释放时互不影响
+    '''
+    with self.queue.mutex:
+      if not self.queue.queue:
+        return None
+      row = self.queue.queue[0]
+    if self.admission is not None and not self.admission.acquire(id(row),self.admission.cost(row)):
+      return None
+    row = self.queue.get()
+    self.prefetch_event.set()
+    return row
+
+  def submit_ready(self,executor:Executor,limit:int)->int:
+    '''
+    按顺序从就绪队列提交最多limit条任务, 返回提交的数量
+    '''
+    submitted = 0
+    while submitted < limit:
+      row = self.next_admitted_row()
+      if row is None:
+        break
+      try:
+        self.submit_row(executor,row)
+      except Exception:
+        if self.admission is not None:
+          self.admission.release(id(row))
+        raise
+      submitted += 1
+    return submitted
+
+  def wait_for_ready(self,timeout:float=1.0)->int:
+    '''
+    预取模式下等待就绪队列中有任务或超时, 返回就绪的任务数
+    '''
+    with self.slot_cond:
+      if self.queue.empty() and self.status:
+        self.slot_cond.wait(timeout=timeout)
+    return self.queue.qsize()
+
+  def renew_leases(self)->int:
+    '''
+    为本实例正在执行的任务续约(更新heartbeat_at), 按主键分批更新, 返回续约的行数
+    '''
+    with self.slot_cond:
+      ids = list(self.in_flight.keys())
+    # 预取到就绪队列中的任务同样需要续约, 否则等待执行期间可能被其他实例回收
+    ids += [row['id'] for row in self.queued_rows()]
+    renewed = 0
+    for i in range(0,len(ids),self.reap_batch_size):
+      batch = ids[i:i+self.reap_batch_size]
+      sql = self.task_sql.renew_leases(len(batch))
+      args = tuple(batch)+(self.worker_id,)
+      with self.dbpool.connection() as conn:
+        with conn.cursor() as cursor:
+          if retry_execute(cursor,self.logging_path,sql,args,self.max_retry_times) == False:
+            raise Exception('Error in renew_leases:retry_execute(sql,args) for updating heartbeat_at')
+          renewed += cursor.rowcount
+        conn.commit()
+    return renewed
+
+  def reap_stale_tasks(self)->int:
+    '''
+    将heartbeat_at早于time_overflow_seconds的state=1任务放回队列(state=0), 返回回收的行数
+    每批最多reap_batch_size行, 按(state, heartbeat_at)索引范围扫描, 单批提交以缩短持锁时间
+    存活实例的任务会被renew_leases持续续约, 不会被回收
+    '''
+    sql = self.task_sql.reap_stale()
+    args = (int(self.time_overflow_seconds),self.reap_batch_size)
+    reaped = 0
+    while not self.stop_event.is_set():
+      with self.dbpool.connection() as conn:
+        with conn.cursor() as cursor:
+          if retry_execute(cursor,self.logging_path,sql,args,self.max_retry_times) == False:
+            raise Exception('Error in reap_stale_tasks:retry_execute(sql,args) for resetting stale tasks')
+          count = cursor.rowcount
+        conn.commit()
+      reaped += count
+      if count < self.reap_batch_size:
+        break
+    if reaped > 0:
+      simple_log.log(f'Reaped {reaped} stale tasks (heartbeat older than {self.time_overflow_seconds}s) back to state=0', log_path=self.logging_path)
+    self.metrics.incr('tasks_reaped',reaped)
+    return reaped
+
+  def lease_loop(self):
+    '''
+    后台线程: 每隔time_overflow_seconds/3续约一次, 每隔reap_interval回收一次过期任务
+    '''
+    renew_interval = max(1.0,self.time_overflow_seconds/3)
+    next_renew = time.time()+renew_interval
+    next_reap = time.time()
+    while not self.stop_event.is_set():
+      now = time.time()
+      try:
+        if now >= next_renew:
+          next_renew = now+renew_interval
+          self.renew_leases()
+        if now >= next_reap:
+          next_reap = now+self.reap_interval
+          self.reap_stale_tasks()
+      except Exception as e:
+        simple_log.log(f'Error in lease_loop: {str(e)}', log_path=self.logging_path)
+      self.stop_event.wait(timeout=max(0.0,min(next_renew,next_reap)-time.time()))
+
+  def start_lease_thread(self):
+    '''
+    只有skip_locked模式下表中有worker_id/heartbeat_at字段, 才启动租约线程
+    '''
+    if self.claim_mode != 'skip_locked' or self.time_overflow_seconds <= 0 or self.lease_thread is not None:
+      return
+    self.lease_thread = threading.Thread(target=self.lease_loop,name='lease_reaper',daemon=True)
+    self.lease_thread.start()
+
+  def stop_lease_thread(self):
+    self.stop_event.set()
+    if self.lease_thread is not None:
+      self.lease_thread.join()
+      self.lease_thread = None
+
+  def start_writer(self):
+    if self.completion_batch_size <= 0 or self.writer is not None:
+      return
+    self.writer = CompletionWriter(self.dbpool,self.logging_path,self.max_retry_times,self.generate_retry_times,self.completion_batch_size,self.completion_flush_interval,self.claim_worker_id(),self.metrics,self.task_sql)
+    self.writer.start()
+
+  def stop_writer(self):
+    '''
+    写完已提交的结果后关闭写入线程, 需要在关闭连接池之前调用
+    '''
+    if self.writer is not None:
+      self.writer.close()
+      self.writer = None
+
+  def claim_worker_id(self)->str|None:
+    '''
+    回调中用于校验任务归属的worker_id, legacy模式下表中没有worker_id字段, 返回None
+    '''
+    if self.claim_mode == 'skip_locked':
+      return self.worker_id
+    return None
+
+  def wake(self):
+    '''
+    唤醒正在等待空闲名额或轮询间隔的run()
+    '''
+    with self.slot_cond:
+      self.slot_cond.notify_all()
+
+  def request_stop(self,timeout:float|None=None):
+    '''
+    通知run()停止领取新任务并开始退出, 不等待; 可以在信号处理函数中调用
+    timeout: 等待正在执行的任务完成的最长时间, None时使用shutdown_timeout
+    '''
+    self.drain_timeout = self.shutdown_timeout if timeout is None else timeout
+    self.status = False
+    self.prefetch_event.set()
+    self.wake()
+
+  def stop(self,timeout:float|None=None)->bool:
+    '''
+    优雅停止: 不再领取任务, 已领取但未开始执行的任务批量放回队列(state=0),
+    正在执行的任务最多等待timeout秒, 写完结果后关闭连接池
+    在其他线程中调用时会等待run()退出, 返回run()是否已经退出
+    '''
+    self.request_stop(timeout)
+    if self.running and threading.current_thread() is not self.run_thread:
+      self.stopped.wait()
+    return not self.running
+
+  def install_signal_handlers(self)->dict:
+    '''
+    只能在主线程中设置信号处理函数, 返回原有的处理函数以便退出时恢复
+    '''
+    previous = {}
+    if not self.handle_signals or threading.current_thread() is not threading.main_thread():
+      return previous
+    def handler(signum,frame):
+      simple_log.log(f'Received signal {signum}, stopping (drain timeout {self.shutdown_timeout}s)', log_path=self.logging_path)
+      self.request_stop()
+    for sig in (signal.SIGTERM,signal.SIGINT):
+      previous[sig] = signal.signal(sig,handler)
+    return previous
+
+  def restore_signal_handlers(self,previous:dict):
+    for sig,old in previous.items():
+      signal.signal(sig,old)
+
+  def release_tasks(self,ids:list[int])->int:
+    '''
+    将已领取但未执行的任务放回队列(state=0), 按reap_batch_size分批, 每批一条语句, 返回放回的行数
+    '''
+    owned = self.claim_worker_id() is not None
+    owner_args = (self.claim_worker_id(),) if owned else ()
+    released = 0
+    for i in range(0,len(ids),self.reap_batch_size):
+      batch = ids[i:i+self.reap_batch_size]
+      with self.dbpool.connection() as conn:
+        with conn.cursor() as cursor:
+          if retry_execute(cursor,self.logging_path,self.task_sql.release_claimed(len(batch),owned),tuple(batch)+owner_args,self.max_retry_times) == False:
+            raise Exception('Error in release_tasks:retry_execute(sql,args) for resetting claimed tasks to state=0')
+          released += cursor.rowcount
+        conn.commit()
+    if released > 0:
+      simple_log.log(f'Released {released} claimed but unstarted tasks back to state=0', log_path=self.logging_path)
+    return released
+
+  def drain(self,executor:Executor):
+    '''
+    退出前的清理: 取消尚未开始的任务并批量放回队列, 正在执行的任务最多等待drain_timeout秒
+    超时仍未结束的任务不再等待, 它们的租约不再续期, 由其他实例的回收线程或下次启动的init_process处理
+    '''
+    deadline = time.time()+max(0,self.drain_timeout)
+    with self.slot_cond:
+      futures = dict(self.in_flight)
+    unstarted = [task_id for task_id,future in futures.items() if future.cancel()]
+    if self.batcher is not None:
+      # 攒批中的任务尚未提交, 上面已取消并放回队列
+      self.batcher.ready(force=True)
+    while not self.queue.empty():
+      unstarted.append(self.queue.get()['id'])
+    try:
+      self.release_tasks(unstarted)
+    except Exception as e:
+      simple_log.log(f'Error in drain while releasing {len(unstarted)} tasks: {str(e)}', log_path=self.logging_path)
+    running = [future for task_id,future in futures.items() if not future.cancelled()]
+    not_done = set()
+    if running:
+      _,not_done = wait(running,timeout=max(0,deadline-time.time()))
+    if not_done:
+      simple_log.log(f'{len(not_done)} tasks still running after the drain deadline', log_path=self.logging_path)
+    with self.slot_cond:
+      abandoned = len(self.abandoned)
+    if abandoned:
+      simple_log.log(f'{abandoned} timed out tasks have not returned, not waiting for them', log_path=self.logging_path)
+    executor.shutdown(wait=not not_done and not abandoned,cancel_futures=True)
 
   #测试成功
   def close(self):
     self.dbpool.close()
 
   class callback:
-    def __init__(self,package:dict[str,any],dbpool:DBpool,logging_path:str,max_retry_times:int = 5,generate_retry_times:int = 3):
+    def __init__(self,package:dict[str,any],dbpool:DBpool,logging_path:str,max_retry_times:int = 5,generate_retry_times:int = 3,worker_id:str|None = None,writer:CompletionWriter|None = None,task_sql:TaskSQL|None = None,deadline:TaskDeadline|None = None):
+      '''
+      worker_id: 不为None时, 只更新仍由该实例持有的任务(worker_id相同且state=1), 避免覆盖已被其他实例重新领取的任务
+      writer: 不为None时, 结果交给CompletionWriter批量写库, write_future在结果落库后完成
+      deadline: 不为None时, 任务已被看门狗按超时处理后到达的结果会被忽略
+      '''
+      self.deadline=deadline
+      self.writer=writer
+      self.write_future:Future|None=None
       self.package=package
       self.dbpool=dbpool
       self.logging_path=logging_path
       self.max_retry_times=max_retry_times
       self.generate_retry_times=generate_retry_times
+      self.worker_id=worker_id
+      self.task_sql=task_sql if task_sql is not None else TaskSQL()
     def __call__(self,future:Future[tuple[int,None|str]]):
       # 添加调试日志，确认回调函数被调用
       simple_log.log(f'Callback started for task {self.package["id"]}', log_path=self.logging_path)
       if future.cancelled():
         simple_log.log(f'Task {self.package["id"]} was cancelled', log_path=self.logging_path)
         return
+      elif self.deadline is not None and not self.deadline.finish():
+        simple_log.log(f'Ignoring late result of task {self.package["id"]}, it already timed out', log_path=self.logging_path)
+        return
       else:
         try:
           result = future.result()
@@ -194,135 +1056,258 @@ class main_thread:
           return
         index = result[0]
         msg = result[1]
+        # 第三个返回值为产物路径(缓存命中时为放到输出目录中的路径), 开启record_artifacts时随成功状态写回
+        artifact_path = result[2] if len(result) > 2 else None
+        if self.writer is not None:
+          self.write_future = self.writer.submit(index,msg,artifact_path)
+          return
         #没有错误信息直接将任务标识为成功结束
         if msg is None:
           state = 2
-          sql = 'update text_to_video_tasks set state = %s, progress = 100 , description = %s where id = %s'
-          args = (state, "success", index)
-          try:
-            conn = self.dbpool.get_connection()
+          sql = self.task_sql.success_update(1,self.worker_id is not None)
+          args = self.task_sql.success_args([(index,artifact_path)],self.worker_id)
+          # 获取连接失败时没有需要放回的连接, 由dbpool.connection()保证只放回借出的连接
+          with self.dbpool.connection() as conn:
             with conn.cursor() as cursor:
               res = retry_execute(cursor, self.logging_path, sql, args, self.max_retry_times)
               if res == False:
-                if conn: 
-                  conn.rollback()
                 raise Exception('Error in callback:retry_execute(sql,args) for updating state to 2')
               else:
                 conn.commit()
                 simple_log.log(f'Successfully updated task {self.package["id"]} state to {state}', log_path=self.logging_path)
-          finally:
-            self.dbpool.put_connection(conn)
         else:
-          #任务有错误信息, 检查重试次数
-          sql1 = 'select retry_times from text_to_video_tasks where id = %s'
-          args1 = (index,)
-          try:
-            conn = self.dbpool.get_connection()
-            #查询重试次数
+          #任务有错误信息, 由一条UPDATE在服务端决定重新排队(state=0, retry_times+1)或最终失败(state=3)
+          sql,args = self.task_sql.failure_update([(index,msg)],self.generate_retry_times,self.worker_id)
+          with self.dbpool.connection() as conn:
             with conn.cursor() as cursor:
-              res = retry_execute(cursor, self.logging_path, sql1, args1, self.max_retry_times)
+              res = retry_execute(cursor, self.logging_path, sql, args, self.max_retry_times)
               if res == False:
-                simple_log.log(f'Error in task{index} for querying retry_times',log_path=self.logging_path)
-                raise Exception('Error in task{index} for querying retry_times')
-              times = cursor.fetchone()['retry_times']
-              #重试次数小于最大重试次数
-              if times < self.generate_retry_times:
-                #将状态重置为0并重试次数加1
-                sql2 = 'update text_to_video_tasks set state = 0, retry_times = %s where id = %s'
-                args2 =(times+1,index)
-                state2 = retry_execute(cursor, self.logging_path,sql2,args2,self.max_retry_times)
-                if state2 == False:
-                  if conn:
-                    conn.rollback()
-                  raise Exception('Error in task{index} for updating state to 0 and retry_times + 1')
-                else:
-                  conn.commit()
-                  simple_log.log(f'Successfully updated task {self.package["id"]} state to 0 and retry_times + 1', log_path=self.logging_path)
+                raise Exception(f'Error in task{index} for updating failed task state')
               else:
-                #重试次数大于等于最大重试次数, 将状态设置为错误
-                sql3 = 'update text_to_video_tasks set state = 3, progress=100, description = %s where id = %s'
-                args3 = (msg+" -> task failed, retry times >= max_retry_times",index)
-                state3 = retry_execute(cursor=cursor,logging_path=self.logging_path,sql=sql3,args=args3,max_retry_times=self.max_retry_times)
-                if state3 == False:
-                  if conn:
-                    conn.rollback()
-                  raise Exception('Error in task{index} for updating state to 3')
-                else:
-                  conn.commit()
-                  simple_log.log(f'Successfully updated task {self.package["id"]} state to 3, description: {msg+" -> task failed, retry times >= max_retry_times"}', log_path=self.logging_path)
-          finally:
-            self.dbpool.put_connection(conn)
-            
+                conn.commit()
+                simple_log.log(f'Successfully recorded failure of task {self.package["id"]}: {msg}', log_path=self.logging_path)
 
   def add_output_path(self,args:dict[str,any]):
     pass
 
+  def build_args(self,row:dict)->dict[str,any]:
+    '''
+    由领取到的行生成传给self.func的参数字典
+    '''
+    args = {'id':row['id'],'task_uuid':row['task_uuid'],'prompt':row['prompt'],'width':row['width'],'height':row['height'],'text_to_video_pack_id':row['text_to_video_pack_id']}
+    self.add_output_path(args)
+    return args
+
+  def submit_row(self,executor:Executor,row:dict)->Future:
+    '''
+    提交一条已领取的任务, 登记在途名额并注册写库回调与名额释放回调
+    批量模式下任务先进入攒批分组, 由flush_batches整批提交, 返回的是该任务自己的Future
+    '''
+    args = self.build_args(row)
+    deadline = self.task_deadline(row)
+    future = None
+    if self.result_cache is not None and self.batcher is None:
+      # 命中缓存时放置产物的文件操作在slot_cond之外完成, 不阻塞其他任务的名额释放
+      future = self.cached_future(args)
+
+    # 提交任务到线程池
+    with self.slot_cond:
+      if self.batcher is not None:
+        item = BatchItem(row,args,deadline)
+        self.batcher.add(item)
+        future = item.future
+      elif future is None:
+        future = self.submit_task(executor,args,deadline,lookup=False)
+      self.in_flight[args['id']] = future
+      if 'user_id' in row:
+        self.in_flight_user[args['id']] = row['user_id']
+      if deadline is not None:
+        self.deadlines[args['id']] = deadline
+
+    # 添加回调函数
+    callback_obj = main_thread.callback(args,self.dbpool,self.logging_path,self.max_retry_times,self.generate_retry_times,self.claim_worker_id(),self.writer,self.task_sql,deadline)
+    future.add_done_callback(callback_obj)
+    future.add_done_callback(main_thread.release_slot(self,row))
+
+    simple_log.log(f'Submitted task {args["id"]} to thread pool', log_path=self.logging_path)
+    return future
+
+  def batch_arg(self,items:list[BatchItem]):
+    '''
+    传给func_batch的第二个参数: pass_context时为与任务一一对应的TaskContext列表, 否则为连接池
+    '''
+    if self.pass_context:
+      return [TaskContext(item.args['id'],self.dbpool,self.reporter,item.deadline,self.get_worker_state) for item in items]
+    return self.dbpool
+
+  def run_batch(self,items:list[BatchItem]):
+    '''
+    在线程池中执行一批任务; 已被drain取消的任务不再执行, 其余任务的Future在调用func_batch前置为运行中
+    '''
+    live = [item for item in items if item.future.set_running_or_notify_cancel()]
+    if not live:
+      return
+    try:
+      results = self.func_batch([item.args for item in live],self.batch_arg(live))
+    except Exception as e:
+      simple_log.log(f'Error in func_batch for tasks {[item.args["id"] for item in live]}: {str(e)}', log_path=self.logging_path)
+      fan_out(live,None,e)
+      return
+    fan_out(live,results)
+
+  def batch_done(self,items:list[BatchItem],group:Future):
+    if group.cancelled():
+      fan_out(items,None,CancelledError('batch was cancelled'))
+    elif group.exception() is not None:
+      fan_out(items,None,group.exception())
+    else:
+      fan_out(items,group.result())
+
+  def submit_batch(self,executor:Executor,items:list[BatchItem]):
+    '''
+    process模式下Future不能传给子进程, 提交时即置为运行中, 由父进程中的完成回调分发结果
+    '''
+    self.metrics.observe('batch_size',len(items))
+    if self.executor_mode == 'process':
+      live = [item for item in items if item.future.set_running_or_notify_cancel()]
+      if live:
+        group = executor.submit(process_worker.run_batch,self.func_batch,[item.args for item in live])
+        group.add_done_callback(lambda group,live=live:self.batch_done(live,group))
+      return
+    executor.submit(self.run_batch,items)
+
+  def flush_batches(self,executor:Executor,force:bool=False)->int:
+    '''
+    提交已满或等待超时的批次, 返回提交的批次数
+    '''
+    if self.batcher is None:
+      return 0
+    batches = self.batcher.ready(force)
+    for items in batches:
+      self.submit_batch(executor,items)
+    return len(batches)
+
+  def batch_timeout(self,timeout:float)->float:
+    '''
+    有未满的批次时, 等待时间不超过它的剩余攒批时间
+    '''
+    if self.batcher is None:
+      return timeout
+    remaining = self.batcher.time_to_next()
+    return timeout if remaining is None else min(timeout,remaining)
+
   def run(self, slice_size:int=10,max_workers:int=10):
     '''
     查找数据库中status为0的记录, 每一条记录都开一个线程处理, 线程数不够则等待
+    每次只领取空闲的在途名额数量(不超过slice_size), 避免任务在线程池队列中长时间积压
     '''
+    budget = self.in_flight_budget(max_workers)
+    self.running = True
+    self.run_thread = threading.current_thread()
+    self.stopped.clear()
+    previous_handlers = self.install_signal_handlers()
+    executor = None
     try:
-      with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        times = 0 #测试语句, 正式调试时删除
-        while True:
-          self.init_process(max_workers=max_workers) #初始化进程, 在最新版本main_thread_cfg_init中, 函数依照is_init值决定是否执行, 并保证在服务器开启后只执行一次
-          print('times:',times) #测试语句, 正式调试时删除
-          times += 1 #测试语句, 正式调试时删除
-          if self.status == False:
+      self.start_lease_thread()
+      self.start_writer()
+      self.start_reporter()
+      self.start_watchdog()
+      self.start_metrics_logger()
+      executor = self.create_executor(max_workers)
+      self.executor = executor
+      times = 0 #测试语句, 正式调试时删除
+      while True:
+        self.init_process(max_workers=max_workers) #初始化进程, 在最新版本main_thread_cfg_init中, 函数依照is_init值决定是否执行, 并保证在服务器开启后只执行一次
+        print('times:',times) #测试语句, 正式调试时删除
+        times += 1 #测试语句, 正式调试时删除
+        if self.status == False:
+          break
+        try:
+          self.scheduler.maintain(self.dbpool)
+        except Exception as e:
+          simple_log.log(f'Error in scheduler maintenance: {str(e)}', log_path=self.logging_path)
+        self.flush_batches(executor)
+        free_slots = self.wait_for_slots(budget,self.batch_timeout(1.0))
+        if free_slots <= 0:
+          continue
+        if self.prefetch_high_watermark > 0:
+          # 预取模式: 领取由后台线程完成, 这里只从就绪队列取出空闲名额数量的任务
+          self.start_prefetcher(slice_size)
+          ready = self.wait_for_ready(self.batch_timeout(1.0))
+          if self.submit_ready(executor,free_slots) == 0 and ready > 0:
+            # 队首任务超出剩余预算, 等待在途任务释放资源
+            with self.slot_cond:
+              if self.status:
+                self.slot_cond.wait(timeout=self.batch_timeout(1.0))
+          self.flush_batches(executor)
+          continue
+        print('before fetch_status0, times:',times) #测试语句, 正式调试时删除
+        want = self.claim_size(min(slice_size,free_slots)-self.queue.qsize())
+        idlist = self.fetch_status0(want) if want > 0 else [] #每次获取10条数据, 进行测试, 正式调试传入1024
+
+        #捕获数据后, 返回全部行数据的id, 用于更新进度条
+        print('idlist:',idlist) #测试语句, 正式调试时删除
+        if self.queue.empty():
+          print('queue is empty, times:',times) #测试语句, 正式调试时删除
+        self.idle_wait(len(idlist) > 0)
+
+        print('after fetch_status0, times:',times) #测试语句, 正式调试时删除
+        futures = []  # 存储所有的Future对象
+        while not self.queue.empty():
+          print('into cycle, times:',times) #测试语句, 正式调试时删除
+          '''
+          对queue中的每一行, 开一个线程处理
+          在处理结束后将queue中的行状态改为2
+          '''
+          '''
+          self.func接收参数为字典, 字典内容为{'id','task_uuid','prompt','width','height','text_to_video_pack_id'}
+          '''
+          row = self.next_admitted_row()
+          if row is None:
+            # 队首任务超出剩余预算, 留在就绪队列中等待在途任务释放资源
             break
-          print('before fetch_status0, times:',times) #测试语句, 正式调试时删除
-          idlist = self.fetch_status0(slice_size) #每次获取10条数据, 进行测试, 正式调试传入1024
-
-          #捕获数据后, 返回全部行数据的id, 用于更新进度条
-          print('idlist:',idlist) #测试语句, 正式调试时删除
-          if self.queue.empty():
-            print('queue is empty, times:',times) #测试语句, 正式调试时删除
-
-          print('after fetch_status0, times:',times) #测试语句, 正式调试时删除
-          futures = []  # 存储所有的Future对象
-          while not self.queue.empty():
-            print('into cycle, times:',times) #测试语句, 正式调试时删除
-            '''
-            对queue中的每一行, 开一个线程处理
-            在处理结束后将queue中的行状态改为2
-            '''
-            '''
-            self.func接收参数为字典, 字典内容为{'id','task_uuid','prompt','width','height','text_to_video_pack_id'}
-            '''
-            row = self.queue.get()
-            args = {'id':row['id'],'task_uuid':row['task_uuid'],'prompt':row['prompt'],'width':row['width'],'height':row['height'],'text_to_video_pack_id':row['text_to_video_pack_id']}
-            self.add_output_path(args)
-
-            # 提交任务到线程池
-            future = executor.submit(self.func,args,self.dbpool)
-            futures.append(future)  # 保存Future对象
-
-            # 添加回调函数
-            callback_obj = main_thread.callback(args,self.dbpool,self.logging_path,self.max_retry_times,self.generate_retry_times)
-            future.add_done_callback(callback_obj)
-
-            simple_log.log(f'Submitted task {args["id"]} to thread pool', log_path=self.logging_path)
-
-          # 等待所有任务完成（可选，用于调试）
-          if futures:
-            simple_log.log(f'Waiting for {len(futures)} tasks to complete', log_path=self.logging_path)
-            # 注意：这里不等待完成，让任务在后台运行
-            # 如果需要等待，可以取消注释下面这行
-            # executor.shutdown(wait=True)
-          print('queue size:',self.queue.qsize()) #测试语句, 正式调试时删除
+          future = self.submit_row(executor,row)
+          futures.append(future)  # 保存Future对象
+        self.flush_batches(executor)
+
+        # 等待所有任务完成（可选，用于调试）
+        if futures:
+          simple_log.log(f'Waiting for {len(futures)} tasks to complete', log_path=self.logging_path)
+          # 注意：这里不等待完成，让任务在后台运行
+          # 如果需要等待，可以取消注释下面这行
+          # executor.shutdown(wait=True)
+        print('queue size:',self.queue.qsize()) #测试语句, 正式调试时删除
     finally:
-      self.close()
+      try:
+        self.stop_prefetcher()
+        if executor is not None:
+          self.drain(executor)
+          self.teardown_workers()
+          if self.result_cache is not None:
+            self.result_cache.close()
+      finally:
+        self.restore_signal_handlers(previous_handlers)
+        self.stop_watchdog()
+        self.stop_reporter()
+        self.stop_writer()
+        self.stop_lease_thread()
+        self.stop_metrics_logger()
+        self.close()
+        self.running = False
+        self.stopped.set()
 
 class main_thread_with_config(main_thread):
-  def __init__(self,func:Callable,path_config:str,dbpool_get:Callable=DBpool.get_DBpool):
+  def __init__(self,func:Callable,path_config:str,dbpool_get:Callable=DBpool.get_DBpool,func_batch:Callable|None=None,worker_init:Callable|None=None,worker_teardown:Callable|None=None):
     '''
     传入config.json文件路径, 读取配置文件, 并初始化main_thread
+    func_batch: 批量模式的任务函数, 见main_thread
+    worker_init, worker_teardown: 每个工作线程的初始化与清理函数, 见main_thread
     '''
     self.path_config = path_config
     self.config = read_config.read_config(path_config)
     if self.config is None:
       raise RuntimeError('Failed to load config')
-    super().__init__(func=func,host=self.config['host'],port=self.config['port'],user=self.config['user'],password=self.config['password'],db=self.config['db'],max_connections=self.config['max_connections'],logging_path=self.config['log_path'],max_retry_times=self.config['max_retry_times'],generate_retry_times=self.config['generate_retry_times'],heart_beat_interval=self.config['heart_beat_interval'],dbpool_get=dbpool_get,time_overflow_seconds=self.config['time_overflow_seconds'])
+    super().__init__(func=func,host=self.config['host'],port=self.config['port'],user=self.config['user'],password=self.config['password'],db=self.config['db'],max_connections=self.config['max_connections'],logging_path=self.config['log_path'],max_retry_times=self.config['max_retry_times'],generate_retry_times=self.config['generate_retry_times'],heart_beat_interval=self.config['heart_beat_interval'],dbpool_get=dbpool_get,time_overflow_seconds=self.config['time_overflow_seconds'],claim_mode=self.config.get('claim_mode','legacy'),worker_id=self.config.get('worker_id'),max_in_flight=self.config.get('max_in_flight'),prefetch_margin=self.config.get('prefetch_margin',2),poll_min_interval=self.config.get('poll_min_interval',0.2),poll_max_interval=self.config.get('poll_max_interval',5.0),reap_interval=self.config.get('reap_interval',60),reap_batch_size=self.config.get('reap_batch_size',100),completion_batch_size=self.config.get('completion_batch_size',64),completion_flush_interval=self.config.get('completion_flush_interval',0.2),table_name=self.config.get('table_name'),fields=self.config.get('fields'),schedule_mode=self.config.get('schedule_mode','fifo'),max_per_user=self.config.get('max_per_user',0),priority_lanes=self.config.get('priority_lanes'),priority_aging_interval=self.config.get('priority_aging_interval',300),priority_aging_step=self.config.get('priority_aging_step',1),executor_mode=self.config.get('executor_mode','thread'),process_db_connections=self.config.get('process_db_connections',1),pass_context=self.config.get('pass_context',False),progress_flush_interval=self.config.get('progress_flush_interval',1.0),shutdown_timeout=self.config.get('shutdown_timeout',30),handle_signals=self.config.get('handle_signals',True),retry_backoff_base=self.config.get('retry_backoff_base',0),retry_backoff_max=self.config.get('retry_backoff_max',600),retry_backoff_jitter=self.config.get('retry_backoff_jitter',0.2),enforce_deadlines=self.config.get('enforce_deadlines',False),per_task_deadlines=self.config.get('per_task_deadlines',False),deadline_check_interval=self.config.get('deadline_check_interval',1.0),prefetch_high_watermark=self.config.get('prefetch_high_watermark',0),prefetch_low_watermark=self.config.get('prefetch_low_watermark'),admission_budgets=self.config.get('admission_budgets'),admission_costs=self.config.get('admission_costs'),func_batch=func_batch,batch_key=self.config.get('batch_key'),batch_max_size=self.config.get('batch_max_size',8),batch_max_wait=self.config.get('batch_max_wait',0.5),worker_init=worker_init,worker_teardown=worker_teardown,result_cache_dir=os.path.join(self.config['output_path'],'.result_cache') if self.config.get('result_cache',False) else None,result_cache_max_bytes=self.config.get('result_cache_max_bytes',10*1024**3),result_cache_max_entries=self.config.get('result_cache_max_entries',10000),pool_options=self.config.get('pool_options'),record_artifacts=self.config.get('record_artifacts',False),metrics_log_interval=self.config.get('metrics_log_interval',60),max_replacement_workers=self.config.get('max_replacement_workers'))
     self.output_path = self.config['output_path']
     # self.generate_retry_times = self.config['generate_retry_times']
     # 测试语句, 正式调试时删除
@@ -332,72 +1317,73 @@ class main_thread_with_config(main_thread):
     print('generate_retry_times: ',self.generate_retry_times)
     print('heart_beat_interval: ',self.heart_beat_interval)
     print('time_overflow_seconds: ',self.time_overflow_seconds)
+    simple_log.log(f'Scheduler started with claim_mode={self.claim_mode}, worker_id={self.worker_id}', log_path=self.logging_path)
   def add_output_path(self,args:dict[str,any]):
     args['output_path'] = self.output_path
 
 class main_thread_cfg_init(main_thread_with_config):
-  def __init__(self,func:Callable,path_config:str,dbpool_get:Callable=DBpool.get_DBpool):
+  def __init__(self,func:Callable,path_config:str,dbpool_get:Callable=DBpool.get_DBpool,func_batch:Callable|None=None,worker_init:Callable|None=None,worker_teardown:Callable|None=None):
     self.__is_init = True
-    super().__init__(func=func,path_config=path_config,dbpool_get=dbpool_get)
+    super().__init__(func=func,path_config=path_config,dbpool_get=dbpool_get,func_batch=func_batch,worker_init=worker_init,worker_teardown=worker_teardown)
 
   #确实可以在开始时将全部未完成任务状态转回为0, 但是无法保证在run过程中不会出现新的未完成任务
   def init_process(self,max_workers:int=10):
     '''
     在服务器启动时, 只负责将未完成任务的状态转回为0, 接下来交给run处理
     本函数只在初始状态执行一次
+    skip_locked模式下可能有多个实例同时运行, 只回收worker_id与本实例相同的任务(需在配置中固定worker_id)
     '''
     if self.__is_init == False:
       return
     else:
       print('start init_process')
       self.__is_init = False
-      conn = self.dbpool.get_connection()
       try:
-        with conn.cursor() as cursor:
-          #测试语句 - 查看更新前的状态
-          sql = 'select id from text_to_video_tasks where state = 1'
-          res=retry_execute(cursor,self.logging_path,sql,None,self.max_retry_times)
-          print('res:',res)
-          if res == False:
-            raise Exception('Error in init_process:retry_execute(sql,args) for finding rows with state=1')
-
-          state_1_ids = [row['id'] for row in cursor.fetchall()]
-          print('\nstate_1_ids size:\n',len(state_1_ids),'\nstate_1_ids:\n',state_1_ids)
-          print('**************************************************************************')
-          # update语句中最好不要嵌套子查询, 否则会报错
-          if len(state_1_ids) > 0:
-            # 使用IN子句进行更新
-            placeholders = ','.join(['%s'] * len(state_1_ids))
-            sql = f'update text_to_video_tasks set state = 0 where id in ({placeholders})'
-            args = tuple(state_1_ids)
-            res = retry_execute(cursor,self.logging_path,sql,args,self.max_retry_times)
-            conn.commit()
+        with self.dbpool.connection() as conn:
+          with conn.cursor() as cursor:
+            #测试语句 - 查看更新前的状态
+            owned = self.claim_worker_id() is not None
+            owner_args = (self.claim_worker_id(),) if owned else ()
+            sql = self.task_sql.select_claimed(owned)
+            res=retry_execute(cursor,self.logging_path,sql,owner_args or None,self.max_retry_times)
             print('res:',res)
             if res == False:
-              conn.rollback()
-              print('Error in init_process:retry_execute(sql,args) for updating state to 0')
-              raise Exception('Error in init_process:retry_execute(sql,args) for updating state to 0')
-            affected_rows = cursor.rowcount
-            print(f'update success, affected rows: {affected_rows}')
-          else:
-            print('no rows with state=1 to update')
-
-          #测试语句 - 查看更新后的状态
-          test_list = []
-          sql = 'select id from text_to_video_tasks where state = 1'
-          res = retry_execute(cursor,self.logging_path,sql,None,self.max_retry_times)
-          if res == False:
-            raise Exception('Error in init_process:retry_execute(sql,args) for finding rows with state=1')
-          else:
-            test_list = list(cursor.fetchall())
-          print('test_list: (after update)\n',test_list)
+              raise Exception('Error in init_process:retry_execute(sql,args) for finding rows with state=1')
+
+            state_1_ids = [row['id'] for row in cursor.fetchall()]
+            print('\nstate_1_ids size:\n',len(state_1_ids),'\nstate_1_ids:\n',state_1_ids)
+            print('**************************************************************************')
+            # update语句中最好不要嵌套子查询, 否则会报错
+            if len(state_1_ids) > 0:
+              # 使用IN子句进行更新
+              sql = self.task_sql.release_claimed(len(state_1_ids),owned)
+              args = tuple(state_1_ids)+owner_args
+              res = retry_execute(cursor,self.logging_path,sql,args,self.max_retry_times)
+              conn.commit()
+              print('res:',res)
+              if res == False:
+                conn.rollback()
+                print('Error in init_process:retry_execute(sql,args) for updating state to 0')
+                raise Exception('Error in init_process:retry_execute(sql,args) for updating state to 0')
+              affected_rows = cursor.rowcount
+              print(f'update success, affected rows: {affected_rows}')
+            else:
+              print('no rows with state=1 to update')
+
+            #测试语句 - 查看更新后的状态
+            test_list = []
+            sql = self.task_sql.select_claimed(owned)
+            res = retry_execute(cursor,self.logging_path,sql,owner_args or None,self.max_retry_times)
+            if res == False:
+              raise Exception('Error in init_process:retry_execute(sql,args) for finding rows with state=1')
+            else:
+              test_list = list(cursor.fetchall())
+            print('test_list: (after update)\n',test_list)
 
       except Exception as e:
         print(f'init_process failed: {str(e)}')
         simple_log.log(str(e)+' init_process failed',log_path=self.logging_path)
-      finally:
-        self.dbpool.put_connection(conn)
 
 class main_thread_TimedRenew(main_thread_cfg_init):
-  def __init__(self,func:Callable,path_config:str,dbpool_get:Callable=DBpool.get_DBpoolRenew):
-    super().__init__(func=func,path_config=path_config,dbpool_get=dbpool_get)
\ No newline at end of file
+  def __init__(self,func:Callable,path_config:str,dbpool_get:Callable=DBpool.get_DBpoolRenew,func_batch:Callable|None=None,worker_init:Callable|None=None,worker_teardown:Callable|None=None):
+    super().__init__(func=func,path_config=path_config,dbpool_get=dbpool_get,func_batch=func_batch,worker_init=worker_init,worker_teardown=worker_teardown)
\ No newline at end of file
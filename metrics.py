@@ -0,0 +1,82 @@
+import threading
+import bisect
+
+# 默认的直方图分桶(单位: 秒)
+DEFAULT_BUCKETS = (0.001,0.005,0.01,0.05,0.1,0.5,1,5,10,60)
+
+class Histogram:
+  '''
+  分桶计数的直方图, counts[i]为落在(buckets[i-1],buckets[i]]中的样本数, 最后一个桶为+inf
+  '''
+  def __init__(self,buckets:tuple=DEFAULT_BUCKETS):
+    self.buckets = tuple(sorted(buckets))
+    self.counts = [0]*(len(self.buckets)+1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def observe(self,value:float):
+    self.counts[bisect.bisect_left(self.buckets,value)] += 1
+    self.count += 1
+    self.sum += value
+    if value > self.max:
+      self.max = value
+
+  def quantile(self,q:float)->float:
+    '''
+    按分桶估算分位数, 返回分位数所在桶的上界(落在+inf桶时返回最大值)
+    '''
+    if self.count == 0:
+      return 0.0
+    rank = q*self.count
+    seen = 0
+    for i,c in enumerate(self.counts):
+      seen += c
+      if seen >= rank and c > 0:
+        return self.buckets[i] if i < len(self.buckets) else self.max
+    return self.max
+
+  def to_dict(self)->dict:
+    return {
+      'count':self.count,
+      'sum':self.sum,
+      'max':self.max,
+      'p50':self.quantile(0.5),
+      'p99':self.quantile(0.99),
+      'buckets':dict(zip([str(b) for b in self.buckets]+['+inf'],self.counts)),
+    }
+
+class Metrics:
+  '''
+  进程内的简单指标收集: 计数器, 瞬时值(gauge), 直方图
+  所有方法线程安全, snapshot()返回当前全部指标的副本, 可直接打印或写入日志
+  '''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters:dict[str,float] = {}
+    self.gauges:dict[str,float] = {}
+    self.histograms:dict[str,Histogram] = {}
+
+  def incr(self,name:str,value:float=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name,0)+value
+
+  def set_gauge(self,name:str,value:float):
+    with self.lock:
+      self.gauges[name] = value
+
+  def observe(self,name:str,value:float,buckets:tuple=DEFAULT_BUCKETS):
+    with self.lock:
+      hist = self.histograms.get(name)
+      if hist is None:
+        hist = Histogram(buckets)
+        self.histograms[name] = hist
+      hist.observe(value)
+
+  def snapshot(self)->dict:
+    with self.lock:
+      return {
+        'counters':dict(self.counters),
+        'gauges':dict(self.gauges),
+        'histograms':{name:hist.to_dict() for name,hist in self.histograms.items()},
+      }
@@ -0,0 +1,72 @@
+# 进程池模式下在子进程中运行的代码
+# 子进程不能使用父进程的DBpool对象(连接不能跨进程传递), 每个子进程按需创建自己的小连接池
+from typing import Callable
+import multiprocessing.util
+import DBpool
+from progress_reporter import ProgressReporter
+from task_context import TaskContext
+
+# 子进程内的全局状态, 由init_worker设置
+_pool_args:dict|None = None
+_dbpool:DBpool.DBpool|None = None
+_context_args:dict|None = None
+_reporter:ProgressReporter|None = None
+_worker_state = None
+
+def init_worker(pool_args:dict|None,context_args:dict|None=None,worker_init:Callable|None=None,worker_teardown:Callable|None=None):
+  '''
+  ProcessPoolExecutor的initializer, 在每个子进程启动时执行一次
+  pool_args: 创建子进程连接池的参数(DBpool.__init__的关键字参数), 为None时任务函数收到的dbpool为None
+  context_args: 不为None时任务函数收到TaskContext, 其中为子进程ProgressReporter的参数(ProgressReporter.__init__中dbpool以外的关键字参数)
+  worker_init, worker_teardown: 子进程启动时执行worker_init(), 返回值通过TaskContext.worker_state传给任务函数, 子进程退出时执行worker_teardown(state)
+  '''
+  global _pool_args, _dbpool, _context_args, _reporter, _worker_state
+  _pool_args = pool_args
+  _dbpool = None
+  _context_args = context_args
+  _reporter = None
+  _worker_state = None
+  if worker_init is not None:
+    _worker_state = worker_init()
+    if worker_teardown is not None:
+      multiprocessing.util.Finalize(None,worker_teardown,args=(_worker_state,),exitpriority=20)
+
+def get_worker_state():
+  return _worker_state
+
+def get_dbpool()->DBpool.DBpool|None:
+  '''
+  第一次使用时才建立连接, 不访问数据库的任务函数不会占用连接
+  '''
+  global _dbpool
+  if _dbpool is None and _pool_args is not None:
+    _dbpool = DBpool.DBpool(**_pool_args)
+  return _dbpool
+
+def get_reporter()->ProgressReporter|None:
+  '''
+  子进程自己的进度写入器, 进程退出时写回剩余的进度
+  '''
+  global _reporter
+  if _reporter is None and _context_args is not None and get_dbpool() is not None:
+    _reporter = ProgressReporter(get_dbpool(),**_context_args)
+    _reporter.start()
+    multiprocessing.util.Finalize(None,_reporter.close,exitpriority=10)
+  return _reporter
+
+def run_task(func:Callable,args:dict)->tuple[int,None|str]:
+  '''
+  在子进程中执行任务函数, 返回值通过pickle传回父进程, 由父进程中的回调写库
+  func必须是模块级函数, args中的值必须可以pickle
+  '''
+  if _context_args is not None:
+    return func(args,TaskContext(args['id'],get_dbpool(),get_reporter(),state_getter=get_worker_state))
+  return func(args,get_dbpool())
+
+def run_batch(func_batch:Callable,args_list:list[dict])->list[tuple[int,None|str]]:
+  '''
+  批量模式下在子进程中执行一批任务, 返回值由父进程按id分发给各任务的回调
+  '''
+  if _context_args is not None:
+    return func_batch(args_list,[TaskContext(args['id'],get_dbpool(),get_reporter(),state_getter=get_worker_state) for args in args_list])
+  return func_batch(args_list,get_dbpool())
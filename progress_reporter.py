@@ -0,0 +1,90 @@
+import threading
+import traceback
+import simple_log
+import metrics
+from db_retry import retry_execute
+from task_sql import TaskSQL
+
+class ProgressReporter:
+  '''
+  任务进度的合并写入器
+  report()只在内存中记录每个任务的最新进度, 后台线程每隔flush_interval秒把有变化的任务用一条CASE语句写回,
+  无论有多少任务在执行, 每秒的进度写库次数都有上限; 只更新state=1(仍在执行)的任务, 不会覆盖已完成任务的进度
+  '''
+  def __init__(self,dbpool,logging_path:str,task_sql:TaskSQL|None=None,flush_interval:float=1.0,max_retry_times:int=5,worker_id:str|None=None,max_batch:int=500,metrics_obj:metrics.Metrics|None=None):
+    self.dbpool = dbpool
+    self.logging_path = logging_path
+    self.task_sql = task_sql if task_sql is not None else TaskSQL()
+    self.flush_interval = flush_interval
+    self.max_retry_times = max_retry_times
+    self.worker_id = worker_id
+    self.max_batch = max(1,max_batch)
+    self.metrics = metrics_obj if metrics_obj is not None else metrics.Metrics()
+    self.lock = threading.Lock()
+    # 有变化但尚未写回的进度, id -> progress
+    self.dirty:dict[int,int] = {}
+    self.stop_event = threading.Event()
+    self.thread:threading.Thread|None = None
+
+  def report(self,task_id:int,progress:int|float):
+    progress = int(max(0,min(100,progress)))
+    with self.lock:
+      self.dirty[task_id] = progress
+
+  def start(self):
+    if self.thread is None:
+      self.stop_event.clear()
+      self.thread = threading.Thread(target=self.flush_loop,name='progress_reporter',daemon=True)
+      self.thread.start()
+
+  def close(self):
+    '''
+    停止后台线程并写回剩余的进度
+    '''
+    self.stop_event.set()
+    if self.thread is not None:
+      self.thread.join()
+      self.thread = None
+    self.flush()
+
+  def flush_loop(self):
+    while not self.stop_event.wait(timeout=self.flush_interval):
+      try:
+        self.flush()
+      except Exception as e:
+        simple_log.log(traceback.format_exc()+'\n-> Error in ProgressReporter.flush',log_path=self.logging_path)
+
+  def flush(self)->int:
+    with self.lock:
+      dirty = self.dirty
+      self.dirty = {}
+    if not dirty:
+      return 0
+    items = list(dirty.items())
+    conn = self.dbpool.get_connection()
+    try:
+      with conn.cursor() as cursor:
+        for i in range(0,len(items),self.max_batch):
+          batch = items[i:i+self.max_batch]
+          sql = self.task_sql.progress_update(len(batch),self.worker_id is not None)
+          args = tuple(value for item in batch for value in item)+tuple(task_id for task_id,_ in batch)
+          if self.worker_id is not None:
+            args += (self.worker_id,)
+          if retry_execute(cursor,self.logging_path,sql,args,self.max_retry_times) == False:
+            raise Exception('Error in ProgressReporter:retry_execute(sql,args) for updating progress')
+      conn.commit()
+    except Exception as e:
+      try:
+        conn.rollback()
+      except:
+        pass
+      # 写入失败时放回未写入的进度, 已有更新的值优先
+      with self.lock:
+        for task_id,progress in items:
+          self.dirty.setdefault(task_id,progress)
+      raise e
+    finally:
+      self.dbpool.put_connection(conn)
+    self.metrics.incr('progress_flushes')
+    self.metrics.incr('progress_rows',len(items))
+    return len(items)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import unicodedata
+import simple_log
+
+INDEX_FILE = 'index.json'
+
+def cache_key(args:dict)->str:
+  '''
+  由(prompt, width, height, text_to_video_pack_id)计算缓存键: prompt按NFC规范化并合并空白, 其余字段按原值参与哈希
+  '''
+  prompt = unicodedata.normalize('NFC',' '.join(str(args.get('prompt') or '').split()))
+  payload = json.dumps([prompt,args.get('width'),args.get('height'),args.get('text_to_video_pack_id')],ensure_ascii=False)
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+  '''
+  以内容哈希为键的生成结果缓存, 保存在root目录下(一般为output_path下的子目录)
+  每个键对应一个产物文件, index.json记录文件名、大小与最近使用时间, 总大小超过max_bytes或条目数超过max_entries时按最近最少使用淘汰
+  命中时把缓存的产物硬链接(不支持时复制)到任务的输出目录
+  '''
+  def __init__(self,root:str,max_bytes:int=10*1024**3,max_entries:int=10000,logging_path:str='./log.txt'):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    self.logging_path = logging_path
+    self.lock = threading.Lock()
+    # key -> {'file':文件名, 'size':字节数, 'last_used':时间戳}
+    self.entries:dict[str,dict] = {}
+    os.makedirs(self.root,exist_ok=True)
+    self.load()
+
+  def load(self):
+    path = os.path.join(self.root,INDEX_FILE)
+    if not os.path.exists(path):
+      return
+    try:
+      with open(path,'r',encoding='utf-8') as f:
+        entries = json.load(f)
+    except Exception as e:
+      simple_log.log(f'Error in ResultCache.load, starting with an empty index: {str(e)}', log_path=self.logging_path)
+      return
+    # 丢弃文件已不存在的条目
+    self.entries = {key:entry for key,entry in entries.items() if os.path.exists(os.path.join(self.root,entry['file']))}
+
+  def save(self):
+    '''
+    先写临时文件再替换, 进程中途退出时不会留下损坏的索引; 调用方需持有lock
+    '''
+    path = os.path.join(self.root,INDEX_FILE)
+    tmp = path+'.tmp'
+    with open(tmp,'w',encoding='utf-8') as f:
+      json.dump(self.entries,f)
+    os.replace(tmp,path)
+
+  def get(self,key:str)->str|None:
+    '''
+    返回缓存的产物路径, 未命中时返回None
+    '''
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      path = os.path.join(self.root,entry['file'])
+      if not os.path.exists(path):
+        del self.entries[key]
+        return None
+      entry['last_used'] = time.time()
+      return path
+
+  def put(self,key:str,artifact:str)->bool:
+    '''
+    把产物复制到缓存目录并记录索引, 超过max_bytes的单个产物不缓存
+    '''
+    size = os.path.getsize(artifact)
+    if size > self.max_bytes:
+      return False
+    name = key+os.path.splitext(artifact)[1]
+    target = os.path.join(self.root,name)
+    tmp = target+'.tmp'
+    shutil.copyfile(artifact,tmp)
+    os.replace(tmp,target)
+    with self.lock:
+      self.entries[key] = {'file':name,'size':size,'last_used':time.time()}
+      self.evict()
+      self.save()
+    return True
+
+  def evict(self):
+    '''
+    按最近使用时间从旧到新淘汰, 直到总大小与条目数都在上限以内; 调用方需持有lock
+    '''
+    total = sum(entry['size'] for entry in self.entries.values())
+    for key in sorted(self.entries,key=lambda k:self.entries[k]['last_used']):
+      if total <= self.max_bytes and len(self.entries) <= self.max_entries:
+        break
+      entry = self.entries.pop(key)
+      total -= entry['size']
+      try:
+        os.remove(os.path.join(self.root,entry['file']))
+      except FileNotFoundError:
+        pass
+
+  def materialize(self,key:str,dest_dir:str,name:str)->str|None:
+    '''
+    把缓存的产物放到dest_dir/name(扩展名与缓存文件相同), 返回产物路径; 未命中或文件已被淘汰时返回None
+    '''
+    path = self.get(key)
+    if path is None:
+      return None
+    os.makedirs(dest_dir,exist_ok=True)
+    dest = os.path.join(dest_dir,str(name)+os.path.splitext(path)[1])
+    try:
+      if os.path.exists(dest):
+        os.remove(dest)
+      try:
+        os.link(path,dest)
+      except OSError:
+        shutil.copyfile(path,dest)
+    except FileNotFoundError:
+      return None
+    return dest
+
+  def close(self):
+    '''
+    写回命中时更新的最近使用时间
+    '''
+    with self.lock:
+      self.save()
@@ -0,0 +1,209 @@
+from typing import Callable
+from db_retry import retry_execute
+from task_sql import TaskSQL
+
+# 任务调度模式
+# fifo: 按id顺序领取
+# fair: 按user_id轮转领取, 避免单个用户的大量任务阻塞其他用户
+# priority: 按priority字段分为多个通道, 按权重分配领取名额, 等待越久的任务按越高的优先级领取
+SCHEDULE_MODES = ('fifo','fair','priority')
+
+PRIORITY_MIN = -2147483648
+PRIORITY_MAX = 2147483647
+
+# 未配置priority_lanes时使用的默认通道: priority>0的任务占3/4名额
+DEFAULT_PRIORITY_LANES = [
+  {'name':'high','min_priority':1,'weight':3},
+  {'name':'normal','max_priority':0,'weight':1},
+]
+
+class FifoScheduler:
+  '''
+  按id顺序领取state=0的任务
+  '''
+  def __init__(self,task_sql:TaskSQL,logging_path:str,max_retry_times:int=5):
+    self.task_sql = task_sql
+    self.logging_path = logging_path
+    self.max_retry_times = max_retry_times
+
+  def execute(self,cursor,sql:str,args:tuple):
+    if retry_execute(cursor,self.logging_path,sql,args,self.max_retry_times) == False:
+      raise Exception(f'Error in {type(self).__name__}:retry_execute(sql,args) for finding rows with state=0')
+    return list(cursor.fetchall())
+
+  def select(self,cursor,limit:int,skip_locked:bool)->list[dict]:
+    return self.execute(cursor,self.task_sql.claim_select(skip_locked),(limit,))
+
+  def maintain(self,dbpool):
+    '''
+    在领取事务之外执行的周期性维护, 由run()每轮调用, 需要时由子类实现
+    '''
+    pass
+
+class FairShareScheduler(FifoScheduler):
+  '''
+  按user_id轮转领取任务
+  每次领取先用(state, user_id)索引找出有待处理任务的用户(从上次轮转到的用户之后继续, 到末尾后从头开始),
+  再把名额逐个轮流分给这些用户, 每个用户用一条(state, user_id, id)索引查询取自己最早的任务
+  user_id为NULL的任务视为同一个用户, 每轮转一圈参与一次
+  max_per_user: 单个用户在本实例同时执行的任务数上限, 0表示不限制
+  user_load: 返回本实例各用户正在执行的任务数
+  '''
+  def __init__(self,task_sql:TaskSQL,logging_path:str,max_retry_times:int=5,max_per_user:int=0,users_per_claim:int=0,user_load:Callable[[],dict]|None=None):
+    super().__init__(task_sql,logging_path,max_retry_times)
+    self.max_per_user = max_per_user
+    self.users_per_claim = users_per_claim
+    self.user_load = user_load if user_load is not None else dict
+    self.last_user = None
+
+  def pending_users(self,cursor,limit:int)->list:
+    users = []
+    if self.last_user is not None:
+      users = [row['user_id'] for row in self.execute(cursor,self.task_sql.pending_users(True),(self.last_user,limit))]
+    if len(users) < limit:
+      # 轮转到末尾, 从头开始补足
+      for row in self.execute(cursor,self.task_sql.pending_users(False),(limit,)):
+        if row['user_id'] not in users and len(users) < limit:
+          users.append(row['user_id'])
+    return users
+
+  def allocate(self,users:list,limit:int)->dict:
+    '''
+    将limit个名额逐个轮流分给users, 跳过达到max_per_user上限的用户
+    '''
+    load = self.user_load()
+    quotas = {}
+    active = [user for user in users if self.max_per_user <= 0 or load.get(user,0) < self.max_per_user]
+    remaining = limit
+    while remaining > 0 and active:
+      next_active = []
+      for user in active:
+        if remaining <= 0:
+          break
+        quotas[user] = quotas.get(user,0)+1
+        remaining -= 1
+        if self.max_per_user <= 0 or load.get(user,0)+quotas[user] < self.max_per_user:
+          next_active.append(user)
+      active = next_active
+    return quotas
+
+  def select(self,cursor,limit:int,skip_locked:bool)->list[dict]:
+    users = self.pending_users(cursor,self.users_per_claim if self.users_per_claim > 0 else limit)
+    quotas = self.allocate(users,limit)
+    per_user = []
+    for user in users:
+      if quotas.get(user,0) <= 0:
+        continue
+      per_user.append(self.execute(cursor,self.task_sql.claim_select_user(skip_locked),(user,quotas[user])))
+      self.last_user = user if user is not None else self.last_user
+    # 按轮次交错排列, 提交到线程池的顺序也是公平的
+    rows = []
+    for i in range(max((len(r) for r in per_user),default=0)):
+      for r in per_user:
+        if i < len(r):
+          rows.append(r[i])
+    return rows
+
+class PriorityLaneScheduler(FifoScheduler):
+  '''
+  优先级通道调度
+  lanes: [{'name', 'min_priority', 'max_priority', 'weight'}], 按priority字段的闭区间划分通道, 区间缺省为无界
+  每次领取按weight把名额分给各通道(最大余数法), 每个通道一条(state, priority DESC, id)索引查询;
+  某些通道任务不足时, 剩余名额按优先级从高到低补给其他通道
+  老化: 按created_at计算等待时间, 每等待aging_interval秒视为priority提高aging_step, 最高到最高通道的下界,
+  低优先级任务不会被饿死; 老化只在领取时计算, 不修改priority字段, 多个实例也不会让任务更快老化;
+  老化任务只按本通道下界参与竞争: 通道内按有效优先级(老化任务为通道下界)从高到低、同优先级按created_at从早到晚领取,
+  本通道高于下界的任务总是先于老化任务; aging_interval<=0时不老化
+  '''
+  def __init__(self,task_sql:TaskSQL,logging_path:str,max_retry_times:int=5,lanes:list[dict]|None=None,aging_interval:float=300,aging_step:int=1):
+    super().__init__(task_sql,logging_path,max_retry_times)
+    lanes = lanes if lanes else DEFAULT_PRIORITY_LANES
+    self.lanes = []
+    for lane in lanes:
+      low = lane.get('min_priority',PRIORITY_MIN)
+      high = lane.get('max_priority',PRIORITY_MAX)
+      weight = lane.get('weight',1)
+      if low > high or weight <= 0:
+        raise ValueError(f'Invalid priority lane: {lane}')
+      self.lanes.append({'name':lane.get('name',f'{low}-{high}'),'min_priority':low,'max_priority':high,'weight':weight})
+    # 按优先级从高到低排列
+    self.lanes.sort(key=lambda lane:lane['max_priority'],reverse=True)
+    self.aging_interval = aging_interval
+    self.aging_step = aging_step
+
+  def shares(self,limit:int)->list[int]:
+    total = sum(lane['weight'] for lane in self.lanes)
+    exact = [limit*lane['weight']/total for lane in self.lanes]
+    shares = [int(x) for x in exact]
+    order = sorted(range(len(exact)),key=lambda i:exact[i]-shares[i],reverse=True)
+    for i in order[:limit-sum(shares)]:
+      shares[i] += 1
+    return shares
+
+  def select_lane(self,cursor,lane:dict,limit:int,skip_locked:bool)->list[dict]:
+    return self.execute(cursor,self.task_sql.claim_select_lane(skip_locked),(lane['min_priority'],lane['max_priority'],limit))
+
+  def select_aged(self,cursor,lane:dict,limit:int,skip_locked:bool)->list[dict]:
+    '''
+    优先级低于本通道、但等待时间已足够老化到本通道下界的任务; 不老化或本通道之下没有优先级时返回空列表
+    '''
+    if self.aging_interval <= 0 or self.aging_step <= 0 or lane['min_priority'] <= PRIORITY_MIN:
+      return []
+    low = lane['min_priority']
+    return self.execute(cursor,self.task_sql.claim_select_aged(skip_locked),(low,self.aging_interval,low,self.aging_step,self.aging_interval,limit))
+
+  @staticmethod
+  def rank(lane:dict,row:dict)->tuple:
+    '''
+    通道内的领取顺序: 有效优先级从高到低(老化任务按通道下界计), 再按created_at从早到晚, 最后按id
+    '''
+    priority = max(row.get('priority',lane['min_priority']),lane['min_priority'])
+    created_at = row.get('created_at')
+    return (-priority,created_at is None,created_at,row['id'])
+
+  def select_from(self,cursor,lane:dict,limit:int,skip_locked:bool,seen:set)->tuple[list[dict],bool]:
+    '''
+    从一个通道领取最多limit条不在seen中的任务, 返回(行, 通道中是否可能还有任务)
+    本通道任务与老化任务各查询一次, 按rank合并, 老化任务不会排在本通道更高优先级的任务之前
+    同一事务内已领取的行(例如被较高通道按老化领取的任务)还会被读到, 查询时多取len(seen)条, 按id去重
+    '''
+    found = []
+    more = False
+    want = limit+len(seen)
+    for select in (self.select_lane,self.select_aged):
+      candidates = select(cursor,lane,want,skip_locked)
+      more = more or len(candidates) >= want
+      found.extend(candidates)
+    found.sort(key=lambda row:self.rank(lane,row))
+    rows = []
+    for row in found:
+      if row['id'] in seen:
+        continue
+      if len(rows) >= limit:
+        more = True
+        break
+      seen.add(row['id'])
+      rows.append(row)
+    return rows,more
+
+  def select(self,cursor,limit:int,skip_locked:bool)->list[dict]:
+    shares = self.shares(limit)
+    seen = set()
+    per_lane = []
+    more = []
+    for lane,share in zip(self.lanes,shares):
+      rows,lane_more = self.select_from(cursor,lane,share,skip_locked,seen) if share > 0 else ([],False)
+      per_lane.append(rows)
+      more.append(lane_more)
+    leftover = limit-sum(len(rows) for rows in per_lane)
+    if leftover > 0:
+      # 只有取满名额的通道可能还有任务
+      for i,lane in enumerate(self.lanes):
+        if leftover <= 0:
+          break
+        if not more[i]:
+          continue
+        extra,_ = self.select_from(cursor,lane,leftover,skip_locked,seen)
+        per_lane[i].extend(extra)
+        leftover -= len(extra)
+    return [row for rows in per_lane for row in rows]
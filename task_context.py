@@ -0,0 +1,76 @@
+from typing import Callable
+import threading
+import time
+
+class TaskDeadline:
+  '''
+  一个在途任务的截止时间与取消标记, 由调度器的看门狗线程和任务回调共享
+  计时从任务真正开始执行时算起(start), 在执行器队列中等待的时间不计入
+  finish()只有第一次调用返回True: 回调与看门狗谁先调用谁负责写回结果, 晚到的另一方直接忽略
+  '''
+  def __init__(self,seconds:float):
+    self.seconds = seconds
+    self.started_at:float|None = None
+    self.cancel_event = threading.Event()
+    self.lock = threading.Lock()
+    self.finalized = False
+
+  def start(self,now:float|None=None):
+    if self.started_at is None:
+      self.started_at = time.monotonic() if now is None else now
+
+  def remaining(self,now:float|None=None)->float|None:
+    if self.started_at is None:
+      return None
+    now = time.monotonic() if now is None else now
+    return self.started_at+self.seconds-now
+
+  def expired(self,now:float|None=None)->bool:
+    remaining = self.remaining(now)
+    return remaining is not None and remaining <= 0
+
+  def finish(self)->bool:
+    with self.lock:
+      if self.finalized:
+        return False
+      self.finalized = True
+      return True
+
+  def cancel(self):
+    self.cancel_event.set()
+
+class TaskContext:
+  '''
+  开启pass_context后, 任务函数的第二个参数为TaskContext而不是连接池: func(args, ctx)
+  dbpool: 连接池(process模式下为子进程自己的连接池)
+  report_progress(progress): 报告0~100的进度, 由ProgressReporter合并后批量写库, 不会占用连接
+  cancelled()/cancel_event: 开启enforce_deadlines后, 任务超时时被设置; 长时间运行的func应定期检查并尽早返回
+  remaining(): 距离截止时间的秒数, 没有截止时间时为None
+  worker_state: 配置了worker_init时为当前工作线程(或进程)中worker_init的返回值, 否则为None
+  '''
+  def __init__(self,task_id:int,dbpool=None,reporter=None,deadline:TaskDeadline|None=None,state_getter:Callable|None=None):
+    self.task_id = task_id
+    self.dbpool = dbpool
+    self.reporter = reporter
+    self.deadline = deadline
+    self.cancel_event = deadline.cancel_event if deadline is not None else threading.Event()
+    # TaskContext在run()所在的线程中创建, 工作线程的状态要在func访问时才能取到
+    self.state_getter = state_getter
+
+  @property
+  def worker_state(self):
+    if self.state_getter is None:
+      return None
+    return self.state_getter()
+
+  def report_progress(self,progress:int|float):
+    if self.reporter is not None:
+      self.reporter.report(self.task_id,progress)
+
+  def cancelled(self)->bool:
+    return self.cancel_event.is_set()
+
+  def remaining(self)->float|None:
+    if self.deadline is None:
+      return None
+    return self.deadline.remaining()
@@ -0,0 +1,232 @@
+import re
+
+DEFAULT_TABLE_NAME = 'text_to_video_tasks'
+
+# 传给任务函数的字段, 领取任务时只查询这些列
+PROJECTED_FIELDS = ('id','task_uuid','prompt','width','height','text_to_video_pack_id')
+
+FAILED_SUFFIX = " -> task failed, retry times >= max_retry_times"
+
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_$]*$')
+
+def quote_identifier(name:str)->str:
+  '''
+  表名/列名来自配置文件, 只允许普通标识符, 防止拼接进SQL时被注入
+  '''
+  if not isinstance(name,str) or IDENTIFIER.match(name) is None:
+    raise ValueError(f'Invalid SQL identifier in config: {name!r}')
+  return f'`{name}`'
+
+class TaskSQL:
+  '''
+  根据配置中的table_name与fields生成调度器使用的全部SQL语句
+  fields: 逻辑字段名 -> 表中实际列名, 未配置的字段按同名列处理
+  查询结果的列都以逻辑字段名作为别名, 调用方始终用逻辑字段名取值
+  生成的语句按(语句名, 参数个数)缓存, IN列表长度不同的语句分别缓存
+  retry_backoff: (base, max, jitter), 不为None时失败重试的任务写入next_run_at = 现在 + min(base*2^retry_times, max)*(1±jitter)秒,
+  领取语句跳过next_run_at尚未到达的任务
+  record_artifacts: 为True时成功的任务同时写入artifact_path(func第三个返回值或缓存命中时放置产物的路径), 没有产物时保留原值
+  '''
+  def __init__(self,table_name:str|None=None,fields:dict[str,str]|None=None,projection:tuple=PROJECTED_FIELDS,retry_backoff:tuple[float,float,float]|None=None,record_artifacts:bool=False):
+    self.table_name = table_name if table_name else DEFAULT_TABLE_NAME
+    self.fields = dict(fields) if fields else {}
+    self.table = quote_identifier(self.table_name)
+    self.projection = tuple(dict.fromkeys(('id',)+tuple(projection)))
+    self.retry_backoff = tuple(retry_backoff) if retry_backoff else None
+    self.record_artifacts = record_artifacts
+    self.cache:dict[tuple,str] = {}
+
+  def col(self,field:str)->str:
+    return quote_identifier(self.fields.get(field,field))
+
+  def statement(self,key:tuple,builder)->str:
+    sql = self.cache.get(key)
+    if sql is None:
+      sql = builder()
+      self.cache[key] = sql
+    return sql
+
+  def in_list(self,n:int)->str:
+    return ','.join(['%s'] * n)
+
+  def owner_condition(self,owned:bool)->str:
+    '''
+    owned为True时附加任务归属条件(state=1且worker_id为本实例), 参数为worker_id
+    '''
+    if not owned:
+      return ''
+    return f' AND {self.col("state")} = 1 AND {self.col("worker_id")} = %s'
+
+  def pending_condition(self)->str:
+    '''
+    待领取任务的条件: state=0, 开启延迟重试时还要求next_run_at已到达
+    '''
+    condition = f'{self.col("state")} = 0'
+    if self.retry_backoff is not None:
+      next_run_at = self.col('next_run_at')
+      condition += f' AND ({next_run_at} IS NULL OR {next_run_at} <= NOW(3))'
+    return condition
+
+  def select_list(self)->str:
+    return ', '.join(f'{self.col(field)} AS {quote_identifier(field)}' for field in self.projection)
+
+  # 领取任务: 参数为(limit,)
+  def claim_select(self,skip_locked:bool)->str:
+    def build():
+      sql = f'SELECT {self.select_list()} FROM {self.table} WHERE {self.pending_condition()} ORDER BY {self.col("id")} LIMIT %s'
+      if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+      return sql
+    return self.statement(('claim_select',skip_locked),build)
+
+  # 有待处理任务的用户(借助(state, user_id)索引做松散索引扫描): after_cursor为True时参数为(last_user_id, limit), 否则为(limit,)
+  def pending_users(self,after_cursor:bool)->str:
+    def build():
+      condition = f' AND {self.col("user_id")} > %s' if after_cursor else ''
+      return f'SELECT {self.col("user_id")} AS `user_id` FROM {self.table} WHERE {self.pending_condition()}{condition} GROUP BY {self.col("user_id")} ORDER BY {self.col("user_id")} LIMIT %s'
+    return self.statement(('pending_users',after_cursor),build)
+
+  # 领取单个用户的任务: 参数为(user_id, limit), user_id可以为NULL
+  def claim_select_user(self,skip_locked:bool)->str:
+    def build():
+      sql = f'SELECT {self.select_list()} FROM {self.table} WHERE {self.pending_condition()} AND {self.col("user_id")} <=> %s ORDER BY {self.col("id")} LIMIT %s'
+      if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+      return sql
+    return self.statement(('claim_select_user',skip_locked),build)
+
+  # 领取一个优先级通道的任务(借助(state, priority DESC, id)索引按顺序读取): 参数为(min_priority, max_priority, limit)
+  def claim_select_lane(self,skip_locked:bool)->str:
+    def build():
+      sql = f'SELECT {self.select_list()} FROM {self.table} WHERE {self.pending_condition()} AND {self.col("priority")} BETWEEN %s AND %s ORDER BY {self.col("priority")} DESC, {self.col("id")} LIMIT %s'
+      if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+      return sql
+    return self.statement(('claim_select_lane',skip_locked),build)
+
+  # 领取因等待时间老化进入某个通道的低优先级任务: 参数为(min_priority, interval, min_priority, step, interval, limit)
+  # 优先级为p的任务等待ceil((min_priority-p)/step)*interval秒后视为达到min_priority, 不修改priority字段
+  # 第一个created_at条件是所有老化任务共同的最短等待时间, 让查询可以按(state, created_at)索引从最早的任务开始读取
+  def claim_select_aged(self,skip_locked:bool)->str:
+    def build():
+      priority = self.col('priority')
+      created_at = self.col('created_at')
+      sql = (
+        f'SELECT {self.select_list()} FROM {self.table} WHERE {self.pending_condition()} AND {priority} < %s '
+        f'AND {created_at} <= NOW() - INTERVAL %s SECOND '
+        f'AND {created_at} <= NOW() - INTERVAL (CEIL((%s - {priority}) / %s) * %s) SECOND '
+        f'ORDER BY {created_at}, {self.col("id")} LIMIT %s'
+      )
+      if skip_locked:
+        sql += ' FOR UPDATE SKIP LOCKED'
+      return sql
+    return self.statement(('claim_select_aged',skip_locked),build)
+
+  # 将领取到的任务置为state=1: stamp为True时参数为(worker_id, *ids), 否则为(*ids)
+  def claim_update(self,n:int,stamp:bool)->str:
+    def build():
+      sets = f'{self.col("state")} = 1'
+      if stamp:
+        sets += f', {self.col("worker_id")} = %s, {self.col("heartbeat_at")} = NOW()'
+      return f'UPDATE {self.table} SET {sets} WHERE {self.col("id")} IN ({self.in_list(n)})'
+    return self.statement(('claim_update',n,stamp),build)
+
+  # 成功: 参数为(description[, *[id, artifact_path]*n], *ids[, worker_id]), 由success_args生成
+  def success_update(self,n:int,owned:bool)->str:
+    def build():
+      artifact = ''
+      if self.record_artifacts:
+        column = self.col('artifact_path')
+        cases = ' '.join([f'WHEN %s THEN IFNULL(%s, {column})'] * n)
+        artifact = f', {column} = CASE {self.col("id")} {cases} END'
+      return f'UPDATE {self.table} SET {self.col("state")} = 2, {self.col("progress")} = 100, {self.col("description")} = %s{artifact} WHERE {self.col("id")} IN ({self.in_list(n)})'+self.owner_condition(owned)
+    return self.statement(('success_update',n,owned),build)
+
+  def success_args(self,successes:list[tuple[int,str|None]],worker_id:str|None=None)->tuple:
+    '''
+    success_update的参数, successes为[(task_id, artifact_path)], 没有产物时artifact_path为None
+    '''
+    args = ('success',)
+    if self.record_artifacts:
+      args += tuple(value for task_id,path in successes for value in (task_id,path))
+    args += tuple(task_id for task_id,_ in successes)
+    if worker_id is not None:
+      args += (worker_id,)
+    return args
+
+  def failure_update(self,failures:list[tuple[int,str]],generate_retry_times:int,worker_id:str|None=None)->tuple[str,tuple]:
+    '''
+    失败任务的状态转换语句: 一条UPDATE在服务端完成判断, 不需要先查询retry_times
+    retry_times < generate_retry_times: state=0, retry_times+1 (重新排队)
+    否则: state=3, progress=100, description=错误信息 (最终失败)
+    开启retry_backoff时, 重新排队的任务同时写入next_run_at, 退避时间随retry_times指数增长并带随机抖动
+    failures为[(task_id, msg)], 多个任务时用CASE为每个任务写入各自的错误信息
+    MySQL按从左到右的顺序执行SET, retry_times必须最后赋值, 前面的条件才能读到原值
+    '''
+    n = len(failures)
+    owned = worker_id is not None
+    def build():
+      retry = self.col('retry_times')
+      cases = ' '.join(['WHEN %s THEN %s'] * n)
+      delay = ''
+      if self.retry_backoff is not None:
+        next_run_at = self.col('next_run_at')
+        delay = f'{next_run_at} = IF({retry} < %s, NOW(3) + INTERVAL ROUND(LEAST(%s * POW(2, {retry}), %s) * (1 + %s * (2 * RAND() - 1)) * 1000000) MICROSECOND, {next_run_at}), '
+      return (
+        f'UPDATE {self.table} SET '
+        f'{self.col("state")} = IF({retry} < %s, 0, 3), '
+        f'{self.col("progress")} = IF({retry} < %s, {self.col("progress")}, 100), '
+        f'{self.col("description")} = IF({retry} < %s, {self.col("description")}, CASE {self.col("id")} {cases} END), '
+        f'{delay}'
+        f'{retry} = IF({retry} < %s, {retry} + 1, {retry}) '
+        f'WHERE {self.col("id")} IN ({self.in_list(n)})'
+      )+self.owner_condition(owned)
+    sql = self.statement(('failure_update',n,owned),build)
+    ids = tuple(task_id for task_id,_ in failures)
+    case_args = tuple(value for task_id,msg in failures for value in (task_id,msg+FAILED_SUFFIX))
+    args = (generate_retry_times,generate_retry_times,generate_retry_times)+case_args
+    if self.retry_backoff is not None:
+      args += (generate_retry_times,)+self.retry_backoff
+    args += (generate_retry_times,)+ids
+    if owned:
+      args += (worker_id,)
+    return sql,args
+
+  # 批量写入进度(只更新仍在执行的任务): 参数为(*[id, progress]*n, *ids[, worker_id])
+  def progress_update(self,n:int,owned:bool)->str:
+    def build():
+      cases = ' '.join(['WHEN %s THEN %s'] * n)
+      condition = self.owner_condition(True) if owned else f' AND {self.col("state")} = 1'
+      return f'UPDATE {self.table} SET {self.col("progress")} = CASE {self.col("id")} {cases} END WHERE {self.col("id")} IN ({self.in_list(n)})'+condition
+    return self.statement(('progress_update',n,owned),build)
+
+  # 续约: 参数为(*ids, worker_id)
+  def renew_leases(self,n:int)->str:
+    def build():
+      return f'UPDATE {self.table} SET {self.col("heartbeat_at")} = NOW() WHERE {self.col("id")} IN ({self.in_list(n)})'+self.owner_condition(True)
+    return self.statement(('renew_leases',n),build)
+
+  # 回收过期任务: 参数为(seconds, limit)
+  def reap_stale(self)->str:
+    def build():
+      return (
+        f'UPDATE {self.table} SET {self.col("state")} = 0, {self.col("worker_id")} = NULL '
+        f'WHERE {self.col("state")} = 1 AND {self.col("heartbeat_at")} < NOW() - INTERVAL %s SECOND '
+        f'ORDER BY {self.col("heartbeat_at")} LIMIT %s'
+      )
+    return self.statement(('reap_stale',),build)
+
+  # 查询state=1的任务id: owned为True时参数为(worker_id,)
+  def select_claimed(self,owned:bool)->str:
+    def build():
+      sql = f'SELECT {self.col("id")} AS `id` FROM {self.table} WHERE {self.col("state")} = 1'
+      if owned:
+        sql += f' AND {self.col("worker_id")} = %s'
+      return sql
+    return self.statement(('select_claimed',owned),build)
+
+  # 将state=1的任务放回队列: 参数为(*ids[, worker_id])
+  def release_claimed(self,n:int,owned:bool)->str:
+    def build():
+      return f'UPDATE {self.table} SET {self.col("state")} = 0 WHERE {self.col("id")} IN ({self.in_list(n)})'+self.owner_condition(owned)
+    return self.statement(('release_claimed',n,owned),build)
@@ -0,0 +1,39 @@
+-- text_to_video_tasks 表结构升级脚本
+-- 调度器的可选功能依赖以下字段与索引, 按需执行对应段落即可, 未开启的功能不需要执行
+
+-- claim_mode = skip_locked (多实例领取任务)
+-- worker_id: 领取该任务的调度实例标识
+-- heartbeat_at: 领取时间/最近一次心跳时间
+ALTER TABLE text_to_video_tasks
+  ADD COLUMN worker_id VARCHAR(128) NULL DEFAULT NULL,
+  ADD COLUMN heartbeat_at DATETIME NULL DEFAULT NULL;
+-- 领取语句按 state=0 ORDER BY id 扫描, 该索引保证只读取需要的行并只对这些行加锁
+ALTER TABLE text_to_video_tasks ADD INDEX idx_state_id (state, id);
+
+-- 过期任务回收(claim_mode = skip_locked 且 time_overflow_seconds > 0)
+-- 回收语句按 state=1 AND heartbeat_at < ? 做范围扫描, 续约语句按主键更新
+ALTER TABLE text_to_video_tasks ADD INDEX idx_state_heartbeat (state, heartbeat_at);
+
+-- schedule_mode = fair (按user_id轮转领取)
+-- 查找有待处理任务的用户时做松散索引扫描, 领取单个用户的任务时按id顺序读取, 都不需要扫描整个待处理集合
+ALTER TABLE text_to_video_tasks ADD INDEX idx_state_user_id (state, user_id, id);
+
+-- schedule_mode = priority (优先级通道)
+-- priority: 数值越大越优先; 每个通道的领取语句按 priority DESC, id 顺序读取索引, 取够即停止
+ALTER TABLE text_to_video_tasks ADD COLUMN priority INT NOT NULL DEFAULT 0;
+ALTER TABLE text_to_video_tasks ADD INDEX idx_state_priority_id (state, priority DESC, id);
+-- 老化按created_at计算等待时间, 不修改priority; 老化查询按该索引从最早的待处理任务开始读取
+ALTER TABLE text_to_video_tasks ADD INDEX idx_state_created_at (state, created_at);
+
+-- retry_backoff_base > 0 (失败任务延迟重试)
+-- next_run_at: 最早可以再次领取的时间, NULL表示立即可领取
+-- 领取语句仍按(state, id)索引顺序读取, 只跳过排在前面且尚未到时间的重试任务
+ALTER TABLE text_to_video_tasks ADD COLUMN next_run_at DATETIME(3) NULL DEFAULT NULL;
+
+-- per_task_deadlines (单个任务的执行截止时间)
+-- deadline_seconds: 任务函数最长执行时间(秒), NULL或<=0时使用time_overflow_seconds
+ALTER TABLE text_to_video_tasks ADD COLUMN deadline_seconds INT NULL DEFAULT NULL;
+
+-- record_artifacts (记录产物路径)
+-- artifact_path: 成功任务的产物路径(func的第三个返回值或结果缓存放置的文件), 没有产物时保留原值
+ALTER TABLE text_to_video_tasks ADD COLUMN artifact_path VARCHAR(1024) NULL DEFAULT NULL;
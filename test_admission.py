@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试AdmissionController按资源预算控制任务启动的脚本(不需要数据库)
+"""
+
+from admission import AdmissionController
+
+def make_controller():
+    return AdmissionController({'vram': 10, 'slots': 3}, {'vram': {'base': 1, 'per_megapixel': 4}})
+
+def test_cost_by_resolution():
+    """占用按width*height估算, 未配置规则的资源每个任务占1, 超过总预算时按总预算计算"""
+    admission = make_controller()
+    small = admission.cost({'width': 500, 'height': 500})
+    assert small == {'vram': 2.0, 'slots': 1.0}
+    huge = admission.cost({'width': 4000, 'height': 4000})
+    assert huge['vram'] == 10
+
+def test_acquire_and_release():
+    """预算不足时拒绝启动, 释放后可以继续启动"""
+    admission = make_controller()
+    big = admission.cost({'width': 1500, 'height': 1000})
+    small = admission.cost({'width': 500, 'height': 500})
+    assert admission.acquire(1, big)
+    assert admission.acquire(2, small)
+    assert not admission.acquire(3, big)
+    assert admission.claim_limit() == 1
+    admission.release(1)
+    assert admission.acquire(3, big)
+    assert not admission.acquire(4, small)
+    admission.release(2)
+    admission.release(3)
+    assert admission.used == {'vram': 0.0, 'slots': 0.0}
+    # 重复释放不会让用量变为负数
+    admission.release(3)
+    assert admission.used['vram'] == 0
+
+def test_claim_limit_without_base():
+    """base为0时按已估算过的最小占用限制领取数量, 还没有估算过时只领取1个; 也可以配置最小占用"""
+    admission = AdmissionController({'vram': 24}, {'vram': {'base': 0, 'per_megapixel': 8}})
+    assert admission.claim_limit() == 1
+    cost = admission.cost({'width': 1000, 'height': 1000})
+    assert cost == {'vram': 8.0}
+    assert admission.claim_limit() == 3
+    assert admission.acquire(1, cost)
+    assert admission.claim_limit() == 2
+    configured = AdmissionController({'vram': 24}, {'vram': {'base': 0, 'per_megapixel': 8, 'min': 4}})
+    assert configured.claim_limit() == 6
+    # 不会被占用的资源不限制领取
+    free = AdmissionController({'vram': 24}, {'vram': {'base': 0}})
+    assert free.claim_limit() is None
+
+if __name__ == "__main__":
+    test_cost_by_resolution()
+    test_acquire_and_release()
+    test_claim_limit_without_base()
+    print("\n测试完成！")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试main_thread_async.run()的领取与退出逻辑(使用test_main_thread中的假任务表, 不需要数据库)
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from async_main_thread import main_thread_async
+from test_main_thread import TaskTable, TablePool, wait_until
+
+LOG_PATH = os.path.join(tempfile.gettempdir(), 'test_async_main_thread_log.txt')
+
+def make_async_thread(table, func, **config):
+    '''
+    写入临时配置文件并创建main_thread_async, config覆盖默认配置
+    '''
+    values = {'host': 'localhost', 'port': 3306, 'user': 'test', 'password': 'test', 'db': 'test', 'max_connections': 2,
+              'output_path': tempfile.gettempdir(), 'log_path': LOG_PATH, 'max_retry_times': 1, 'generate_retry_times': 3,
+              'heart_beat_interval': 600, 'time_overflow_seconds': 1800, 'handle_signals': False, 'completion_batch_size': 0,
+              'poll_min_interval': 0.01, 'poll_max_interval': 0.05, 'shutdown_timeout': 0.2}
+    values.update(config)
+    fd, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(values, f)
+    return main_thread_async(func, path, dbpool_get=lambda *args, **kwargs: TablePool(table))
+
+def start(thread, slice_size=10, max_workers=2):
+    '''
+    在后台线程中运行run(), errors记录run()抛出的异常
+    '''
+    errors = []
+    def target():
+        try:
+            thread.run(slice_size=slice_size, max_workers=max_workers)
+        except Exception as e:
+            errors.append(e)
+    runner = threading.Thread(target=target, daemon=True)
+    runner.start()
+    return runner, errors
+
+def test_async_run_completes_tasks():
+    """协程按名额执行, 全部任务写回成功"""
+    table = TaskTable(6)
+    running = []
+    peak = []
+    async def render(args, ctx):
+        running.append(args['id'])
+        peak.append(len(running))
+        await asyncio.sleep(0.02)
+        running.remove(args['id'])
+        return args['id'], None
+    thread = make_async_thread(table, render)
+    runner, errors = start(thread, max_workers=2)
+    assert wait_until(lambda: set(table.states().values()) == {2})
+    assert max(peak) <= 2
+    assert thread.stop(timeout=1)
+    runner.join(2)
+    assert not errors
+
+def test_async_loop_error_releases_rows():
+    """调度循环抛出异常时, 正在执行的协程被取消, 已领取的任务放回队列"""
+    table = TaskTable(3)
+    started = []
+    async def hang(args, ctx):
+        started.append(args['id'])
+        await asyncio.sleep(10)
+        return args['id'], None
+    thread = make_async_thread(table, hang)
+    def broken_claim(want):
+        raise RuntimeError('claim failed')
+    runner, errors = start(thread, max_workers=5)
+    assert wait_until(lambda: len(started) == 3)
+    thread.fetch_status0 = broken_claim
+    runner.join(3)
+    assert not runner.is_alive()
+    assert len(errors) == 1 and str(errors[0]) == 'claim failed'
+    assert table.states() == {1: 0, 2: 0, 3: 0}
+    assert table.count('release') >= 1
+    assert not thread.in_flight
+
+if __name__ == "__main__":
+    test_async_run_completes_tasks()
+    test_async_loop_error_releases_rows()
+    print("\n测试完成！")
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试TaskBatcher分组攒批与结果分发的脚本(不需要数据库)
+"""
+
+import time
+from batching import TaskBatcher, BatchItem, fan_out
+
+def make_item(task_id, width, height):
+    row = {'id': task_id, 'width': width, 'height': height}
+    return BatchItem(row, dict(row))
+
+def test_group_by_key_and_size():
+    """相同分辨率的任务分为一组, 攒够max_size条立即取出, 未满的组等待超时后取出"""
+    batcher = TaskBatcher(max_size=2, max_wait=0.05)
+    for task_id, size in enumerate([(512, 512), (1024, 576), (512, 512), (512, 512)]):
+        batcher.add(make_item(task_id, *size))
+    batches = batcher.ready()
+    assert [[item.args['id'] for item in batch] for batch in batches] == [[0, 2]]
+    assert len(batcher) == 2
+    assert batcher.time_to_next() > 0
+    time.sleep(0.06)
+    rest = sorted([item.args['id'] for item in batch] for batch in batcher.ready())
+    assert rest == [[1], [3]]
+    assert batcher.time_to_next() is None
+
+def test_fan_out():
+    """结果按id分发, 漏掉的任务与整批异常都按失败处理"""
+    items = [make_item(task_id, 512, 512) for task_id in (1, 2, 3)]
+    fan_out(items, [(2, None), (1, 'bad')])
+    assert items[0].future.result() == (1, 'bad')
+    assert items[1].future.result() == (2, None)
+    assert items[2].future.result()[1] == 'missing from batch results'
+    failed = [make_item(4, 512, 512)]
+    fan_out(failed, None, RuntimeError('boom'))
+    assert 'boom' in failed[0].future.result()[1]
+
+if __name__ == "__main__":
+    test_group_by_key_and_size()
+    test_fan_out()
+    print("\n测试完成！")
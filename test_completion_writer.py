@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试CompletionWriter批量写回的脚本(使用内存中的假连接池, 不需要数据库)
+"""
+
+import os
+import tempfile
+import pymysql
+from completion_writer import CompletionWriter
+from task_sql import TaskSQL, FAILED_SUFFIX
+
+LOG_PATH = os.path.join(tempfile.gettempdir(), 'test_completion_writer_log.txt')
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = 0
+        self.last = None
+
+    def execute(self, sql, args=None):
+        if self.conn.fail is not None:
+            error = self.conn.fail(sql, args)
+            if error is not None:
+                raise error
+        self.conn.statements.append((' '.join(sql.split()), args))
+
+    def fetchone(self):
+        return self.last
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class FakeConnection:
+    def __init__(self, fail=None):
+        # fail(sql, args)返回异常时execute抛出它
+        self.fail = fail
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+class FakePool:
+    def __init__(self, *conns):
+        # 依次借出conns中的连接, 最后一个连接重复使用
+        self.conns = list(conns)
+        self.conn = conns[0]
+        self.discarded = []
+
+    def get_connection(self):
+        self.conn = self.conns.pop(0) if len(self.conns) > 1 else self.conns[0]
+        return self.conn
+
+    def put_connection(self, conn):
+        pass
+
+    def discard_connection(self, conn):
+        self.discarded.append(conn)
+
+def test_successes_are_merged():
+    """多条成功结果合并为一条UPDATE, 一次提交"""
+    conn = FakeConnection()
+    writer = CompletionWriter(FakePool(conn), LOG_PATH, batch_size=10, flush_interval=5)
+    writer.start()
+    futures = [writer.submit_success(i) for i in range(10)]
+    for future in futures:
+        assert future.result(timeout=5) is True
+    writer.close()
+    assert conn.commits == 1
+    assert len(conn.statements) == 1
+    assert conn.statements[0][1] == ('success',) + tuple(range(10))
+
+def test_artifact_paths_are_recorded():
+    """开启record_artifacts时成功结果的产物路径随同一条UPDATE写回, 没有产物的任务保留原值"""
+    conn = FakeConnection()
+    writer = CompletionWriter(FakePool(conn), LOG_PATH, batch_size=2, flush_interval=5, task_sql=TaskSQL(record_artifacts=True))
+    writer.start()
+    futures = [writer.submit_success(1, '/out/1.mp4'), writer.submit_success(2)]
+    for future in futures:
+        assert future.result(timeout=5) is True
+    writer.close()
+    sql, args = conn.statements[0]
+    assert '`artifact_path` = CASE `id` WHEN %s THEN IFNULL(%s, `artifact_path`)' in sql
+    assert args == ('success', 1, '/out/1.mp4', 2, None, 1, 2)
+
+def test_close_flushes_pending():
+    """close()会写完队列中剩余的结果"""
+    conn = FakeConnection()
+    writer = CompletionWriter(FakePool(conn), LOG_PATH, generate_retry_times=3, batch_size=100, flush_interval=60)
+    writer.start()
+    ok = writer.submit_success(1)
+    failed = writer.submit_failure(7, 'error')
+    writer.close(timeout=5)
+    assert ok.result(timeout=1) is True
+    assert failed.result(timeout=1) is True
+    assert conn.commits == 1
+    assert len(conn.statements) == 2
+
+def test_failures_use_one_conditional_update():
+    """失败任务不再先查询retry_times, 多个失败合并为一条带CASE的UPDATE"""
+    sql, args = TaskSQL().failure_update([(3, 'a'), (4, 'b')], 3)
+    assert sql.startswith('UPDATE')
+    assert sql.count('UPDATE') == 1
+    assert sql.index('`retry_times` = IF') > sql.index('`state` = IF')
+    assert args[3:7] == (3, 'a' + FAILED_SUFFIX, 4, 'b' + FAILED_SUFFIX)
+    assert args[-2:] == (3, 4)
+
+def test_lost_connection_rewrites_whole_batch():
+    """写失败结果时连接断开, 已执行的成功结果随事务丢失, 整批在新连接上重新写入"""
+    def drop_on_failures(sql, args):
+        if 'IF(' in sql:
+            return pymysql.err.OperationalError(2013, 'Lost connection to MySQL server during query')
+    broken = FakeConnection(drop_on_failures)
+    fresh = FakeConnection()
+    pool = FakePool(broken, fresh)
+    writer = CompletionWriter(pool, LOG_PATH, batch_size=2, flush_interval=5)
+    writer.start()
+    futures = [writer.submit_success(1), writer.submit_failure(2, 'error')]
+    for future in futures:
+        assert future.result(timeout=5) is True
+    writer.close()
+    assert pool.discarded == [broken] and broken.commits == 0
+    assert fresh.commits == 1
+    assert [sql.split()[0] for sql, _ in fresh.statements] == ['UPDATE', 'UPDATE']
+    assert writer.metrics.snapshot()['counters']['completion_flush_retries'] == 1
+
+def test_data_error_falls_back_to_rows():
+    """一条结果出现数据错误时逐条写入, 其余结果正常落库, 只有出错的结果失败"""
+    def reject_long(sql, args):
+        if any(isinstance(arg, str) and arg.startswith('x' * 10) for arg in args):
+            return pymysql.err.DataError(1406, "Data too long for column 'description'")
+    conn = FakeConnection(reject_long)
+    writer = CompletionWriter(FakePool(conn), LOG_PATH, batch_size=3, flush_interval=5)
+    writer.start()
+    ok = writer.submit_success(1)
+    bad = writer.submit_failure(2, 'x' * 100)
+    failed = writer.submit_failure(3, 'error')
+    assert ok.result(timeout=5) is True
+    assert failed.result(timeout=5) is True
+    assert isinstance(bad.exception(timeout=5), pymysql.err.DataError)
+    writer.close()
+    assert conn.commits == 2
+    assert writer.metrics.snapshot()['counters']['completion_row_fallbacks'] == 1
+
+if __name__ == "__main__":
+    test_successes_are_merged()
+    test_artifact_paths_are_recorded()
+    test_close_flushes_pending()
+    test_failures_use_one_conditional_update()
+    test_lost_connection_rewrites_whole_batch()
+    test_data_error_falls_back_to_rows()
+    print("\n测试完成！")
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试弹性连接池的按需扩容、空闲回收与部分创建失败(不需要数据库)
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import time
+from DBpool import DBpool, DBpoolRenew, session_assignments, session_statements
+from db_retry import retry
+
+LOG_PATH = os.path.join(tempfile.gettempdir(), 'test_dbpool_log.txt')
+
+class ClosableConnection:
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.last_renew_time = time.time()
+        self.checks = 0
+        self.rollbacks = 0
+        self.statements = []
+        self.autocommit_mode = False
+        self.server_thread_id = (1,)
+
+    def autocommit(self, value):
+        self.autocommit_mode = value
+
+    def ping(self, reconnect=True):
+        # 模拟ping时重建了连接: 服务端线程id变化
+        self.server_thread_id = (self.server_thread_id[0] + 1,)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def cursor(self):
+        return CheckCursor(self)
+
+    def close(self):
+        self.closed = True
+
+class CheckCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql):
+        self.conn.checks += 1
+        self.conn.statements.append(sql)
+        if self.conn.broken:
+            raise Exception('MySQL server has gone away')
+
+class FakeDBpool(DBpool):
+    '''
+    create_connection返回假连接, fail_after个连接之后创建失败
+    '''
+    def __init__(self, *args, fail_after=None, delay=0, **kwargs):
+        self.created = []
+        self.fail_after = fail_after
+        self.delay = delay
+        self.create_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def create_connection(self):
+        time.sleep(self.delay)
+        with self.create_lock:
+            if self.fail_after is not None and len(self.created) >= self.fail_after:
+                raise Exception('Too many connections')
+            conn = ClosableConnection()
+            self.created.append(conn)
+            return self.init_session(conn)
+
+class FakeDBpoolRenew(DBpoolRenew):
+    def __init__(self, *args, **kwargs):
+        self.created = []
+        super().__init__(*args, **kwargs)
+
+    def create_connection(self):
+        conn = ClosableConnection()
+        self.created.append(conn)
+        return self.stamp_lifetime(conn)
+
+def make_pool(**kwargs):
+    return FakeDBpool(4, 'localhost', 3306, 'user', 'password', 'db', logging_path=LOG_PATH, **kwargs)
+
+def test_fixed_pool_unchanged():
+    """不配置min_size时启动即创建全部连接"""
+    pool = make_pool()
+    assert pool.size == 4 and pool.pool.qsize() == 4
+    pool.close()
+    assert all(conn.closed for conn in pool.created)
+
+def test_grows_on_demand():
+    """等待超过grow_after后新建连接, 不超过max_connections"""
+    pool = make_pool(min_size=1, grow_after=0.01)
+    assert pool.size == 1
+    held = [pool.get_connection() for _ in range(4)]
+    assert pool.size == 4 and len(set(map(id, held))) == 4
+    try:
+        pool.timed_get_connection(0.05)
+        assert False, 'pool should not grow beyond max_connections'
+    except queue.Empty:
+        pass
+    for conn in held:
+        pool.put_connection(conn)
+    pool.close()
+
+def test_waiter_gets_returned_connection():
+    """达到上限后的等待者拿到归还的连接"""
+    pool = make_pool(min_size=0, grow_after=0.01)
+    held = [pool.get_connection() for _ in range(4)]
+    timer = threading.Timer(0.05, pool.put_connection, args=(held[0],))
+    timer.start()
+    assert pool.timed_get_connection(2) is held[0]
+    pool.close()
+
+def test_shrink_idle():
+    """空闲超时的连接被关闭, 保留min_size个, 常用的连接不受影响"""
+    pool = make_pool(min_size=1, grow_after=0.01, idle_timeout=0.05)
+    held = [pool.get_connection() for _ in range(3)]
+    for conn in held:
+        pool.put_connection(conn)
+    time.sleep(0.1)
+    hot = pool.get_connection()
+    pool.put_connection(hot)
+    assert pool.shrink_idle() == 2
+    assert pool.size == 1 and not hot.closed
+    assert pool.get_connection() is hot
+    pool.close()
+
+def test_partial_creation_failure():
+    """弹性模式下部分连接创建失败时仍然启动, 之后扩容失败时继续等待已有连接"""
+    pool = make_pool(min_size=3, grow_after=0.01, fail_after=2)
+    assert pool.size == 2
+    held = [pool.get_connection() for _ in range(2)]
+    try:
+        pool.timed_get_connection(0.05)
+        assert False, 'no connection should be available'
+    except queue.Empty:
+        pass
+    assert pool.size == 2
+    for conn in held:
+        pool.put_connection(conn)
+    pool.close()
+    started = True
+    try:
+        make_pool(min_size=2, fail_after=0)
+    except Exception:
+        started = False
+    assert not started, 'elastic pool without any connection should not start'
+
+def test_parallel_warm_up():
+    """连接并发创建, 有min_ready个可用后即返回, 其余在后台创建完成"""
+    start = time.time()
+    pool = make_pool(delay=0.2, warmup_workers=2, min_ready=2)
+    assert time.time() - start < 0.35
+    assert pool.metrics.gauges['dbpool_ready_seconds'] < 0.35
+    deadline = time.time() + 2
+    while pool.size < 4 and time.time() < deadline:
+        time.sleep(0.01)
+    assert pool.size == 4 and pool.pool.qsize() == 4
+    while 'dbpool_warm_seconds' not in pool.metrics.gauges and time.time() < deadline:
+        time.sleep(0.01)
+    assert pool.metrics.gauges['dbpool_warm_seconds'] >= 0.35
+    pool.close()
+
+def test_fixed_pool_warm_up_failure():
+    """固定大小模式下预热失败时关闭已创建的连接并抛出异常"""
+    holder = {}
+    class RecordingPool(FakeDBpool):
+        def create_connection(self):
+            holder['pool'] = self
+            return super().create_connection()
+    started = True
+    try:
+        RecordingPool(4, 'localhost', 3306, 'user', 'password', 'db', logging_path=LOG_PATH, fail_after=2)
+    except Exception:
+        started = False
+    assert not started
+    assert all(conn.closed for conn in holder['pool'].created)
+
+def test_renew_checkout_does_not_query():
+    """获取与放回连接时不执行SELECT 1, 由维护线程检查空闲连接"""
+    pool = FakeDBpoolRenew(2, 'localhost', 3306, 'user', 'password', 'db', logging_path=LOG_PATH, time_interval=0)
+    conn = pool.get_connection()
+    pool.put_connection(conn)
+    assert conn.checks == 0
+    assert pool.check_connections() == 0
+    assert all(conn.checks == 1 for conn in pool.created)
+    pool.close()
+
+def test_renew_replaces_broken_and_expired():
+    """检查失败或超过寿命的连接被关闭并替换, 连接数不变"""
+    pool = FakeDBpoolRenew(3, 'localhost', 3306, 'user', 'password', 'db', logging_path=LOG_PATH, time_interval=0, max_lifetime=60, lifetime_jitter=0.5)
+    broken, expired, healthy = pool.created[:3]
+    broken.broken = True
+    expired.expires_at = time.time() - 1
+    assert all(30 <= conn.expires_at - time.time() <= 60 for conn in (broken, healthy))
+    assert pool.check_connections() == 2
+    assert broken.closed and expired.closed and not healthy.closed
+    assert pool.size == 3 and pool.pool.qsize() == 3
+    assert expired.checks == 0
+    pool.close()
+
+def test_connection_context():
+    """connection()退出时回滚并放回连接, 异常时同样放回, 获取失败时不放回任何连接"""
+    pool = make_pool(hold_warning_seconds=0)
+    with pool.connection() as conn:
+        assert pool.pool.qsize() == 3 and len(pool.holders) == 1
+    assert conn.rollbacks == 1 and pool.pool.qsize() == 4 and not pool.holders
+    try:
+        with pool.connection() as conn:
+            raise ValueError('query failed')
+    except ValueError:
+        pass
+    assert sum(c.rollbacks for c in pool.created) == 2 and pool.pool.qsize() == 4
+    held = [pool.get_connection() for _ in range(4)]
+    try:
+        with pool.connection(timeout=0.01):
+            assert False, 'no connection should be available'
+    except queue.Empty:
+        pass
+    assert pool.pool.qsize() == 0
+    for conn in held:
+        pool.put_connection(conn)
+    snapshot = pool.metrics.snapshot()
+    assert snapshot['histograms']['dbpool_hold_seconds']['count'] == 6
+    assert snapshot['histograms']['dbpool_wait_seconds']['count'] == 6
+    assert snapshot['gauges']['dbpool_in_use'] == 4
+    pool.close()
+
+def test_long_hold_stack_capture():
+    """持有超过hold_warning_seconds的连接记录一次借出位置与持有线程的调用栈"""
+    pool = make_pool(hold_warning_seconds=0.05)
+    release = threading.Event()
+    def hold_connection_for_too_long():
+        with pool.connection():
+            release.wait(2)
+    thread = threading.Thread(target=hold_connection_for_too_long)
+    thread.start()
+    time.sleep(0.1)
+    assert pool.check_holds() == 1
+    assert pool.check_holds() == 0
+    with open(LOG_PATH) as f:
+        entry = f.read().rsplit('checked out at:', 1)[1]
+    site, stack = entry.split('current stack:', 1)
+    assert 'in hold_connection_for_too_long' in site and 'with pool.connection():' in site
+    assert 'DBpool.py' not in site and 'contextlib' not in site
+    assert 'release.wait(2)' in stack
+    release.set()
+    thread.join()
+    assert not pool.holders and pool.metrics.counters['dbpool_long_holds'] == 1
+    pool.close()
+
+def test_session_profile():
+    """会话变量在建立连接时合并为一条init_command, 隔离级别单独设置, set_session只对变化的项执行SET"""
+    assert session_assignments({'isolation_level': 'read-committed', 'lock_wait_timeout': '5'}) == ['innodb_lock_wait_timeout = 5']
+    # 不使用transaction_isolation变量, 兼容MySQL 5.7.20与MariaDB 11.1之前的版本
+    assert session_statements({'isolation_level': 'read-committed', 'lock_wait_timeout': '5'}) == [
+        'SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED', 'SET SESSION innodb_lock_wait_timeout = 5']
+    try:
+        session_statements({'isolation_level': "READ COMMITTED'; DROP TABLE x"})
+        assert False, 'invalid isolation level should be rejected'
+    except ValueError:
+        pass
+    session = {'isolation_level': 'READ COMMITTED', 'lock_wait_timeout': 5, 'max_execution_time': 30000, 'charset': 'utf8mb4', 'autocommit': False}
+    pool = make_pool(session=session)
+    assert pool.session_args == {
+        'charset': 'utf8mb4',
+        'autocommit': False,
+        'init_command': 'SET SESSION innodb_lock_wait_timeout = 5, max_execution_time = 30000',
+    }
+    conn = pool.get_connection()
+    assert conn.session_state == session
+    assert conn.statements == ['SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED']
+    conn.statements.clear()
+    assert not pool.set_session(conn, isolation_level='READ COMMITTED', autocommit=False)
+    assert conn.statements == []
+    assert pool.set_session(conn, lock_wait_timeout=50, autocommit=True)
+    assert conn.statements == ['SET SESSION innodb_lock_wait_timeout = 50'] and conn.autocommit_mode
+    assert not pool.set_session(conn, lock_wait_timeout=50)
+    # 重连后pymysql只重新执行init_command: 隔离级别重新设置, 已记录的会话状态清空, set_session重新执行SET
+    conn.statements.clear()
+    assert retry(conn, 1, LOG_PATH)
+    assert conn.statements == ['SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED'] and conn.session_state == {}
+    assert pool.set_session(conn, lock_wait_timeout=50)
+    assert conn.statements[-1] == 'SET SESSION innodb_lock_wait_timeout = 50'
+    pool.put_connection(conn)
+    pool.close()
+
+if __name__ == "__main__":
+    test_fixed_pool_unchanged()
+    test_grows_on_demand()
+    test_waiter_gets_returned_connection()
+    test_shrink_idle()
+    test_partial_creation_failure()
+    test_parallel_warm_up()
+    test_fixed_pool_warm_up_failure()
+    test_renew_checkout_does_not_query()
+    test_renew_replaces_broken_and_expired()
+    test_connection_context()
+    test_long_hold_stack_capture()
+    test_session_profile()
+    print("\n测试完成！")
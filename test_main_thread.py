@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试main_thread.run()的领取、预取与退出逻辑(使用内存中的假任务表, 不需要数据库)
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import main_thread
+from test_dbpool import FakeDBpool
+
+LOG_PATH = os.path.join(tempfile.gettempdir(), 'test_main_thread_log.txt')
+
+class TaskTable:
+    '''
+    内存中的任务表, 按语句的特征执行task_sql生成的SQL
+    '''
+    def __init__(self, count=0):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.statements = []
+        for _ in range(count):
+            self.add()
+
+    def add(self, **values):
+        with self.lock:
+            task_id = len(self.rows) + 1
+            row = {'id': task_id, 'task_uuid': f'uuid-{task_id}', 'prompt': 'p', 'width': 1, 'height': 1, 'text_to_video_pack_id': 1,
+                   'state': 0, 'worker_id': None, 'heartbeat_at': None, 'retry_times': 0, 'description': None, 'artifact_path': None}
+            row.update(values)
+            self.rows[task_id] = row
+            return task_id
+
+    def states(self):
+        with self.lock:
+            return {task_id: row['state'] for task_id, row in self.rows.items()}
+
+    def count(self, kind):
+        with self.lock:
+            return sum(1 for statement in self.statements if statement == kind)
+
+    def ids(self, sql, args, owned):
+        n = len(re.search(r'IN \(([^)]*)\)', sql).group(1).split(','))
+        return list(args[len(args) - n - owned:len(args) - owned])
+
+    def owns(self, row, sql, args):
+        return ' AND `worker_id` = %s' not in sql or (row['state'] == 1 and row['worker_id'] == args[-1])
+
+    def execute(self, sql, args):
+        '''
+        返回(结果行, rowcount)
+        '''
+        sql = ' '.join(sql.split())
+        args = tuple(args or ())
+        owned = int(' AND `worker_id` = %s' in sql)
+        with self.lock:
+            if sql.startswith('SELECT') and 'LIMIT %s' in sql:
+                self.statements.append('claim')
+                pending = [row for row in self.rows.values() if row['state'] == 0][:args[-1]]
+                fields = re.findall(r'AS `(\w+)`', sql)
+                return [{key: row.get(key) for key in fields} for row in pending], len(pending)
+            if 'SET `state` = 1' in sql:
+                self.statements.append('claim_update')
+                stamp = '`worker_id` = %s' in sql
+                rows = [self.rows[task_id] for task_id in self.ids(sql, args, 0)]
+                for row in rows:
+                    row['state'] = 1
+                    if stamp:
+                        row['worker_id'] = args[0]
+                        row['heartbeat_at'] = time.time()
+                return [], len(rows)
+            if 'SET `state` = 2' in sql:
+                self.statements.append('success')
+                rows = [self.rows[task_id] for task_id in self.ids(sql, args, owned) if self.owns(self.rows[task_id], sql, args)]
+                paths = dict(zip(args[1::2], args[2::2])) if '`artifact_path`' in sql else {}
+                for row in rows:
+                    row['state'] = 2
+                    row['description'] = args[0]
+                    if paths.get(row['id']) is not None:
+                        row['artifact_path'] = paths[row['id']]
+                return [], len(rows)
+            if 'SET `state` = IF(' in sql:
+                self.statements.append('failure')
+                generate_retry_times = args[0]
+                rows = [self.rows[task_id] for task_id in self.ids(sql, args, owned) if self.owns(self.rows[task_id], sql, args)]
+                for row in rows:
+                    if row['retry_times'] < generate_retry_times:
+                        row['state'] = 0
+                        row['retry_times'] += 1
+                    else:
+                        row['state'] = 3
+                return [], len(rows)
+            if 'SET `heartbeat_at` = NOW()' in sql:
+                self.statements.append('renew')
+                rows = [self.rows[task_id] for task_id in self.ids(sql, args, 1) if self.owns(self.rows[task_id], sql, args)]
+                for row in rows:
+                    row['heartbeat_at'] = time.time()
+                return [], len(rows)
+            if 'SET `state` = 0, `worker_id` = NULL' in sql:
+                self.statements.append('reap')
+                seconds, limit = args
+                stale = [row for row in self.rows.values() if row['state'] == 1 and row['heartbeat_at'] < time.time() - seconds][:limit]
+                for row in stale:
+                    row['state'] = 0
+                    row['worker_id'] = None
+                return [], len(stale)
+            if 'SET `state` = 0 WHERE' in sql:
+                self.statements.append('release')
+                rows = [self.rows[task_id] for task_id in self.ids(sql, args, owned) if self.owns(self.rows[task_id], sql, args)]
+                for row in rows:
+                    row['state'] = 0
+                return [], len(rows)
+            self.statements.append('other')
+            return [], 0
+
+class TableCursor:
+    def __init__(self, table):
+        self.table = table
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, args=None):
+        self.rows, self.rowcount = self.table.execute(sql, args)
+
+    def fetchall(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class TableConnection:
+    def __init__(self, table):
+        self.table = table
+
+    def cursor(self):
+        return TableCursor(self.table)
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class TablePool:
+    '''
+    与DBpool接口相同的假连接池, 所有连接共用同一张TaskTable
+    '''
+    def __init__(self, table):
+        self.table = table
+        self.closed = False
+
+    def create_connection(self):
+        return TableConnection(self.table)
+
+    def get_connection(self):
+        return TableConnection(self.table)
+
+    def put_connection(self, conn):
+        pass
+
+    @contextmanager
+    def connection(self, timeout=None):
+        yield self.get_connection()
+
+    def set_session(self, conn, **values):
+        return False
+
+    def close(self):
+        self.closed = True
+
+def make_thread(table, func, **kwargs):
+    kwargs.setdefault('handle_signals', False)
+    kwargs.setdefault('completion_batch_size', 0)
+    return main_thread.main_thread(func, dbpool_get=lambda *args, **pool_kwargs: TablePool(table), logging_path=LOG_PATH, **kwargs)
+
+def start(thread, slice_size=10, max_workers=2):
+    runner = threading.Thread(target=thread.run, kwargs={'slice_size': slice_size, 'max_workers': max_workers}, daemon=True)
+    runner.start()
+    return runner
+
+def wait_until(condition, timeout=3):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def finish(args, ctx):
+    return args['id'], None
+
+def fail_even(args, ctx):
+    # process模式的任务函数必须是模块级函数
+    return args['id'], ('even id' if args['id'] % 2 == 0 else None)
+
+def blocking(gate, started=None):
+    '''
+    阻塞到gate被设置的任务函数, started记录开始执行的任务id
+    '''
+    def func(args, ctx):
+        if started is not None:
+            started.append(args['id'])
+        gate.wait(5)
+        return args['id'], None
+    return func
+
+def test_in_flight_budget():
+    """领取数量不超过在途名额, 名额释放后继续领取剩余任务"""
+    table = TaskTable(10)
+    gate = threading.Event()
+    started = []
+    thread = make_thread(table, blocking(gate, started), max_in_flight=3, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, slice_size=10, max_workers=2)
+    assert wait_until(lambda: len(started) == 2)
+    time.sleep(0.3)
+    states = table.states()
+    # 2个正在执行, 1个在线程池队列中等待, 其余任务留在表中
+    assert list(states.values()).count(1) == 3 and list(states.values()).count(0) == 7
+    with thread.slot_cond:
+        assert len(thread.in_flight) == 3
+    gate.set()
+    assert wait_until(lambda: set(table.states().values()) == {2})
+    assert thread.stop(timeout=1)
+    runner.join(2)
+
+def test_adaptive_poll():
+    """没有任务时轮询间隔从min_interval指数增长到max_interval, 领取到任务后重置"""
+    poll = main_thread.AdaptivePoll(0.1, 0.5, jitter=0)
+    assert [poll.idle() for _ in range(4)] == [0.1, 0.2, 0.4, 0.5]
+    assert poll.found() == 0 and poll.idle() == 0.1
+    table = TaskTable()
+    thread = make_thread(table, finish, poll_min_interval=0.05, poll_max_interval=0.2)
+    runner = start(thread)
+    time.sleep(1.0)
+    # 0.05 -> 0.1 -> 0.2 -> 0.2 ..., 1秒内约7次, 抖动为±20%
+    assert 4 <= table.count('claim') <= 10, table.count('claim')
+    assert 0.16 <= thread.metrics.gauges['poll_interval_seconds'] <= 0.24
+    table.add()
+    assert wait_until(lambda: table.states() == {1: 2}, timeout=1)
+    assert thread.stop(timeout=1)
+    runner.join(2)
+
+def test_lease_renewal_and_reaping():
+    """其他实例过期的任务被回收并重新领取, 本实例正在执行的任务按时续约不会被回收"""
+    table = TaskTable()
+    table.add(state=1, worker_id='dead-worker', heartbeat_at=time.time() - 60)
+    table.add()
+    gate = threading.Event()
+    started = []
+    thread = make_thread(table, blocking(gate, started), claim_mode='skip_locked', worker_id='me', time_overflow_seconds=2,
+                         reap_interval=0.2, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread)
+    assert wait_until(lambda: sorted(started) == [1, 2])
+    assert all(row['worker_id'] == 'me' for row in table.rows.values())
+    # 执行时间超过time_overflow_seconds, 期间每秒续约一次
+    time.sleep(2.5)
+    assert table.count('renew') >= 2
+    assert table.states() == {1: 1, 2: 1}
+    assert all(time.time() - row['heartbeat_at'] < 2 for row in table.rows.values())
+    assert thread.metrics.counters['tasks_reaped'] == 1
+    gate.set()
+    assert wait_until(lambda: table.states() == {1: 2, 2: 2})
+    assert thread.stop(timeout=1)
+    runner.join(2)
+
+def test_stop_releases_unstarted_rows():
+    """stop()时线程池中未开始的任务用一条语句放回队列, 正在执行的任务等待到超时"""
+    table = TaskTable(5)
+    gate = threading.Event()
+    started = []
+    thread = make_thread(table, blocking(gate, started), prefetch_margin=2, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, max_workers=1)
+    assert wait_until(lambda: len(started) == 1 and list(table.states().values()).count(1) == 3)
+    begin = time.time()
+    assert thread.stop(timeout=0.3)
+    assert time.time() - begin >= 0.3
+    runner.join(2)
+    running = started[0]
+    assert table.states() == {task_id: (1 if task_id == running else 0) for task_id in range(1, 6)}
+    assert table.count('release') == 1
+    gate.set()
+
+def test_prefetcher_fills_ready_queue():
+    """预取线程把就绪队列补到高水位, 不超过在途名额加高水位; 停止时就绪队列中的任务被放回"""
+    table = TaskTable(20)
+    gate = threading.Event()
+    started = []
+    thread = make_thread(table, blocking(gate, started), prefetch_high_watermark=4, prefetch_margin=0, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, slice_size=10, max_workers=2)
+    assert wait_until(lambda: len(started) == 2 and thread.queue.qsize() == 4)
+    time.sleep(0.2)
+    assert list(table.states().values()).count(1) == 6
+    assert thread.metrics.gauges['ready_buffer_size'] == 4
+    assert thread.stop(timeout=0.1)
+    runner.join(2)
+    assert list(table.states().values()).count(0) == 18
+    gate.set()
+
+def test_prefetcher_idle_claim_rate():
+    """空表时预取线程按AdaptivePoll的间隔领取, run()的循环不会把它唤醒成忙等"""
+    table = TaskTable()
+    thread = make_thread(table, finish, prefetch_high_watermark=6, poll_min_interval=0.05, poll_max_interval=0.2)
+    runner = start(thread)
+    time.sleep(1.0)
+    assert thread.stop(timeout=1)
+    runner.join(2)
+    # 间隔0.05 -> 0.1 -> 0.2 -> 0.2 ..., 1秒内最多约8次
+    assert table.count('claim') <= 12, table.count('claim')
+    assert thread.metrics.counters['claim_queries'] == table.count('claim')
+
+def test_late_result_keeps_retry_registration():
+    """超时任务重试后, 旧调用返回时不影响新提交的登记与准入占用, 补充的工作线程在旧调用返回后收回"""
+    table = TaskTable()
+    table.add(deadline_seconds=0.2)
+    calls = []
+    release = [threading.Event(), threading.Event()]
+    def slow(args, ctx):
+        call = len(calls)
+        calls.append(call)
+        release[call].wait(5)
+        return args['id'], None
+    thread = make_thread(table, slow, enforce_deadlines=True, per_task_deadlines=True, deadline_check_interval=0.05,
+                         admission_budgets={'slots': 2}, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, max_workers=2)
+    assert wait_until(lambda: len(calls) == 1)
+    # 重新领取后的第二次执行不会再超时
+    table.rows[1]['deadline_seconds'] = 30
+    assert wait_until(lambda: len(calls) == 2)
+    with thread.slot_cond:
+        retry = thread.in_flight[1]
+        # 已为超时任务补充了工作线程, 它不再占用在途名额
+        assert len(thread.abandoned) == 1 and thread.occupied_slots() == 1
+    assert thread.executor._max_workers == 3
+    assert thread.admission.used['slots'] == 2
+    release[0].set()
+    assert wait_until(lambda: not thread.abandoned)
+    with thread.slot_cond:
+        assert thread.in_flight.get(1) is retry and 1 in thread.deadlines
+    assert thread.admission.used['slots'] == 1
+    assert thread.executor._max_workers == 2
+    release[1].set()
+    assert wait_until(lambda: table.states() == {1: 2})
+    assert wait_until(lambda: thread.admission.used['slots'] == 0)
+    assert thread.stop(timeout=1)
+    runner.join(2)
+
+def test_hung_tasks_do_not_hold_capacity():
+    """超时未返回的任务补充工作线程, 其余任务继续执行; func返回后收回补充的线程, 补充数受上限限制"""
+    table = TaskTable(20)
+    gate = threading.Event()
+    calls = {}
+    def hang_first_two(args, ctx):
+        calls[args['id']] = calls.get(args['id'], 0) + 1
+        if args['id'] <= 2 and calls[args['id']] == 1:
+            gate.wait(10)
+        return args['id'], None
+    thread = make_thread(table, hang_first_two, max_in_flight=2, enforce_deadlines=True, time_overflow_seconds=1,
+                         deadline_check_interval=0.05, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, slice_size=10, max_workers=2)
+    assert wait_until(lambda: set(table.states().values()) == {2}, timeout=5)
+    with thread.slot_cond:
+        assert len(thread.abandoned) == 2 and len(thread.replaced) == 2
+    gate.set()
+    assert wait_until(lambda: not thread.abandoned)
+    assert not thread.replaced and thread.executor._max_workers == 2
+    assert thread.stop(timeout=1)
+    runner.join(2)
+    # 不补充线程时, 超时任务在返回前占满名额, 其余任务不会被领取
+    table = TaskTable(4)
+    gate = threading.Event()
+    calls.clear()
+    thread = make_thread(table, hang_first_two, max_in_flight=2, enforce_deadlines=True, time_overflow_seconds=1,
+                         deadline_check_interval=0.05, poll_min_interval=0.01, poll_max_interval=0.05, max_replacement_workers=0)
+    runner = start(thread, slice_size=10, max_workers=2)
+    assert wait_until(lambda: len(thread.abandoned) == 2, timeout=3)
+    time.sleep(0.3)
+    assert table.states()[3] == 0 and table.states()[4] == 0
+    gate.set()
+    assert wait_until(lambda: set(table.states().values()) == {2})
+    assert thread.stop(timeout=1)
+    runner.join(2)
+
+def test_process_mode_run():
+    """process模式下任务在子进程中执行, 成功与失败结果都由父进程写回"""
+    table = TaskTable(6)
+    thread = make_thread(table, fail_even, executor_mode='process', process_db_connections=0, generate_retry_times=0,
+                         poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, max_workers=2)
+    assert wait_until(lambda: set(table.states().values()) == {2, 3}, timeout=10)
+    assert table.states() == {1: 2, 2: 3, 3: 2, 4: 3, 5: 2, 6: 3}
+    assert thread.stop(timeout=5)
+    runner.join(5)
+    assert not runner.is_alive()
+
+def test_worker_init_requires_context():
+    """worker_init的返回值只能通过TaskContext传给func, 不开启pass_context时拒绝创建"""
+    table = TaskTable()
+    try:
+        make_thread(table, finish, worker_init=lambda: 'client')
+    except ValueError as e:
+        assert 'pass_context' in str(e)
+    else:
+        raise AssertionError('worker_init without pass_context should be rejected')
+    states = []
+    def use_state(args, ctx):
+        states.append(ctx.worker_state)
+        return args['id'], None
+    table.add()
+    thread = make_thread(table, use_state, worker_init=lambda: 'client', pass_context=True, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread, max_workers=1)
+    assert wait_until(lambda: table.states() == {1: 2})
+    assert states == ['client']
+    assert thread.stop(timeout=1)
+    runner.join(2)
+
+def test_cache_hit_records_artifact_path():
+    """相同的任务命中结果缓存, 放到输出目录的产物路径写入artifact_path"""
+    output = tempfile.mkdtemp()
+    table = TaskTable()
+    table.add()
+    calls = []
+    def render(args, ctx):
+        calls.append(args['id'])
+        path = os.path.join(output, f'{args["task_uuid"]}.mp4')
+        with open(path, 'wb') as f:
+            f.write(b'video')
+        return args['id'], None, path
+    thread = make_thread(table, render, result_cache_dir=os.path.join(output, '.result_cache'), record_artifacts=True,
+                         poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread)
+    assert wait_until(lambda: table.states() == {1: 2})
+    table.add()
+    assert wait_until(lambda: table.states() == {1: 2, 2: 2})
+    assert thread.stop(timeout=1)
+    runner.join(2)
+    assert calls == [1]
+    assert table.rows[1]['artifact_path'] == os.path.join(output, 'uuid-1.mp4')
+    cached = table.rows[2]['artifact_path']
+    assert cached and cached != table.rows[1]['artifact_path']
+    with open(cached, 'rb') as f:
+        assert f.read() == b'video'
+
+def test_periodic_metrics_log():
+    """按metrics_log_interval把指标快照写入日志, 退出时再写一次"""
+    table = TaskTable(3)
+    log_path = os.path.join(tempfile.gettempdir(), 'test_main_thread_metrics_log.txt')
+    if os.path.exists(log_path):
+        os.remove(log_path)
+    thread = main_thread.main_thread(finish, dbpool_get=lambda *args, **kwargs: TablePool(table), logging_path=log_path, handle_signals=False,
+                                     completion_batch_size=0, metrics_log_interval=0.1, poll_min_interval=0.01, poll_max_interval=0.05)
+    runner = start(thread)
+    assert wait_until(lambda: table.states() == {1: 2, 2: 2, 3: 2})
+    time.sleep(0.3)
+    assert thread.stop(timeout=1)
+    runner.join(2)
+    with open(log_path) as f:
+        reports = [line.split('Metrics: ', 1)[1] for line in f if 'Metrics: ' in line]
+    assert len(reports) >= 3
+    assert json.loads(reports[-1])['counters']['tasks_claimed'] == 3
+
+def test_probe_connection_is_not_pooled():
+    """启动时的探测连接用完即关闭, 弹性连接池中的连接数不超过计数"""
+    pools = []
+    def dbpool_get(*args, **kwargs):
+        pools.append(FakeDBpool(2, 'localhost', 3306, 'user', 'password', 'db', logging_path=LOG_PATH, min_size=0,
+                                session=kwargs.get('session'), metrics_obj=kwargs.get('metrics_obj')))
+        return pools[0]
+    thread = main_thread.main_thread(finish, dbpool_get=dbpool_get, logging_path=LOG_PATH, handle_signals=False)
+    pool = pools[0]
+    assert pool.size == 0 and pool.pool.qsize() == 0
+    assert len(pool.created) == 1 and pool.created[0].closed
+    held = [pool.get_connection() for _ in range(2)]
+    assert pool.size == 2 and pool.pool.qsize() == 0
+    for conn in held:
+        pool.put_connection(conn)
+    thread.close()
+
+if __name__ == "__main__":
+    test_in_flight_budget()
+    test_adaptive_poll()
+    test_lease_renewal_and_reaping()
+    test_stop_releases_unstarted_rows()
+    test_prefetcher_fills_ready_queue()
+    test_prefetcher_idle_claim_rate()
+    test_late_result_keeps_retry_registration()
+    test_hung_tasks_do_not_hold_capacity()
+    test_process_mode_run()
+    test_worker_init_requires_context()
+    test_cache_hit_records_artifact_path()
+    test_periodic_metrics_log()
+    test_probe_connection_is_not_pooled()
+    print("\n测试完成！")
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试ProgressReporter合并写入进度的脚本(使用内存中的假连接池, 不需要数据库)
+"""
+
+import os
+import tempfile
+from progress_reporter import ProgressReporter
+from task_context import TaskContext
+from test_completion_writer import FakeConnection, FakePool
+
+LOG_PATH = os.path.join(tempfile.gettempdir(), 'test_progress_reporter_log.txt')
+
+def test_latest_value_per_task():
+    """同一任务多次报告只写最新值, 所有任务一条语句写回"""
+    conn = FakeConnection()
+    reporter = ProgressReporter(FakePool(conn), LOG_PATH, flush_interval=60)
+    for task_id in (1, 2, 3):
+        ctx = TaskContext(task_id, None, reporter)
+        for progress in (10, 50, 90):
+            ctx.report_progress(progress)
+    assert reporter.flush() == 3
+    assert len(conn.statements) == 1
+    sql, args = conn.statements[0]
+    assert args == (1, 90, 2, 90, 3, 90, 1, 2, 3)
+    assert sql.endswith('AND `state` = 1')
+    # 没有新进度时不写库
+    assert reporter.flush() == 0
+    assert len(conn.statements) == 1
+
+if __name__ == "__main__":
+    test_latest_value_per_task()
+    print("\n测试完成！")
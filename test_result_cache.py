@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试ResultCache缓存键、LRU淘汰与索引持久化的脚本(使用临时目录, 不需要数据库)
+"""
+
+import os
+import tempfile
+import time
+from result_cache import ResultCache, cache_key
+
+def write_artifact(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return path
+
+def test_key_normalization():
+    """prompt中的空白差异不影响缓存键, 分辨率不同则键不同"""
+    args = {'prompt': 'a cat', 'width': 512, 'height': 512, 'text_to_video_pack_id': 1}
+    assert cache_key(args) == cache_key(dict(args, prompt='  a   cat '))
+    assert cache_key(args) != cache_key(dict(args, width=1024))
+
+def test_lru_eviction_and_reload():
+    """超过总大小时淘汰最久未使用的条目, 重新打开后索引仍然有效"""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, 'cache')
+        cache = ResultCache(root, max_bytes=25, logging_path=os.path.join(tmp, 'log.txt'))
+        cache.put('a', write_artifact(tmp, 'a.mp4', 10))
+        time.sleep(0.01)
+        cache.put('b', write_artifact(tmp, 'b.mp4', 10))
+        time.sleep(0.01)
+        assert cache.get('a') is not None
+        cache.put('c', write_artifact(tmp, 'c.mp4', 10))
+        assert cache.get('b') is None
+        assert cache.get('a') is not None and cache.get('c') is not None
+        dest = cache.materialize('a', os.path.join(tmp, 'out'), 'task-1')
+        assert dest.endswith('task-1.mp4') and os.path.getsize(dest) == 10
+        cache.close()
+        reopened = ResultCache(root, max_bytes=25, logging_path=os.path.join(tmp, 'log.txt'))
+        assert sorted(reopened.entries) == ['a', 'c']
+
+if __name__ == "__main__":
+    test_key_normalization()
+    test_lru_eviction_and_reload()
+    print("\n测试完成！")
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试任务调度策略的脚本(使用内存中的假游标模拟任务表, 不需要数据库)
+"""
+
+import math
+import os
+import tempfile
+from scheduling import FairShareScheduler, PriorityLaneScheduler
+from task_sql import TaskSQL, PROJECTED_FIELDS
+
+LOG_PATH = os.path.join(tempfile.gettempdir(), 'test_scheduling_log.txt')
+
+class FakeTaskCursor:
+    """只实现调度器用到的几种查询"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.result = []
+
+    def execute(self, sql, args=None):
+        pending = [row for row in self.rows if row['state'] == 0]
+        if 'GROUP BY' in sql:
+            users = sorted({row['user_id'] for row in pending}, key=lambda u: (u is not None, u))
+            if '> %s' in sql:
+                users = [u for u in users if u is not None and u > args[0]]
+            self.result = [{'user_id': u} for u in users[:args[-1]]]
+        elif '<=>' in sql:
+            user, limit = args
+            self.result = sorted([row for row in pending if row['user_id'] == user], key=lambda r: r['id'])[:limit]
+        elif 'CEIL(' in sql:
+            # 老化查询: 行中的waited表示已等待的秒数
+            low, min_wait, _, step, interval, limit = args
+            aged = [row for row in pending if row['priority'] < low and row.get('waited', 0) >= max(min_wait, math.ceil((low - row['priority']) / step) * interval)]
+            self.result = sorted(aged, key=lambda r: (-r.get('waited', 0), r['id']))[:limit]
+        elif 'BETWEEN' in sql:
+            low, high, limit = args
+            lane = [row for row in pending if low <= row['priority'] <= high]
+            self.result = sorted(lane, key=lambda r: (-r['priority'], r['id']))[:limit]
+        else:
+            raise AssertionError(sql)
+
+    def fetchall(self):
+        return self.result
+
+def make_rows():
+    # 用户1有100个任务, 用户2和用户3各有2个任务, 且排在用户1之后
+    rows = [{'id': i, 'user_id': 1, 'state': 0} for i in range(100)]
+    rows += [{'id': 100 + i, 'user_id': 2, 'state': 0} for i in range(2)]
+    rows += [{'id': 200 + i, 'user_id': 3, 'state': 0} for i in range(2)]
+    return rows
+
+def test_small_users_are_not_blocked():
+    """大量任务的用户不会阻塞后提交的小用户"""
+    scheduler = FairShareScheduler(TaskSQL(projection=PROJECTED_FIELDS + ('user_id',)), LOG_PATH)
+    rows = scheduler.select(FakeTaskCursor(make_rows()), 6, True)
+    assert sorted(row['user_id'] for row in rows) == [1, 1, 2, 2, 3, 3]
+    # 交错排列
+    assert [row['user_id'] for row in rows[:3]] == [1, 2, 3]
+
+def test_per_user_cap():
+    """达到单用户并发上限的用户不再分配名额"""
+    scheduler = FairShareScheduler(TaskSQL(), LOG_PATH, max_per_user=2, user_load=lambda: {1: 2})
+    rows = scheduler.select(FakeTaskCursor(make_rows()), 6, True)
+    assert all(row['user_id'] != 1 for row in rows)
+
+def test_rotation():
+    """名额不够分时, 下一次从上次轮转到的用户之后继续"""
+    scheduler = FairShareScheduler(TaskSQL(), LOG_PATH)
+    cursor = FakeTaskCursor(make_rows())
+    first = scheduler.select(cursor, 2, True)
+    second = scheduler.select(cursor, 2, True)
+    assert [row['user_id'] for row in first] == [1, 2]
+    assert [row['user_id'] for row in second] == [3, 1]
+
+def make_priority_rows(batch=100, paid=100):
+    rows = [{'id': i, 'priority': 0, 'state': 0} for i in range(batch)]
+    rows += [{'id': 1000 + i, 'priority': 5, 'state': 0} for i in range(paid)]
+    return rows
+
+def test_priority_weighted_shares():
+    """各通道按权重分配名额, 低优先级通道也能分到名额"""
+    lanes = [{'name': 'paid', 'min_priority': 1, 'weight': 3}, {'name': 'batch', 'max_priority': 0, 'weight': 1}]
+    scheduler = PriorityLaneScheduler(TaskSQL(), LOG_PATH, lanes=lanes)
+    rows = scheduler.select(FakeTaskCursor(make_priority_rows()), 8, True)
+    assert [row['priority'] for row in rows] == [5] * 6 + [0] * 2
+
+def test_priority_leftover():
+    """高优先级通道任务不足时, 剩余名额补给其他通道"""
+    lanes = [{'name': 'paid', 'min_priority': 1, 'weight': 3}, {'name': 'batch', 'max_priority': 0, 'weight': 1}]
+    scheduler = PriorityLaneScheduler(TaskSQL(), LOG_PATH, lanes=lanes)
+    rows = scheduler.select(FakeTaskCursor(make_priority_rows(paid=1)), 8, True)
+    assert len(rows) == 8
+    assert len({row['id'] for row in rows}) == 8
+
+def set_waited(row, waited):
+    # created_at越小等待越久, 老化查询读取waited
+    row['waited'] = waited
+    row['created_at'] = -waited
+
+def test_priority_aging_by_wait_time():
+    """等待足够久的低优先级任务按通道下界参与竞争, 不修改priority字段, 同一任务只领取一次"""
+    lanes = [{'name': 'paid', 'min_priority': 1, 'weight': 3}, {'name': 'batch', 'max_priority': 0, 'weight': 1}]
+    rows = make_priority_rows()
+    set_waited(rows[0], 600)
+    set_waited(rows[1], 299)
+    rows[2]['priority'] = -2
+    set_waited(rows[2], 600)
+    scheduler = PriorityLaneScheduler(TaskSQL(), LOG_PATH, lanes=lanes, aging_interval=300, aging_step=1)
+    # paid通道的任务优先级高于下界, 总是先于老化任务
+    claimed = scheduler.select(FakeTaskCursor(rows), 4, True)
+    assert [row['id'] for row in claimed] == [1000, 1001, 1002, 0]
+    # paid通道任务在下界时, 优先级0的任务等待300秒后按等待时间与它们竞争, 优先级-2的任务需要900秒
+    for row in rows[100:]:
+        row['priority'] = 1
+        set_waited(row, 10)
+    claimed = scheduler.select(FakeTaskCursor(rows), 4, True)
+    assert [row['id'] for row in claimed] == [0, 1000, 1001, 1]
+    assert rows[0]['priority'] == 0
+    disabled = PriorityLaneScheduler(TaskSQL(), LOG_PATH, lanes=lanes, aging_interval=0)
+    assert [row['id'] for row in disabled.select(FakeTaskCursor(rows), 4, True)] == [1000, 1001, 1002, 0]
+
+def test_aged_rows_do_not_displace_lane():
+    """大量老化任务不会挤占高优先级通道自己的任务"""
+    lanes = [{'name': 'paid', 'min_priority': 1, 'weight': 3}, {'name': 'batch', 'max_priority': 0, 'weight': 1}]
+    rows = make_priority_rows()
+    for row in rows[:100]:
+        set_waited(row, 3600)
+    scheduler = PriorityLaneScheduler(TaskSQL(), LOG_PATH, lanes=lanes, aging_interval=300)
+    claimed = scheduler.select(FakeTaskCursor(rows), 8, True)
+    assert [row['id'] for row in claimed] == [1000, 1001, 1002, 1003, 1004, 1005, 0, 1]
+
+def test_aged_rows_fill_leftover():
+    """高优先级通道只有老化任务时, 老化任务与本通道任务都不会重复领取"""
+    lanes = [{'name': 'paid', 'min_priority': 1, 'weight': 1}, {'name': 'batch', 'max_priority': 0, 'weight': 1}]
+    rows = [{'id': i, 'priority': 0, 'state': 0, 'waited': 1000} for i in range(6)]
+    scheduler = PriorityLaneScheduler(TaskSQL(), LOG_PATH, lanes=lanes, aging_interval=300)
+    claimed = scheduler.select(FakeTaskCursor(rows), 4, True)
+    assert sorted(row['id'] for row in claimed) == [0, 1, 2, 3]
+
+if __name__ == "__main__":
+    test_small_users_are_not_blocked()
+    test_per_user_cap()
+    test_rotation()
+    test_priority_weighted_shares()
+    test_priority_leftover()
+    test_priority_aging_by_wait_time()
+    test_aged_rows_do_not_displace_lane()
+    test_aged_rows_fill_leftover()
+    print("\n测试完成！")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试TaskDeadline截止时间与取消标记的脚本(不需要数据库)
+"""
+
+from task_context import TaskContext, TaskDeadline
+
+def test_deadline_counts_from_start():
+    """开始执行前不计时, 开始后按seconds判断是否超时"""
+    deadline = TaskDeadline(5)
+    assert not deadline.expired(100)
+    deadline.start(100)
+    assert deadline.remaining(102) == 3
+    assert not deadline.expired(104.9)
+    assert deadline.expired(105)
+
+def test_finish_once_and_cancel():
+    """看门狗与回调只有一方能写回结果, 取消标记对TaskContext可见"""
+    deadline = TaskDeadline(1)
+    ctx = TaskContext(7, None, None, deadline)
+    assert deadline.finish()
+    assert not deadline.finish()
+    assert not ctx.cancelled()
+    deadline.cancel()
+    assert ctx.cancelled()
+    assert TaskContext(8).remaining() is None
+
+def test_worker_state_resolved_on_access():
+    """worker_state在func访问时才从当前线程取值"""
+    import threading
+    local = threading.local()
+    ctx = TaskContext(9, state_getter=lambda: getattr(local, 'state', None))
+    assert ctx.worker_state is None
+    local.state = {'client': 'warm'}
+    assert ctx.worker_state == {'client': 'warm'}
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(ctx.worker_state))
+    thread.start()
+    thread.join()
+    assert seen == [None]
+    assert TaskContext(10).worker_state is None
+
+if __name__ == "__main__":
+    test_deadline_counts_from_start()
+    test_finish_once_and_cancel()
+    test_worker_state_resolved_on_access()
+    print("\n测试完成！")
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试TaskSQL根据配置生成SQL语句的脚本(不需要数据库)
+"""
+
+from task_sql import TaskSQL
+from read_config import read_config
+
+def test_config_mapping():
+    """表名和字段映射来自配置, 查询结果使用逻辑字段名作为别名"""
+    sql = TaskSQL('other_tasks', {'state': 'status', 'prompt': 'text'})
+    claim = sql.claim_select(True)
+    assert 'FROM `other_tasks`' in claim
+    assert '`status` = 0' in claim
+    assert '`text` AS `prompt`' in claim
+    assert '*' not in claim
+    assert claim.endswith('FOR UPDATE SKIP LOCKED')
+
+def test_statement_cache():
+    """相同的语句只生成一次"""
+    sql = TaskSQL()
+    assert sql.success_update(3, False) is sql.success_update(3, False)
+    assert sql.success_update(3, False) != sql.success_update(4, False)
+
+def test_record_artifacts():
+    """开启record_artifacts时成功语句写入各任务的产物路径, 未开启时参数不变"""
+    sql = TaskSQL(fields={'artifact_path': 'video_path'}, record_artifacts=True)
+    assert '`video_path` = CASE `id` WHEN %s THEN IFNULL(%s, `video_path`) WHEN %s THEN IFNULL(%s, `video_path`) END' in sql.success_update(2, True)
+    assert sql.success_args([(1, '/a.mp4'), (2, None)], 'w') == ('success', 1, '/a.mp4', 2, None, 1, 2, 'w')
+    assert TaskSQL().success_args([(1, '/a.mp4')]) == ('success', 1)
+
+def test_aged_claim_does_not_update():
+    """老化由created_at在领取时计算, 没有修改priority的语句"""
+    sql = TaskSQL(fields={'created_at': 'create_time'})
+    claim = sql.claim_select_aged(True)
+    assert claim.startswith('SELECT') and 'SET' not in claim
+    assert '`create_time` <= NOW() - INTERVAL (CEIL((%s - `priority`) / %s) * %s) SECOND' in claim
+    assert claim.count('%s') == 6 and claim.endswith('FOR UPDATE SKIP LOCKED')
+    assert not hasattr(sql, 'age_priorities')
+
+def test_invalid_identifier():
+    """配置中的非法列名会被拒绝"""
+    try:
+        TaskSQL(fields={'state': 'state; drop table x'}).claim_select(False)
+    except ValueError:
+        return
+    raise AssertionError('expected ValueError')
+
+def test_default_config():
+    """仓库自带的配置可以直接生成语句"""
+    config = read_config('./movie_agent_config.json')
+    sql = TaskSQL(config['table_name'], config['fields'])
+    assert 'FROM `text_to_video_tasks`' in sql.claim_select(False)
+
+def test_retry_backoff():
+    """开启延迟重试后, 领取语句跳过未到时间的任务, 失败语句在retry_times之前写入next_run_at"""
+    sql = TaskSQL(retry_backoff=(5, 600, 0.2))
+    assert '`next_run_at` <= NOW(3)' in sql.claim_select(False)
+    assert '`next_run_at` <= NOW(3)' in sql.pending_users(True)
+    stmt, args = sql.failure_update([(7, 'boom')], 3, 'w1')
+    assert stmt.index('`next_run_at` =') < stmt.index('`retry_times` = IF')
+    assert stmt.count('%s') == len(args)
+    assert args[-3:] == (3, 7, 'w1')
+    plain, plain_args = TaskSQL().failure_update([(7, 'boom')], 3, 'w1')
+    assert 'next_run_at' not in plain and plain.count('%s') == len(plain_args)
+
+if __name__ == "__main__":
+    test_config_mapping()
+    test_statement_cache()
+    test_record_artifacts()
+    test_aged_claim_does_not_update()
+    test_invalid_identifier()
+    test_default_config()
+    test_retry_backoff()
+    print("\n测试完成！")